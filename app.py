@@ -6,6 +6,10 @@ from aws_cdk import (
     aws_s3 as s3,
     aws_s3_notifications as s3n,
     aws_iam as iam,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as event_sources,
 )
 from constructs import Construct
 from aws_cdk import Duration
@@ -15,18 +19,54 @@ class Architecture(Stack):
         super().__init__(scope, construct_id, **kwargs)
 
         # Create an S3 bucket
-        bucket = s3.Bucket(self, "Bucket")
+        bucket = s3.Bucket(self, "Bucket",
+            # data handed between the stages and their checkpoints are only needed while a job is in progress
+            lifecycle_rules=[
+                s3.LifecycleRule(prefix="artifacts/", expiration=Duration.days(7)),
+                s3.LifecycleRule(prefix="jobs/", expiration=Duration.days(7)),
+                # the LLM response cache treats entries older than 7 days as missing
+                s3.LifecycleRule(prefix="llm-cache/", expiration=Duration.days(8)),
+            ],
+        )
+
+        # modules shared by the lambdas (result layout, lookups and compaction)
+        shared_layer = lambda_.LayerVersion(
+            self, "SharedLayer",
+            code=lambda_.Code.from_asset("lambda/shared"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+        )
+
+        # the pipeline stages pass job records through these queues, a record that keeps failing ends up in the dead letter queue.
+        # messages stay invisible for longer than a stage may run
+        dead_letter_queue = sqs.Queue(self, "PipelineDeadLetterQueue", retention_period=Duration.days(14))
+        pipeline_queue = sqs.Queue(
+            self, "PipelineQueue",
+            visibility_timeout=Duration.seconds(960),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue),
+        )
+        verification_queue = sqs.Queue(
+            self, "VerificationQueue",
+            visibility_timeout=Duration.seconds(960),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue),
+        )
+        pipeline_environment = {
+            "S3_BUCKET_NAME": bucket.bucket_name,
+            "PIPELINE_QUEUE_URL": pipeline_queue.queue_url,
+            "VERIFICATION_QUEUE_URL": verification_queue.queue_url,
+        }
 
         insights_verification = lambda_.Function(
             self, 'InsightsVerification',
             runtime=lambda_.Runtime.PYTHON_3_9,
-            handler='verify_insights.verify_insights',
+            handler='verify_insights.queue_handler',
             code=lambda_.Code.from_docker_build(
                 "lambda/insights_verification",
         ),
-        timeout=Duration.seconds(900)
+        timeout=Duration.seconds(900),
+        layers=[shared_layer],
+        environment=pipeline_environment,
         )
-        # Create consolidated Lambda function
+        # Create consolidated Lambda function, it only starts a pipeline job for the upload
         insights_generation = lambda_.Function(
             self, 'InsightsGeneration',
             runtime=lambda_.Runtime.PYTHON_3_9,
@@ -34,33 +74,80 @@ class Architecture(Stack):
             code=lambda_.Code.from_docker_build(
                 "lambda/insights_generation",
         ),
+        # hashes the uploaded ZIP to skip uploads that were processed before
+        timeout=Duration.seconds(300),
+        layers=[shared_layer],
+        environment=pipeline_environment,
+        )
+        # runs the ingest, preprocess, generate, paraphrase and publish stages
+        pipeline_worker = lambda_.Function(
+            self, 'PipelineWorker',
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            handler='stages.handler',
+            code=lambda_.Code.from_docker_build(
+                "lambda/insights_generation",
+        ),
         timeout=Duration.seconds(900),
-        environment={
-            "InsightsVerificationLambdaFunctionName": insights_verification.function_name,
-            "S3_BUCKET_NAME": bucket.bucket_name
-            },
-             
+        layers=[shared_layer],
+        environment=pipeline_environment,
         )
+        pipeline_worker.add_event_source(event_sources.SqsEventSource(pipeline_queue, batch_size=1))
+        # the generate stage has every insight verified as soon as it is final
+        pipeline_worker.add_environment("VERIFICATION_FUNCTION_NAME", insights_verification.function_name)
+        insights_verification.grant_invoke(pipeline_worker)
+        insights_verification.add_event_source(event_sources.SqsEventSource(verification_queue, batch_size=1))
 
         api_lambda = lambda_.Function(
             self, "api",
             runtime=lambda_.Runtime.PYTHON_3_9,
             handler="api_function.handler",
             code=lambda_.Code.from_asset("lambda/api_gateway"),
+            layers=[shared_layer],
             environment={
                 "S3_BUCKET_NAME": bucket.bucket_name
             },
             timeout=Duration.seconds(100)
         )
 
+        # folds the per-run result objects into the group manifests
+        results_compaction = lambda_.Function(
+            self, "ResultsCompaction",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            handler="compact.handler",
+            code=lambda_.Code.from_docker_build(
+                "lambda/results_compaction",
+        ),
+        timeout=Duration.seconds(900),
+        layers=[shared_layer],
+        environment={
+            "S3_BUCKET_NAME": bucket.bucket_name
+            },
+        )
+        events.Rule(
+            self, "ResultsCompactionSchedule",
+            schedule=events.Schedule.rate(Duration.hours(1)),
+            targets=[targets.LambdaFunction(results_compaction)],
+        )
+
         # Grant Lambda function access to S3 bucket
+        # reads the upload and writes the processed markers under ingest/
         bucket.grant_read_write(insights_generation)
+        bucket.grant_read_write(pipeline_worker)
         bucket.grant_read(api_lambda)
+        bucket.grant_read_write(results_compaction)
+        # the verification lambda reads the handed off data and writes its checkpoint
+        bucket.grant_read_write(insights_verification)
+        pipeline_queue.grant_send_messages(insights_generation)
+        pipeline_queue.grant_send_messages(pipeline_worker)
+        pipeline_queue.grant_send_messages(insights_verification)
+        verification_queue.grant_send_messages(pipeline_worker)
+        verification_queue.grant_send_messages(insights_verification)
 
-        # Add S3 event notification to trigger Lambda
+        # Add S3 event notification to trigger Lambda, only for the uploads and not for what the pipeline writes
         bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
             s3n.LambdaDestination(insights_generation),
+            s3.NotificationKeyFilter(suffix=".zip"),
         )
 
 
@@ -74,7 +161,7 @@ class Architecture(Stack):
 
         # Add permissions for invoking Bedrock
         bedrock_policy = iam.PolicyStatement(
-            actions=["bedrock:InvokeModel","bedrock:ListFoundationModels"],
+            actions=["bedrock:InvokeModel","bedrock:InvokeModelWithResponseStream","bedrock:ListFoundationModels"],
             resources=["*"]  # Specify the ARN of your Bedrock model if possible
         )
         guardrail_policy = iam.PolicyStatement(
@@ -83,13 +170,9 @@ class Architecture(Stack):
                 ],
             resources=["*"]
         )
-        insights_generation.add_to_role_policy(guardrail_policy)
-        insights_generation.add_to_role_policy(bedrock_policy)
+        pipeline_worker.add_to_role_policy(guardrail_policy)
+        pipeline_worker.add_to_role_policy(bedrock_policy)
         insights_verification.add_to_role_policy(bedrock_policy)
-        insights_generation.role.add_to_policy(iam.PolicyStatement(
-        actions=["lambda:InvokeFunction"],
-        resources=[insights_verification.function_arn]
-        ))
         lambda_.EventInvokeConfig(
         self, "api_InvokeConfig",
         function=insights_generation,
@@ -0,0 +1,95 @@
+"""
+Benchmark for preprocess_data: legacy row-by-row implementation vs the vectorized one.
+
+usage: python benchmarks/bench_preprocess.py [rows ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from dateutil import parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "insights_generation"))
+
+from preprocess import preprocess_data  # noqa: E402
+
+
+def legacy_date_format(date_string):
+    return parser.parse(date_string).strftime("%-m/%-d/%Y")
+
+
+def legacy_preprocess(hourly, child, group):
+    frames = [hourly, child, group]
+    for df in frames:
+        df.columns = [col.strip() for col in df.columns]
+        for col in df.columns:
+            if df[col].dtype == "object":
+                df[col] = df[col].str.strip()
+        df.replace("", np.nan, inplace=True)
+        df.dropna(inplace=True)
+    for df in frames:
+        df["Day Date"] = df["Day Date"].apply(legacy_date_format)
+    return hourly.to_csv(index=False), child.to_csv(index=False), group.to_csv(index=False)
+
+
+def make_frames(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range("2024-01-08", periods=60, freq="B")
+    day_strings = np.array([f" {d.month:02d}/{d.day:02d}/{d.year} " for d in days], dtype=object)
+    day_idx = rng.integers(0, len(days), rows)
+    hours = rng.integers(8, 17, rows)
+    hourly = pd.DataFrame({
+        "Group ID ": np.full(rows, 101),
+        "Child ID": rng.integers(1000, 1030, rows),
+        "Day Date": day_strings[day_idx],
+        "Begin Time Local": [f"{days[d].date()} {h:02d}:00:00" for d, h in zip(day_idx, hours)],
+        "Duration Sum": rng.integers(0, 3600, rows),
+        "CT Avg": rng.integers(0, 60, rows),
+        "CT Sum": rng.integers(0, 60, rows),
+        "AWC Avg": rng.integers(0, 2000, rows),
+        "AWC Sum": rng.integers(0, 2000, rows),
+    })
+    hourly.loc[rng.random(rows) < 0.01, "Begin Time Local"] = " "
+    child_rows = max(rows // 8, 1)
+    child = pd.DataFrame({
+        "Group ID": np.full(child_rows, 101),
+        "Child ID": rng.integers(1000, 1030, child_rows),
+        "Child Name": rng.choice(np.array([" Ana", "Ben ", "Cleo"], dtype=object), child_rows),
+        "Day Date": day_strings[rng.integers(0, len(days), child_rows)],
+        "CT Sum": rng.integers(0, 400, child_rows),
+    })
+    group = pd.DataFrame({
+        "Group ID": np.full(len(days), 101),
+        "Group Name": np.full(len(days), " Robins "),
+        "Day Date": day_strings,
+        "CT Avg": rng.integers(0, 60, len(days)),
+    })
+    return hourly, child, group
+
+
+def vectorized_preprocess(hourly, child, group):
+    hourly, child, group, _ = preprocess_data(hourly, child, group)
+    return hourly.to_csv(index=False), child.to_csv(index=False), group.to_csv(index=False)
+
+
+def timed(fn, frames):
+    copies = [df.copy() for df in frames]
+    start = time.perf_counter()
+    out = fn(*copies)
+    return time.perf_counter() - start, out
+
+
+def main(sizes):
+    print(f"{'rows':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+    for rows in sizes:
+        frames = make_frames(rows)
+        legacy_time, legacy_out = timed(legacy_preprocess, frames)
+        new_time, new_out = timed(vectorized_preprocess, frames)
+        assert legacy_out == new_out, "outputs differ"
+        print(f"{rows:>10} {legacy_time:>12.3f} {new_time:>15.3f} {legacy_time / new_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -1,7 +1,9 @@
 import json
 import boto3
 import os
+import hashlib
 import logging
+from result_store import load_history, ResultCache
 
 
 s3 = boto3.client('s3')
@@ -9,45 +11,162 @@ s3 = boto3.client('s3')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# parsed result objects, kept while the lambda is warm and revalidated against S3 by ETag
+result_cache = ResultCache(max_entries=int(os.environ.get('RESULT_CACHE_ENTRIES', 256)))
+
+TIMESTAMP_FIELD = "Insight_generation_timestamp"
+TRUE_VALUES = ("1", "true", "yes")
+# stored with each result for the next upload's comparison, only returned when asked for with fields
+INTERNAL_FIELDS = ("fingerprints",)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _response(status_code, body=None, etag=None):
+    response = {'statusCode': status_code, 'headers': {}}
+    if etag:
+        response['headers']['ETag'] = etag
+    if body is not None:
+        response['headers']['Content-Type'] = 'application/json'
+        response['body'] = body
+    return response
+
+
+def _int_param(params, name):
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer.")
+    if value < 1:
+        raise BadRequest(f"'{name}' must be at least 1.")
+    return value
+
+
+def _list_param(params, name):
+    return [v.strip() for v in (params.get(name) or "").split(",") if v.strip()]
+
+
+def parse_query(params):
+    '''
+    latest      only the newest entry of each group
+    limit       at most this many entries per group, newest first
+    cursor      entries older than data_<cursor>, taken from next_cursor of the previous page
+    since       entries generated after this ISO timestamp (Insight_generation_timestamp)
+    fields      only these fields of each entry, e.g. fields=insights,Insight_generation_timestamp
+                (internal fields such as fingerprints are only returned when named here)
+    exclude     every field but these, e.g. exclude=verification_details
+    '''
+    query = {
+        "limit": 1 if (params.get('latest') or "").lower() in TRUE_VALUES else _int_param(params, 'limit'),
+        "cursor": _int_param(params, 'cursor'),
+        "since": params.get('since') or None,
+        "fields": _list_param(params, 'fields'),
+        "exclude": _list_param(params, 'exclude'),
+    }
+    return query
+
+
+def _entry_number(key):
+    suffix = key.rsplit("_", 1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def _project(entry, fields, exclude):
+    if not isinstance(entry, dict):
+        return entry
+    if fields:
+        entry = {k: v for k, v in entry.items() if k in fields}
+    else:
+        entry = {k: v for k, v in entry.items() if k not in INTERNAL_FIELDS}
+    if exclude:
+        entry = {k: v for k, v in entry.items() if k not in exclude}
+    return entry
+
+
+def select_entries(history, query):
+    '''
+    Applies the query to a group history ({"data_1": ..., ...}). Returns the selected entries
+    (data_<n> -> entry, newest first) and the cursor of the next page, or None when this is the last page.
+    '''
+    keys = sorted((k for k in history if k.startswith("data_")), key=_entry_number, reverse=True)
+    if query["cursor"]:
+        keys = [k for k in keys if _entry_number(k) < query["cursor"]]
+    if query["since"]:
+        # ISO timestamps written by the generation lambda compare in time order as strings
+        keys = [k for k in keys if str((history[k] or {}).get(TIMESTAMP_FIELD, "")) > query["since"]]
+    next_cursor = None
+    if query["limit"] and len(keys) > query["limit"]:
+        keys = keys[:query["limit"]]
+        next_cursor = _entry_number(keys[-1])
+    selected = {k: _project(history[k], query["fields"], query["exclude"]) for k in keys}
+    return selected, next_cursor
+
+
+def _header(event, name):
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
 def handler(event, context):
     try:
         logger.info("Received event: " + json.dumps(event))
         bucket_name = os.environ['S3_BUCKET_NAME']
-        response = s3.list_objects_v2(Bucket=bucket_name)
-        query_params = event.get('queryStringParameters')
+        query_params = event.get('queryStringParameters') or {}
         key_to_search = query_params.get('group_no')
         if not key_to_search:
             logger.error("No group_no provided in the query parameters.")
             return {
             'statusCode': 404,
             'body': json.dumps({"error": "No 'group_no' provided in the query parameters. please provide a group_no."})
-            } 
-        groups = key_to_search.split(',')
-        matches_keys = []
+            }
+        groups = list(dict.fromkeys(g.strip() for g in key_to_search.split(',') if g.strip()))
+        try:
+            query = parse_query(query_params)
+        except BadRequest as e:
+            return {'statusCode': 400, 'body': json.dumps({"error": str(e)})}
+
+        # one exact key per group instead of scanning the whole bucket
+        found = {}
         for g in groups:
-            for obj in response.get('Contents', []):
-                if g in obj['Key']:
-                    matches_keys.append(obj['Key'])
-        if not matches_keys:
+            history = load_history(s3, bucket_name, g, cache=result_cache)
+            if history is None:
+                continue
+            entries, next_cursor = select_entries(history, query)
+            entries["Group No"] = g
+            if next_cursor:
+                entries["next_cursor"] = next_cursor
+            found[g] = entries
+        logger.info(f"Result cache: {result_cache.hits} hits, {result_cache.misses} misses")
+        if not found:
             logger.error("No insights for requested groups found.")
             return  {
             'statusCode': 404,
             'body': json.dumps({"error": "No insights for requested groups found."})
-            } 
-        group_file = matches_keys[0]
-        file_obj = s3.get_object(Bucket=bucket_name, Key=f"{group_file}")
-        file_content = file_obj['Body'].read().decode('utf-8')
-        json_content = json.loads(file_content)
-        json_content["Group No"] = ",".join(group_file.split("_")).replace(".json", "")
+            }
+        if len(groups) == 1:
+            json_content = found[groups[0]]
+        else:
+            json_content = {"groups": found, "missing": [g for g in groups if g not in found]}
+
+        body = json.dumps(json_content)
+        etag = '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+        if_none_match = _header(event, 'if-none-match')
+        if if_none_match and etag in [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]:
+            logger.info("Results not modified since the client's copy.")
+            return _response(304, etag=etag)
         logger.info("Successfully processed the request.")
-        return {
-            'statusCode': 200,
-            'body': json.dumps(json_content)
-        } 
+        return _response(200, body, etag)
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
 
         return {
             'statusCode': 500,
             'body': json.dumps({"error": "An error occurred while processing the request."})
-            } 
\ No newline at end of file
+            }
@@ -0,0 +1,154 @@
+import pandas as pd
+import numpy as np
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+PERCENTILES = [0.1, 0.25, 1 / 3, 0.5, 2 / 3, 0.75, 0.9]
+
+# when the raw csvs are larger than this (characters) "auto" mode leaves the hourly and child rows
+# out of the generation prompt and relies on the summary block
+RAW_DATA_CHAR_LIMIT = 100_000
+
+# note placed in the prompt instead of csv rows that were left out
+OMITTED_NOTE = "(rows omitted to keep the prompt small, use the pre-computed statistics in the DATA SUMMARY section)"
+# placed in the prompt instead of the summary when the csv rows are there without one
+NO_SUMMARY_NOTE = "(not provided, use the csv files)"
+
+
+def _parse_unique(column, **kwargs):
+    # parse each distinct value once
+    codes, uniques = pd.factorize(column)
+    parsed = pd.to_datetime(pd.Index(np.asarray(uniques, dtype=object)), errors="coerce", **kwargs)
+    return pd.Series(parsed.take(codes), index=column.index).where(codes != -1)
+
+
+def _table(df, float_format="%.1f"):
+    return df.to_csv(float_format=float_format)
+
+
+def child_day_table(hourly, child):
+    '''
+    One row per group, child and day with the daily CT and AWC totals and the hours of data.
+    CT Sum comes from the child file when it has the day, otherwise from the hourly rows.
+    '''
+    keys = ["Group ID", "Child ID", "Day Date"]
+    daily = hourly.groupby(keys, observed=True).agg(
+        ct_sum=("CT Sum", "sum"),
+        awc_sum=("AWC Sum", "sum"),
+        hours=("CT Sum", "size"),
+    )
+    if "CT Sum" in child.columns:
+        child_ct = child.groupby(keys, observed=True)["CT Sum"].sum().rename("child_ct_sum")
+        daily = daily.join(child_ct, how="outer")
+        daily["ct_sum"] = daily["child_ct_sum"].fillna(daily["ct_sum"])
+        daily = daily.drop(columns="child_ct_sum")
+    daily = daily.reset_index()
+    daily["date"] = _parse_unique(daily["Day Date"], format="%m/%d/%Y")
+    return daily
+
+
+def child_aggregates(daily):
+    per_child = daily.groupby(["Group ID", "Child ID"], observed=True).agg(
+        days=("ct_sum", "size"),
+        ct_day_mean=("ct_sum", "mean"),
+        ct_day_min=("ct_sum", "min"),
+        ct_day_max=("ct_sum", "max"),
+        awc_day_mean=("awc_sum", "mean"),
+        bottom_third_days=("bottom_third", "sum"),
+    )
+    # percentile of each child's average daily CT within their group
+    per_child["ct_percentile"] = per_child.groupby(level="Group ID", observed=True)["ct_day_mean"].rank(pct=True) * 100
+    return per_child.sort_values("ct_day_mean")
+
+
+def day_aggregates(daily):
+    return daily.groupby(["Group ID", "date"], observed=True).agg(
+        children=("Child ID", "nunique"),
+        ct_total=("ct_sum", "sum"),
+        ct_child_mean=("ct_sum", "mean"),
+        ct_child_median=("ct_sum", "median"),
+        awc_child_mean=("awc_sum", "mean"),
+    )
+
+
+def mark_bottom_tercile(daily):
+    # a child is in the bottom third of a day when their CT for the day ranks in the lowest third of the group
+    rank = daily.groupby(["Group ID", "date"], observed=True)["ct_sum"].rank(method="max", pct=True)
+    return daily.assign(bottom_third=(rank <= 1 / 3).astype(np.int16))
+
+
+def weekly_deltas(daily):
+    weekly = daily.assign(week=daily["date"].dt.to_period("W-SUN").dt.start_time)
+    per_child = weekly.groupby(["Group ID", "Child ID", "week"], observed=True)["ct_sum"].mean().rename("ct_day_mean").reset_index()
+    per_child["wow_change_pct"] = per_child.groupby(["Group ID", "Child ID"], observed=True)["ct_day_mean"].pct_change() * 100
+    per_group = weekly.groupby(["Group ID", "week"], observed=True).agg(ct_child_day_mean=("ct_sum", "mean"), awc_child_day_mean=("awc_sum", "mean"))
+    per_group["ct_wow_change_pct"] = per_group.groupby(level="Group ID", observed=True)["ct_child_day_mean"].pct_change() * 100
+    per_group["awc_wow_change_pct"] = per_group.groupby(level="Group ID", observed=True)["awc_child_day_mean"].pct_change() * 100
+    return per_child, per_group
+
+
+def hour_profile(hourly):
+    hour = _parse_unique(hourly["Begin Time Local"]).dt.hour
+    frame = hourly.assign(hour=hour.to_numpy())
+    columns = {name: (name, "mean") for name in ["CT Avg", "AWC Avg"] if name in frame.columns}
+    columns.update(ct_sum_mean=("CT Sum", "mean"), awc_sum_mean=("AWC Sum", "mean"), rows=("CT Sum", "size"))
+    return frame.dropna(subset=["hour"]).astype({"hour": int}).groupby(["Group ID", "hour"], observed=True).agg(**columns)
+
+
+def summarize(hourly, child, group):
+    '''
+    Computes the statistics the generation prompt used to ask the model to work out itself
+    and returns them as one compact text block.
+    '''
+    daily = mark_bottom_tercile(child_day_table(hourly, child))
+    per_child = child_aggregates(daily)
+    per_day = day_aggregates(daily)
+    child_weeks, group_weeks = weekly_deltas(daily)
+    hours = hour_profile(hourly)
+    percentiles = per_child.groupby(level="Group ID", observed=True)["ct_day_mean"].quantile(PERCENTILES).unstack()
+    percentiles.columns = [f"p{round(q * 100)}" for q in PERCENTILES]
+
+    bottom = per_child[per_child["ct_percentile"] <= 100 / 3]
+    persistent = per_child[per_child["bottom_third_days"] >= 3]
+
+    sections = [
+        ("Per-child daily CT/AWC (sorted by average daily CT; bottom_third_days = days the child ranked in the bottom third of the group)", _table(per_child)),
+        ("Percentiles of the children's average daily CT per group", _table(percentiles)),
+        ("Children in the bottom third of their group by average daily CT", ", ".join(str(c) for c in bottom.index.get_level_values("Child ID")) or "none"),
+        ("Children in the bottom third on at least 3 days", ", ".join(str(c) for c in persistent.index.get_level_values("Child ID")) or "none"),
+        ("Per-day group totals and per-child averages", _table(per_day)),
+        ("Week-over-week change of the group's average daily CT and AWC per child (weeks start on Monday)", _table(group_weeks)),
+        ("Week-over-week change of each child's average daily CT", _table(child_weeks.set_index(["Group ID", "Child ID", "week"]))),
+        ("Hour-of-day profile (24h clock, averages over all children and days)", _table(hours)),
+    ]
+    summary = "\n".join(f"{title}:\n{body.strip()}\n" for title, body in sections)
+    logger.info(f"Data summary: {len(summary)} characters")
+    return summary
+
+
+def build_prompt_data(hourly, child, group, csvs, mode="auto"):
+    '''
+    Returns the data that goes into the generation prompt as a dict with hourly_csv, child_csv, group_csv and data_summary.
+    csvs holds the full hourly_csv, child_csv and group_csv strings of the frames.
+    mode is "raw" (csv rows only), "summary" (summary plus the small group file), "both", or "auto"
+    which picks "both" for small uploads and "summary" when the raw rows exceed RAW_DATA_CHAR_LIMIT.
+    In "both" mode the summary is optional, when it can't be computed the prompt gets the csv rows without it.
+    '''
+    if mode == "auto":
+        mode = "both" if sum(len(text) for text in csvs.values()) <= RAW_DATA_CHAR_LIMIT else "summary"
+    logger.info(f"Prompt data mode: {mode}")
+
+    if mode == "raw":
+        return dict(csvs, data_summary=NO_SUMMARY_NOTE)
+    if mode == "summary":
+        return {"hourly_csv": OMITTED_NOTE, "child_csv": OMITTED_NOTE, "group_csv": csvs["group_csv"], "data_summary": summarize(hourly, child, group)}
+    try:
+        data_summary = summarize(hourly, child, group)
+    except Exception as e:
+        logger.error(f"Couldn't summarize the data, the prompt gets the csv rows only: {e}")
+        data_summary = NO_SUMMARY_NOTE
+    return dict(csvs, data_summary=data_summary)
+
+
@@ -0,0 +1,61 @@
+import random
+import threading
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException"}
+
+
+class AdaptiveBackoff:
+    '''
+    Delay shared by the threads calling one model. It doubles on every throttling error
+    and halves on every success, so concurrent callers slow down together while Bedrock
+    is throttling and speed back up once it stops.
+    '''
+
+    def __init__(self, min_delay=0.0, initial_delay=1.0, max_delay=30.0, max_attempts=6):
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.delay = min_delay
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            # jitter so throttled callers don't retry in lockstep
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def throttled(self):
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.initial_delay, self.delay * 2))
+            return self.delay
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay / 2 > self.initial_delay / 4 else self.min_delay
+
+
+def invoke_with_backoff(client, backoff, **kwargs):
+    '''
+    client.invoke_model(**kwargs), retried with the shared backoff delay while Bedrock throttles.
+    '''
+    for attempt in range(1, backoff.max_attempts + 1):
+        backoff.wait()
+        try:
+            response = client.invoke_model(**kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLING_ERROR_CODES or attempt == backoff.max_attempts:
+                raise
+            delay = backoff.throttled()
+            logger.info(f"Throttled by Bedrock ({code}), attempt {attempt}, backing off {delay:.1f}s")
+            continue
+        backoff.succeeded()
+        return response
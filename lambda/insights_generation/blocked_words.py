@@ -0,0 +1,110 @@
+import functools
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the prompts that can go through a guardrail
+PROMPT_FILES = ["insights_generation_prompt.txt", "insights_paraphrasing_prompt.txt"]
+BLOCKED_SENTINEL = "HARSH WORDS DETECTED"
+
+# word lists up to this size are only checked locally, larger ones also get a Bedrock guardrail
+LOCAL_BLOCKLIST_MAX_WORDS = 50
+
+
+class WordMatcher:
+    '''
+    Aho-Corasick automaton over lower-cased words and phrases. find returns the words that
+    occur in a text as whole words, in one pass over the text.
+    '''
+
+    def __init__(self, words):
+        self.words = words
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in words:
+            node = 0
+            for char in word:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(word)
+        # breadth first so each node's failure link is set before its children's
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0) if self.goto[fallback].get(char, 0) != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        text = text.lower()
+        found = []
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for word in self.output[node]:
+                start = end - len(word) + 1
+                before = text[start - 1] if start > 0 else " "
+                after = text[end + 1] if end + 1 < len(text) else " "
+                if not before.isalnum() and not after.isalnum() and word not in found:
+                    found.append(word)
+        return found
+
+
+@functools.lru_cache(maxsize=32)
+def _matcher(words):
+    return WordMatcher(words)
+
+
+def get_matcher(blocked_words):
+    '''
+    Returns the compiled matcher for a word list, built once per distinct list and cached across warm invocations.
+    '''
+    return _matcher(tuple(sorted({str(word).strip().lower() for word in blocked_words if str(word).strip()})))
+
+
+@functools.lru_cache(maxsize=1)
+def prompt_words():
+    words = set()
+    for file_name in PROMPT_FILES:
+        with open(file_name, "r") as f:
+            words.update(word.lower() for word in f.read().split())
+    return frozenset(words)
+
+
+def filter_blocked_words(blocked_words):
+    # delete the words which are present in the prompts from the blocked words, the guardrail would block the prompts otherwise
+    words = prompt_words()
+    return [word for word in blocked_words if word not in words]
+
+
+def screen_insights(insights, blocked_words, rewrite):
+    '''
+    Checks every insight for blocked words and rewrites only the offending ones with rewrite(insight, found_words).
+    An insight that still contains blocked words after the rewrite is replaced by the BLOCKED_SENTINEL.
+    '''
+    if not blocked_words:
+        return insights
+    matcher = get_matcher(blocked_words)
+    screened = []
+    for i, insight in enumerate(insights):
+        found = matcher.find(insight)
+        if found:
+            logger.info(f"Insight {i + 1} contains blocked words {found}, rewriting it")
+            insight = rewrite(insight, found)
+            found = matcher.find(insight)
+            if found:
+                logger.info(f"Insight {i + 1} still contains blocked words {found} after the rewrite")
+                insight = BLOCKED_SENTINEL
+        screened.append(insight)
+    return screened
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import math
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# rows without a day are fingerprinted under this key, they belong to every day
+ALL_DAYS = "*"
+# configuration that doesn't change what a run produces, a difference here doesn't force a new run
+RUNTIME_CONFIG_KEYS = ("paraphrase_concurrency", "verification_rate_limits", "verification_concurrency", "fan_out_groups", "use_llm_cache", "verification_prompt_caching")
+
+
+def _row_hashes(df):
+    # values as text with the columns in name order, so the dtypes the csv happened to be read with don't matter
+    df = df[sorted(df.columns)].astype(str)
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def day_fingerprints(hourly, child, group):
+    '''
+    A content hash per "Day Date" over the rows of that day in the three preprocessed frames.
+    Independent of the row and column order, so the same data uploaded again gets the same fingerprints.
+    '''
+    digests = {}
+    for name, df in (("hourly", hourly), ("child", child), ("group", group)):
+        header = json.dumps([name, sorted(df.columns)]).encode("utf-8")
+        days = df["Day Date"].astype(str) if "Day Date" in df.columns else pd.Series(ALL_DAYS, index=df.index)
+        rows = pd.DataFrame({"day": days.to_numpy(), "hash": _row_hashes(df)}).sort_values(["day", "hash"])
+        for day, hashes in rows.groupby("day", sort=False)["hash"]:
+            digest = digests.setdefault(day, hashlib.sha256())
+            digest.update(header)
+            digest.update(hashes.to_numpy().tobytes())
+    return {day: digest.hexdigest() for day, digest in digests.items()}
+
+
+def config_fingerprint(config):
+    settings = {key: value for key, value in config.items() if key not in RUNTIME_CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def fingerprint(hourly, child, group, config):
+    '''
+    What is stored with a group's result and compared on the group's next upload.
+    '''
+    return {"days": day_fingerprints(hourly, child, group), "config": config_fingerprint(config)}
+
+
+def compare(previous, current):
+    '''
+    Compares the fingerprints of an upload with the ones stored with the group's last result.
+    Returns ("reuse", []) when nothing changed, ("delta", new days) when only days were added
+    and ("full", []) when anything else changed or there is nothing to compare with.
+    '''
+    if not previous or previous.get("config") != current["config"]:
+        return "full", []
+    old_days, new_days = previous["days"], current["days"]
+    if old_days == new_days:
+        return "reuse", []
+    if any(new_days.get(day) != digest for day, digest in old_days.items()):
+        # a day was changed or removed, the old insights may rest on data that's gone
+        return "full", []
+    added = [day for day in new_days if day not in old_days]
+    if ALL_DAYS in added:
+        return "full", []
+    return "delta", sorted(added, key=lambda day: pd.to_datetime(day, format="%m/%d/%Y", errors="coerce"))
+
+
+def delta_insight_count(no_of_insights, new_days, all_days):
+    '''
+    Insights generated for the new days, in proportion to their share of the days (at least one).
+    The rest of the result is filled with the previous insights that still hold.
+    '''
+    return min(no_of_insights, max(1, math.ceil(no_of_insights * len(new_days) / max(1, len(all_days)))))
@@ -5,8 +5,10 @@ import botocore
 import re
 import time
 import boto3
-import uuid
 import logging
+from guardrails import get_guardrail
+from llm_cache import invoke_model_cached, stream_model_cached
+from prompt_budget import DEFAULT_PROMPT_TOKEN_BUDGET, estimate_tokens, output_max_tokens, fit_prompt_data, merge_chunk_insights
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,70 +25,89 @@ client = boto3.client("bedrock-runtime", region_name="us-west-2", config=config)
 with open("examples.txt","r") as f:
     examples = f.read()
 
-def generate_insights(hourly_csv, child_csv, group_csv, no_of_insights, insights_generation_prompt, Insights_generation_model_id, blocked_words, paraphrase_or_not):
+GENERATION_SLOTS = ("hourly_csv", "child_csv", "group_csv", "examples", "no_of_insights", "data_summary")
+
+# a numbered insight runs until the next number or an empty line
+INSIGHT_PATTERN = re.compile(r"\d+\.\s(.*?)(?=\n\d+\.|\n\n|\Z)", re.DOTALL)
+COMPLETE_INSIGHT_PATTERN = re.compile(r"\d+\.\s(.*?)(?=\n\d+\.|\n\n)", re.DOTALL)
+
+
+class InsightParser:
+    '''
+    Splits streamed model output into the numbered insights, calling on_insight with each one
+    as soon as the text that ends it has arrived. Gives the same insights as INSIGHT_PATTERN on the whole text.
+    '''
+
+    def __init__(self, on_insight):
+        self.on_insight = on_insight
+        self.text = ""
+        self.position = 0
+        self.insights = []
+
+    def _emit(self, insight):
+        insight = insight.strip()
+        self.insights.append(insight)
+        self.on_insight(insight)
+
+    def feed(self, text):
+        self.text += text
+        while True:
+            match = COMPLETE_INSIGHT_PATTERN.search(self.text, self.position)
+            if not match:
+                return
+            self._emit(match.group(1))
+            self.position = match.end()
+
+    def finish(self):
+        for match in INSIGHT_PATTERN.finditer(self.text, self.position):
+            self._emit(match.group(1))
+        self.position = len(self.text)
+        return self.insights
+
+
+def generate_insights(hourly, child, group, no_of_insights, insights_generation_prompt, Insights_generation_model_id, blocked_words, paraphrase_or_not, prompt_data_mode="auto", prompt_token_budget=None, use_cache=True, on_insight=None):
     '''
-    Takes three data files as csv strings and number of insights to generate and return a list of insights
+    Takes the three preprocessed data frames and number of insights to generate and return a list of insights.
+    insights_generation_prompt is a PromptTemplate with the GENERATION_SLOTS.
+    The data is compacted (and split into chunks of days if needed) to fit in prompt_token_budget tokens.
+    Responses come from the LLM response cache when the same request was made before, unless use_cache is False.
+    With on_insight the response is streamed and on_insight is called with each final insight in order,
+    as soon as it is generated when the data fits in one prompt, after the chunks are merged otherwise.
+    A failed model call raises, an empty list means the model answered without insights.
     '''
+    guardrail = None
     if not paraphrase_or_not and blocked_words:
-        guardrail = None
-        try:
-            sensitive_words = {
-                'text': [
-                ]
-            }
-
-            for b_w in blocked_words:
-                sensitive_words['text'].append({"text": b_w})
-            client_guardrail = boto3.client('bedrock', region_name='us-west-2')
-            client_token = str(uuid.uuid4())
-
-            guardrails = client_guardrail.list_guardrails()["guardrails"]
-            if "guardrail" not in [guad["name"] for guad in guardrails]:
-                guardrail = client_guardrail.create_guardrail(
-                name='guardrail',
-                description='Guardrail for insights generated from opus model',
-                wordPolicyConfig={
-                    'wordsConfig': sensitive_words['text'],
-                    'managedWordListsConfig': [
-                        {
-                            'type': 'PROFANITY'
-                        },
-                    ]
-                },
-                blockedInputMessaging='HARSH WORDS DETECTED',
-                blockedOutputsMessaging='HARSH WORDS DETECTED',
-                clientRequestToken=str(client_token),
-                )
-                print("Guardrail created successfully in generate_insights")
-            else:
-                guad = [guad for guad in guardrails if guad["name"] == "guardrail"][0]
-                guardrail = client_guardrail.update_guardrail(
-                    guardrailIdentifier=guad["id"],
-                    name='guardrail',
-                    description='Guardrail for insights generated from opus model',
-                    wordPolicyConfig={
-                        'wordsConfig': sensitive_words['text'],
-                        'managedWordListsConfig': [
-                            {
-                                'type': 'PROFANITY'
-                            },
-                        ]
-                    },
-                    blockedInputMessaging='HARSH WORDS DETECTED',
-                    blockedOutputsMessaging='HARSH WORDS DETECTED',
-  
-                    )
-                print("Guardrail updated successfully in generate_insights")
-          
-                
-            print("Guardrail created successfully in generate_insights")
-        except Exception as e:
-            logger.info(f"Error in creating guardrail in generate: {e}")
+        guardrail = get_guardrail(blocked_words)
     logger.info("Generating insights")
-    generate_prompt = f'''{insights_generation_prompt.replace(r"{hourly_csv}", hourly_csv).replace(r"{child_csv}", child_csv).replace(r"{group_csv}", group_csv).replace(r"{examples}",examples).replace(r"{no_of_insights}",str(no_of_insights))}'''
+    budget = prompt_token_budget or DEFAULT_PROMPT_TOKEN_BUDGET
+    # tokens left for the data once the instructions and examples are in the prompt
+    data_budget = budget - estimate_tokens(insights_generation_prompt.text) - estimate_tokens(examples)
+    chunks = fit_prompt_data(hourly, child, group, prompt_data_mode, data_budget)
+    max_tokens = output_max_tokens(no_of_insights)
+
+    # chunk insights are merged before they are final, so only a single prompt is handed on while it streams
+    stream_to = on_insight if len(chunks) == 1 else None
+    chunk_insights = []
+    for prompt_data in chunks:
+        insights = invoke_generation(prompt_data, no_of_insights, insights_generation_prompt, Insights_generation_model_id, guardrail, max_tokens, use_cache, stream_to)
+        if insights == "HARSH WORDS DETECTED":
+            return "HARSH WORDS DETECTED"
+        chunk_insights.append(insights)
+    if len(chunk_insights) == 1:
+        return chunk_insights[0]
+    merged = merge_chunk_insights(chunk_insights, no_of_insights)
+    if on_insight:
+        for insight in merged:
+            on_insight(insight)
+    return merged
+
+
+def invoke_generation(prompt_data, no_of_insights, insights_generation_prompt, Insights_generation_model_id, guardrail, max_tokens, use_cache=True, on_insight=None):
+    generate_prompt = insights_generation_prompt.render(hourly_csv=prompt_data["hourly_csv"], child_csv=prompt_data["child_csv"], group_csv=prompt_data["group_csv"], examples=examples, no_of_insights=no_of_insights, data_summary=prompt_data["data_summary"])
+    logger.info(f"Generation prompt: ~{estimate_tokens(generate_prompt)} tokens, max_tokens {max_tokens}")
     native_request = {
     "anthropic_version": "bedrock-2023-05-31",
-    "max_tokens": 200000,
+    "max_tokens": max_tokens,
     "temperature": 0.5,
     "messages": [
         {
@@ -101,29 +122,29 @@ def generate_insights(hourly_csv, child_csv, group_csv, no_of_insights, insights
 
     try:
         # Invoke the model with the request.
-        if not paraphrase_or_not and blocked_words and guardrail:
+        kwargs = {"modelId": Insights_generation_model_id, "body": request}
+        if guardrail:
             print("Guardrail exists: ", guardrail)
-            print("blocked words: ", blocked_words)
-            response = client.invoke_model(modelId=Insights_generation_model_id, body=request, guardrailIdentifier=guardrail["guardrailId"], guardrailVersion=guardrail["version"])
+            kwargs.update(guardrailIdentifier=guardrail["guardrailId"], guardrailVersion=guardrail["version"])
+        if on_insight:
+            parser = InsightParser(on_insight)
+            model_response = stream_model_cached(client, parser.feed, use_cache, **kwargs)
         else:
-            response = client.invoke_model(modelId=Insights_generation_model_id, body=request)
+            model_response = invoke_model_cached(client.invoke_model, use_cache, **kwargs)
 
-        print("Response ",response)
+        print("Response ",model_response)
     except (ClientError, Exception) as e:
+        # raised on so the pipeline retries the stage, throttling and timeouts usually pass
         logger.error(f"ERROR: Can't invoke '{Insights_generation_model_id}'. Reason: {e}")
-        return
-
-    # Decode the response body.
-    model_response = json.loads(response["body"].read())
+        raise
 
     # Extract and print the response text.
     response_text = model_response["content"][0]["text"]    
 
-    # extract the actual insights
-    pattern = r"\d+\.\s(.*?)(?=\n\d+\.|\n\n|\Z)"
-    matches = re.findall(pattern, response_text, re.DOTALL)
-    insights = [match.strip() for match in matches]
-
     if response_text == "HARSH WORDS DETECTED":
         return "HARSH WORDS DETECTED"
-    return insights
\ No newline at end of file
+    if on_insight:
+        # the last insight is only complete once the stream has ended
+        return parser.finish()
+    # extract the actual insights
+    return [match.strip() for match in INSIGHT_PATTERN.findall(response_text)]
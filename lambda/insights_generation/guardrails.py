@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REGISTRY_KEY = "guardrails/registry.json"
+BLOCKED_MESSAGE = "HARSH WORDS DETECTED"
+
+client_guardrail = boto3.client("bedrock", region_name="us-west-2")
+s3 = boto3.client("s3")
+
+# word-set hash -> {"guardrailId", "version", "name"}, kept across warm invocations
+registry = {}
+registry_lock = threading.Lock()
+
+
+def normalize_words(blocked_words):
+    return sorted({str(word).strip().lower() for word in blocked_words if str(word).strip()})
+
+
+def word_set_hash(blocked_words):
+    return hashlib.sha256("\n".join(normalize_words(blocked_words)).encode("utf-8")).hexdigest()[:16]
+
+
+def _load_registry(bucket_name):
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=REGISTRY_KEY)
+        return json.loads(obj["Body"].read().decode("utf-8"))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return {}
+        raise
+
+
+def _save_registry(bucket_name, key, entry):
+    # merge with what other runs may have written since we read it, entries are never changed once written
+    current = _load_registry(bucket_name)
+    current[key] = entry
+    s3.put_object(Bucket=bucket_name, Key=REGISTRY_KEY, Body=json.dumps(current, indent=2).encode("utf-8"), ContentType="application/json")
+    return current
+
+
+def _find_by_name(name):
+    paginator = client_guardrail.get_paginator("list_guardrails")
+    for page in paginator.paginate():
+        for guardrail in page["guardrails"]:
+            if guardrail["name"] == name:
+                return guardrail["id"]
+    return None
+
+
+def _latest_version(guardrail_id):
+    versions = []
+    paginator = client_guardrail.get_paginator("list_guardrails")
+    for page in paginator.paginate(guardrailIdentifier=guardrail_id):
+        versions += [g["version"] for g in page["guardrails"] if g["version"].isdigit()]
+    return max(versions, key=int) if versions else None
+
+
+def _create_guardrail(name, key, words):
+    # the request tokens are derived from the word set so concurrent runs creating the same guardrail get the same one
+    created = client_guardrail.create_guardrail(
+        name=name,
+        description="Guardrail for insights generated from opus model",
+        wordPolicyConfig={
+            "wordsConfig": [{"text": word} for word in words],
+            "managedWordListsConfig": [{"type": "PROFANITY"}],
+        },
+        blockedInputMessaging=BLOCKED_MESSAGE,
+        blockedOutputsMessaging=BLOCKED_MESSAGE,
+        clientRequestToken=f"create-{key}",
+    )
+    logger.info(f"Guardrail {name} created")
+    return created["guardrailId"]
+
+
+def _resolve(name, key, words):
+    guardrail_id = _find_by_name(name) or _create_guardrail(name, key, words)
+    version = _latest_version(guardrail_id)
+    if version is None:
+        # publish an immutable version, the draft is never used or updated
+        version = client_guardrail.create_guardrail_version(guardrailIdentifier=guardrail_id, clientRequestToken=f"version-{key}")["version"]
+    return {"guardrailId": guardrail_id, "version": version, "name": name}
+
+
+def get_guardrail(blocked_words):
+    '''
+    Returns {"guardrailId", "version"} of the guardrail for this set of blocked words.
+    Guardrails are named after a hash of the normalized word set, looked up in memory first,
+    then in the registry object in S3, and only created (never updated) when no run has made one yet.
+    Returns None when the guardrail can't be set up.
+    '''
+    words = normalize_words(blocked_words)
+    if not words:
+        return None
+    key = word_set_hash(words)
+    name = f"insights-blocked-words-{key}"
+    bucket_name = os.environ.get("S3_BUCKET_NAME")
+    try:
+        with registry_lock:
+            if key not in registry and bucket_name:
+                # first use in this container, or another instance may have registered it since
+                registry.update(_load_registry(bucket_name))
+            if key not in registry:
+                logger.info(f"No guardrail registered for word set {key}, looking it up in Bedrock")
+                entry = _resolve(name, key, words)
+                if bucket_name:
+                    registry.update(_save_registry(bucket_name, key, entry))
+                else:
+                    registry[key] = entry
+            entry = registry[key]
+    except Exception as e:
+        logger.info(f"Error in setting up the guardrail: {e}")
+        return None
+    return {"guardrailId": entry["guardrailId"], "version": entry["version"]}
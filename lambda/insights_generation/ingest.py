@@ -0,0 +1,154 @@
+import collections
+import io
+import json
+import zipfile
+import logging
+
+from schemas import read_csv_with_schema
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the only members read from an upload, anything else in the archive is ignored
+CSV_MEMBERS = ["file_1.csv", "file_2.csv", "file_3.csv"]
+CONFIG_MEMBER = "config.json"
+
+# limits on what an archive may declare, checked before a member is read.
+# zipfile stops decompressing a member at its declared size, so a member can't inflate past them.
+MAX_MEMBER_BYTES = 2 * 1024 ** 3
+MAX_UPLOAD_BYTES = 4 * 1024 ** 3
+MAX_CONFIG_BYTES = 1024 ** 2
+MAX_COMPRESSION_RATIO = 200
+
+# csv members bigger than this are parsed in chunks of CSV_CHUNK_ROWS rows
+CHUNKED_READ_BYTES = 256 * 1024 ** 2
+CSV_CHUNK_ROWS = 500_000
+
+# ranged reads of the S3 object, at most RANGE_CACHE_BLOCKS blocks are held in memory
+RANGE_BLOCK_BYTES = 8 * 1024 ** 2
+RANGE_CACHE_BLOCKS = 4
+
+
+class IngestError(ValueError):
+    pass
+
+
+class S3RangeReader(io.RawIOBase):
+    '''
+    Seekable read-only file over an S3 object, fetched in blocks with ranged GETs.
+    zipfile only needs the central directory at the end and the members it opens, so most of
+    an archive is never downloaded and nothing is written to /tmp.
+    '''
+
+    def __init__(self, s3, bucket_name, key, block_size=RANGE_BLOCK_BYTES, max_blocks=RANGE_CACHE_BLOCKS):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.size = s3.head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+        self.position = 0
+        self.blocks = collections.OrderedDict()
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        self.position = max(0, self.position)
+        return self.position
+
+    def _block(self, index):
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}")
+        data = obj["Body"].read()
+        self.bytes_fetched += len(data)
+        self.blocks[index] = data
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.block_size)
+            data = self._block(index)[offset:offset + len(view) - written]
+            view[written:written + len(data)] = data
+            written += len(data)
+            self.position += len(data)
+        return written
+
+
+class Upload:
+    '''
+    The expected members of an uploaded ZIP archive, read straight from S3.
+    Raises IngestError when the archive is not a ZIP file or a member breaks the size limits.
+    '''
+
+    def __init__(self, s3, bucket_name, key):
+        self.reader = S3RangeReader(s3, bucket_name, key)
+        try:
+            self.archive = zipfile.ZipFile(io.BufferedReader(self.reader, buffer_size=1024 ** 2))
+        except zipfile.BadZipFile as e:
+            raise IngestError(f"{key} is not a valid ZIP archive: {e}")
+        infos = {info.filename: info for info in self.archive.infolist()}
+        self.members = {name: infos[name] for name in CSV_MEMBERS + [CONFIG_MEMBER] if name in infos}
+        ignored = [name for name in infos if name not in self.members]
+        logger.info(f"Archive members: {list(self.members)}, ignored: {ignored}")
+        self._check_limits()
+
+    def _check_limits(self):
+        total = 0
+        for name, info in self.members.items():
+            limit = MAX_CONFIG_BYTES if name == CONFIG_MEMBER else MAX_MEMBER_BYTES
+            if info.file_size > limit:
+                raise IngestError(f"{name} is {info.file_size} bytes uncompressed, the limit is {limit}")
+            if info.file_size > MAX_COMPRESSION_RATIO * max(info.compress_size, 1):
+                raise IngestError(f"{name} expands {info.file_size / max(info.compress_size, 1):.0f}x, the limit is {MAX_COMPRESSION_RATIO}x")
+            total += info.file_size
+        if total > MAX_UPLOAD_BYTES:
+            raise IngestError(f"The archive holds {total} bytes of data, the limit is {MAX_UPLOAD_BYTES}")
+
+    def has(self, name):
+        return name in self.members
+
+    def read_config(self):
+        if not self.has(CONFIG_MEMBER):
+            return None
+        with self.archive.open(self.members[CONFIG_MEMBER]) as f:
+            return json.load(f)
+
+    def read_csv(self, file_name):
+        info = self.members[file_name]
+        chunksize = CSV_CHUNK_ROWS if info.file_size > CHUNKED_READ_BYTES else None
+        with self.archive.open(info) as f:
+            return read_csv_with_schema(f, file_name, chunksize=chunksize)
+
+    def close(self):
+        self.archive.close()
+        logger.info(f"Read {self.reader.bytes_fetched} of {self.reader.size} bytes of the upload")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,7 +5,11 @@ import botocore
 import time
 import logging
 import traceback
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+from guardrails import get_guardrail
+from bedrock_retry import AdaptiveBackoff, invoke_with_backoff
+from llm_cache import invoke_model_cached
+from prompt_caching import cached_prefix_content, report_cache_usage
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,91 +17,88 @@ logger.setLevel(logging.INFO)
 config = botocore.config.Config(
     read_timeout=900,
     connect_timeout=900,
-    retries={"max_attempts": 1}
+    retries={"max_attempts": 1},
+    max_pool_connections=50
 )
 
 client = boto3.client("bedrock-runtime", region_name="us-west-2", config=config)
 
 # Set the model ID, e.g., Claude 3 Haiku.
 model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-# Format the request payload using the model's native structure.
-
-def paraphrase(insight, Insights_paraphrasing_prompt, Insights_paraphrasing_model_id, blocked_words, first_insight):
-    if first_insight and blocked_words:
-        guardrail = None
-        try:
-            sensitive_words = {
-                'text': [
-                ]
-            }
 
-            for b_w in blocked_words:
-                sensitive_words['text'].append({"text": b_w})
-            client_guardrail = boto3.client('bedrock', region_name='us-west-2')
-            client_token = str(uuid.uuid4())
-
-            guardrails = client_guardrail.list_guardrails()["guardrails"]
-            if "guardrail" not in [guad["name"] for guad in guardrails]:
-                guardrail = client_guardrail.create_guardrail(
-                name='guardrail',
-                description='Guardrail for xyz insights generated from opus model',
-                wordPolicyConfig={
-                    'wordsConfig': sensitive_words['text'],
-                    'managedWordListsConfig': [
-                        {
-                            'type': 'PROFANITY'
-                        },
-                    ]
-                },
-                blockedInputMessaging='HARSH WORDS DETECTED',
-                blockedOutputsMessaging='HARSH WORDS DETECTED',
-                clientRequestToken=str(client_token),
-                )
-                print("Guardrail created successfully in paraphrase")
-            else:
-                guad = [guad for guad in guardrails if guad["name"] == "guardrail"][0]
-                guardrail = client_guardrail.update_guardrail(
-                    guardrailIdentifier=guad["id"],
-                    name='guardrail',
-                    description='Guardrail for xyz insights generated from opus model',
-                    wordPolicyConfig={
-                        'wordsConfig': sensitive_words['text'],
-                        'managedWordListsConfig': [
-                            {
-                                'type': 'PROFANITY'
-                            },
-                        ]
-                    },
-                    blockedInputMessaging='HARSH WORDS DETECTED',
-                    blockedOutputsMessaging='HARSH WORDS DETECTED',
-  
-                    )
-                print("Guardrail updated successfully in para")
-          
-                
-            print("Guardrail created successfully in para")
-        except Exception as e:
-            logger.info(f"Error in creating guardrail in generate: {e}")
-    else:
-        client_guardrail = boto3.client('bedrock', region_name='us-west-2')
-        guardrails = client_guardrail.list_guardrails()["guardrails"]
-        guardrail = None
-        for guad in guardrails:
-            if guad["name"] == "guardrail":
-                guardrail = guad
-                break
-        
+PARAPHRASING_SLOTS = ("insight",)
+DEFAULT_PARAPHRASE_CONCURRENCY = 5
+# a paraphrased insight is about as long as the original one
+PARAPHRASE_MAX_TOKENS = 1024
+AVOID_WORDS_INSTRUCTION = """
+
+<WORDS TO AVOID>
+*STRICTLY* the paraphrased insight must not contain any of these words or phrases: {words}. use other wording with the same meaning.
+</WORDS TO AVOID>"""
+
+class ParaphrasePool:
+    '''
+    Paraphrases insights as they are submitted, with at most max_workers Bedrock calls in flight.
+    The guardrail is set up once for everything paraphrased through the pool.
+    '''
+
+    def __init__(self, Insights_paraphrasing_prompt, Insights_paraphrasing_model_id, blocked_words, max_workers=DEFAULT_PARAPHRASE_CONCURRENCY, use_cache=True):
+        self.prompt = Insights_paraphrasing_prompt
+        self.model_id = Insights_paraphrasing_model_id
+        self.guardrail = get_guardrail(blocked_words) if blocked_words else None
+        self.backoff = AdaptiveBackoff()
+        self.use_cache = use_cache
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+        self.futures = []
+
+    def submit(self, insight):
+        future = self.executor.submit(paraphrase, insight, self.prompt, self.model_id, self.guardrail, self.backoff, use_cache=self.use_cache)
+        self.futures.append(future)
+        return future
+
+    def results(self):
+        '''
+        The paraphrased insights in submission order, once all of them are done.
+        '''
+        return [future.result() for future in self.futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def paraphrase_all(insights, Insights_paraphrasing_prompt, Insights_paraphrasing_model_id, blocked_words, max_workers=DEFAULT_PARAPHRASE_CONCURRENCY, use_cache=True):
+    '''
+    Paraphrases the insights concurrently with at most max_workers Bedrock calls in flight.
+    Returns the paraphrased insights in input order.
+    '''
+    with ParaphrasePool(Insights_paraphrasing_prompt, Insights_paraphrasing_model_id, blocked_words, min(int(max_workers), len(insights) or 1), use_cache) as pool:
+        for insight in insights:
+            pool.submit(insight)
+        return pool.results()
+
+
+def paraphrase(insight, Insights_paraphrasing_prompt, Insights_paraphrasing_model_id, guardrail=None, backoff=None, avoid_words=None, use_cache=True):
     logger.info("In the paraphrase function")
-    paraphrasing_prompt = f'''{Insights_paraphrasing_prompt.replace(r"{insight}", insight)}'''
+    # the instructions are the same for every insight and go first as a cacheable prefix
+    instructions, insight_part = Insights_paraphrasing_prompt.split("insight")
+    insight_prompt = insight_part.render(insight=insight)
+    if avoid_words:
+        # targeted rewrite of an insight the local blocked-word check flagged
+        insight_prompt += AVOID_WORDS_INSTRUCTION.format(words=", ".join(f'"{word}"' for word in avoid_words))
     native_request = {
         "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 200000,
+        "max_tokens": PARAPHRASE_MAX_TOKENS,
         "temperature": 0.5,
         "messages": [
             {
                 "role": "user",
-                "content": [{"type": "text", "text": paraphrasing_prompt}],
+                "content": cached_prefix_content(instructions.render(), insight_prompt, Insights_paraphrasing_model_id),
             }
         ],
     }
@@ -105,23 +106,16 @@ def paraphrase(insight, Insights_paraphrasing_prompt, Insights_paraphrasing_mode
     # Convert the native request to JSON.
     request = json.dumps(native_request)
 
+    invoke = lambda **kwargs: invoke_with_backoff(client, backoff or AdaptiveBackoff(), **kwargs)
     try:
-        if blocked_words and guardrail and first_insight:
-            print("Guardrail exists: in paraphrase", guardrail)
-            print("blocked words: in praphrase ", blocked_words)
-            response = client.invoke_model(modelId=Insights_paraphrasing_model_id, body=request, guardrailIdentifier=guardrail["guardrailId"], guardrailVersion=guardrail["version"])
-        elif not first_insight and blocked_words and guardrail:
-            print("Not the first insght and guardrail exists: in paraphrase", guardrail)
-            response = client.invoke_model(modelId=Insights_paraphrasing_model_id, body=request, guardrailIdentifier=guardrail["id"], guardrailVersion=guardrail["version"])
+        if guardrail:
+            model_response = invoke_model_cached(invoke, use_cache, modelId=Insights_paraphrasing_model_id, body=request, guardrailIdentifier=guardrail["guardrailId"], guardrailVersion=guardrail["version"])
         else:
-            print("Not using the guardrail")
-            response = client.invoke_model(modelId=Insights_paraphrasing_model_id, body=request)
+            model_response = invoke_model_cached(invoke, use_cache, modelId=Insights_paraphrasing_model_id, body=request)
     except (ClientError, Exception) as e:
-        logger.error(f"An error occurred: {str(e)}")
-
-
-    # Decode the response body.
-    model_response = json.loads(response["body"].read())
+        logger.error(f"An error occurred while paraphrasing, keeping the original insight: {str(e)}")
+        return insight
+    report_cache_usage(Insights_paraphrasing_model_id, model_response)
     # Extract and print the response text.
     response_text = model_response["content"][0]["text"]
     return response_text
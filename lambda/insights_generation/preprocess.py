@@ -0,0 +1,133 @@
+import pandas as pd
+import numpy as np
+from dateutil import parser
+import traceback
+import warnings
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# formats tried with pandas' vectorized parser before falling back to dateutil.
+# both agree with dateutil's default (month first) reading of a date string,
+# anything they can't parse exactly is handed to dateutil.
+VECTORIZED_DATE_FORMATS = ["ISO8601", "%m/%d/%Y"]
+
+
+def date_format(date_string):
+    dt_object = parser.parse(date_string)
+    new_date_string = dt_object.strftime("%-m/%-d/%Y")
+    return new_date_string
+
+
+def _format_dates(parsed):
+    # same output as strftime("%-m/%-d/%Y") without going through strftime per value
+    return (parsed.month.astype(str) + "/" + parsed.day.astype(str) + "/" + parsed.year.astype(str)).to_numpy(dtype=object)
+
+
+def normalize_dates(column):
+    '''
+    Converts a column of date strings to the "%-m/%-d/%Y" format.
+    Each unique string is parsed once, vectorized where possible and with dateutil otherwise.
+    '''
+    codes, uniques = pd.factorize(column)
+    uniques = pd.Index(np.asarray(uniques, dtype=object))
+    formatted = np.full(len(uniques), None, dtype=object)
+    pending = np.ones(len(uniques), dtype=bool)
+
+    for fmt in VECTORIZED_DATE_FORMATS:
+        if not pending.any():
+            break
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                parsed = pd.DatetimeIndex(pd.to_datetime(uniques[pending], format=fmt, errors="coerce"))
+        except (ValueError, TypeError):
+            # e.g. mixed timezone offsets, leave these to dateutil
+            continue
+        ok = ~parsed.isna()
+        idx = np.flatnonzero(pending)[ok]
+        formatted[idx] = _format_dates(parsed[ok])
+        pending[idx] = False
+
+    for i in np.flatnonzero(pending):
+        formatted[i] = date_format(uniques[i])
+
+    out = formatted[codes]
+    out[codes == -1] = np.nan
+    return pd.Series(out, index=column.index, name=column.name)
+
+
+def _clean_column(column):
+    # strip every unique value once and turn empty strings into NaN
+    codes, uniques = pd.factorize(column)
+    cleaned = np.array([v.strip() if isinstance(v, str) else np.nan for v in np.asarray(uniques, dtype=object)], dtype=object)
+    cleaned[cleaned == ""] = np.nan
+    out = cleaned[codes]
+    out[codes == -1] = np.nan
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return pd.Series(pd.Categorical(out), index=column.index, name=column.name)
+    return pd.Series(out, index=column.index, name=column.name)
+
+
+def clean_frame(df):
+    '''
+    Shared cleanup for the hourly, child and group frames: strip column names and text cells,
+    drop rows with missing or empty values and normalize the "Day Date" column.
+    '''
+    df = df.rename(columns=lambda col: col.strip())
+    text_columns = [col for col in df.columns if df[col].dtype == "object" or isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if text_columns:
+        df = df.assign(**{col: _clean_column(df[col]) for col in text_columns})
+
+    # drop the rows with nan values (empty strings were turned into nan above)
+    df = df[df.notna().all(axis=1).to_numpy()]
+
+    try:
+        # check for date values and convert them to consistent format
+        if "Day Date" in df.columns:
+            df = df.assign(**{"Day Date": normalize_dates(df["Day Date"])})
+    except Exception as e:
+        logger.error(f"An error occurred while converting date values: {str(e)}. The model might not provide the correct insights.")
+        logger.debug(traceback.format_exc())
+    return df
+
+
+def preprocess_data(hourly, child, group):
+
+    logger.info("In the preprocess function")
+
+    hourly = clean_frame(hourly)
+    child = clean_frame(child)
+    group = clean_frame(group)
+
+    prefix = ""
+    if len(group["Group ID"].unique()) != 1:
+        prefix = "_".join([str(i) for i in group["Group ID"].unique()])
+    else:
+        prefix = str(list(group["Group ID"].unique())[0])
+
+    return hourly, child, group, prefix
+
+
+def group_ids(group):
+    '''
+    The Group IDs of the raw group file as preprocess_data and split_by_group see them, without reading the other files.
+    '''
+    group = clean_frame(group)
+    return [str(i) for i in group["Group ID"].unique()] if "Group ID" in group.columns else []
+
+
+def split_by_group(hourly, child, group):
+    '''
+    Splits the preprocessed frames by the Group IDs of the group file, in the order they appear there.
+    Returns a list of (group id, hourly, child, group) with the rows of that group only.
+    '''
+    parts = []
+    for df in (hourly, child, group):
+        by_group = {str(key): rows for key, rows in df.groupby("Group ID", observed=True, sort=False)} if "Group ID" in df.columns else {}
+        parts.append(by_group)
+    units = []
+    for group_id in [str(i) for i in group["Group ID"].unique()]:
+        units.append((group_id, *[by_group.get(group_id, df.iloc[0:0]).reset_index(drop=True) for by_group, df in zip(parts, (hourly, child, group))]))
+    return units
@@ -0,0 +1,149 @@
+import math
+import logging
+
+import numpy as np
+import pandas as pd
+
+from analysis import build_prompt_data
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# rough characters per token for csv heavy prompts (numbers and separators tokenize densely)
+CHARS_PER_TOKEN = 3
+
+# prompt token budget used when config.json doesn't set prompt_token_budget.
+# leaves room for the output inside the 200k context window of the claude 3 models.
+DEFAULT_PROMPT_TOKEN_BUDGET = 150_000
+
+# output tokens per requested insight plus a fixed allowance, capped at the model output limit
+OUTPUT_TOKENS_PER_INSIGHT = 250
+OUTPUT_TOKENS_BASE = 512
+OUTPUT_TOKENS_LIMIT = 4096
+
+MAX_CHUNKS = 8
+
+# row identifiers that only make sense inside the source system
+SURROGATE_ID_COLUMNS = ["GrowChildxyzDay ID", "GrowGroupxyzDay ID"]
+COMPACTION_LEVELS = 4
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def output_max_tokens(no_of_insights):
+    return min(OUTPUT_TOKENS_LIMIT, OUTPUT_TOKENS_BASE + OUTPUT_TOKENS_PER_INSIGHT * int(no_of_insights))
+
+
+def _drop_unused_columns(df, notes):
+    df = df.drop(columns=[col for col in SURROGATE_ID_COLUMNS if col in df.columns])
+    constant = [col for col in df.columns if col not in ("Child ID", "Day Date") and len(df) > 1 and df[col].nunique(dropna=False) == 1]
+    for col in constant:
+        notes.setdefault(col, df[col].iloc[0])
+    return df.drop(columns=constant)
+
+
+def _collapse_hourly(hourly):
+    # one row per child and day instead of one per hour, keeping the hour with the most turns
+    hour = pd.to_datetime(hourly["Begin Time Local"].astype(str), errors="coerce").dt.hour
+    frame = hourly.assign(hour=hour)
+    keys = [col for col in ("Group ID", "Child ID", "Day Date") if col in frame.columns]
+    aggregations = {"hours": ("CT Sum", "size")}
+    for col in ("Duration Sum", "CT Sum", "AWC Sum"):
+        if col in frame.columns:
+            aggregations[col] = (col, "sum")
+    for col in ("CT Avg", "AWC Avg"):
+        if col in frame.columns:
+            aggregations[col] = (col, "mean")
+    daily = frame.groupby(keys, observed=True, sort=False).agg(**aggregations)
+    peak = frame.loc[frame.groupby(keys, observed=True, sort=False)["CT Sum"].idxmax(), keys + ["hour"]]
+    daily = daily.join(peak.set_index(keys)["hour"].rename("Peak CT Hour"))
+    return daily.reset_index()
+
+
+def _shorten_ids(frames, legend):
+    ids = pd.unique(np.concatenate([np.asarray(df["Child ID"], dtype=object) for df in frames if "Child ID" in df.columns]))
+    codes = {value: f"C{i + 1}" for i, value in enumerate(ids)}
+    legend.update({short: value for value, short in codes.items()})
+    return [df.assign(**{"Child ID": df["Child ID"].astype(object).map(codes)}) if "Child ID" in df.columns else df for df in frames]
+
+
+def compact_csvs(hourly, child, group, level):
+    '''
+    Renders the frames as csv strings, with more compaction for higher levels:
+    1 drops surrogate ids and constant columns, 2 rounds floats, 3 replaces Child IDs with short codes
+    and a legend, 4 collapses the hourly rows into per-day rows.
+    '''
+    notes, legend = {}, {}
+    frames = [hourly, child, group]
+    if level >= 4:
+        frames[0] = _collapse_hourly(frames[0])
+    if level >= 1:
+        frames = [_drop_unused_columns(df, notes) for df in frames]
+    if level >= 3:
+        frames = _shorten_ids(frames, legend)
+    float_format = "%.1f" if level >= 2 else None
+    hourly_csv, child_csv, group_csv = [df.to_csv(index=False, float_format=float_format) for df in frames]
+
+    header = []
+    if notes:
+        header.append("Columns left out because they have the same value in every row: " + "; ".join(f"{k}={v}" for k, v in notes.items()))
+    if legend:
+        header.append("Child IDs are shortened in all files, always use the original Child ID in insights. Legend (short=original): " + "; ".join(f"{k}={v}" for k, v in legend.items()))
+    if level >= 4:
+        header.append("Hourly rows are collapsed into one row per child and day (sums and averages over the hours, Peak CT Hour = hour with the most turns).")
+    if header:
+        hourly_csv = "\n".join(header) + "\n\n" + hourly_csv
+    return {"hourly_csv": hourly_csv, "child_csv": child_csv, "group_csv": group_csv}
+
+
+def prompt_data_tokens(prompt_data):
+    return sum(estimate_tokens(str(value)) for value in prompt_data.values())
+
+
+def _split_by_day(hourly, child, group, n_chunks):
+    days = pd.Index(pd.unique(np.concatenate([np.asarray(df["Day Date"], dtype=object) for df in (hourly, child, group)])))
+    order = np.argsort(pd.to_datetime(days, format="%m/%d/%Y", errors="coerce"))
+    chunks = []
+    for chunk_days in np.array_split(days[order], n_chunks):
+        if len(chunk_days) == 0:
+            continue
+        chunks.append(tuple(df[df["Day Date"].isin(chunk_days)] for df in (hourly, child, group)))
+    return chunks
+
+
+def fit_prompt_data(hourly, child, group, mode, budget_tokens):
+    '''
+    Returns a list of prompt data dicts (see analysis.build_prompt_data) that each fit in budget_tokens.
+    The data is compacted step by step and only split into chunks of consecutive days when even
+    the most compact form is over budget.
+    '''
+    for level in range(COMPACTION_LEVELS + 1):
+        prompt_data = build_prompt_data(hourly, child, group, compact_csvs(hourly, child, group, level), mode)
+        tokens = prompt_data_tokens(prompt_data)
+        logger.info(f"Prompt data at compaction level {level}: ~{tokens} tokens (budget {budget_tokens})")
+        if tokens <= budget_tokens:
+            return [prompt_data]
+
+    n_chunks = min(MAX_CHUNKS, max(2, math.ceil(tokens / budget_tokens)))
+    while True:
+        chunks = [build_prompt_data(h, c, g, compact_csvs(h, c, g, COMPACTION_LEVELS), mode) for h, c, g in _split_by_day(hourly, child, group, n_chunks)]
+        largest = max(prompt_data_tokens(chunk) for chunk in chunks)
+        if largest <= budget_tokens or n_chunks >= MAX_CHUNKS:
+            if largest > budget_tokens:
+                logger.warning(f"Prompt data is still ~{largest} tokens per chunk with {n_chunks} chunks, the model may reject it")
+            logger.info(f"Prompt data split into {len(chunks)} chunks of consecutive days")
+            return chunks
+        n_chunks = min(MAX_CHUNKS, n_chunks * 2)
+
+
+def merge_chunk_insights(chunk_insights, no_of_insights):
+    # take insights from the chunks in turn so every part of the date range is represented
+    merged, seen = [], set()
+    for rank in range(max((len(ins) for ins in chunk_insights), default=0)):
+        for insights in chunk_insights:
+            if rank < len(insights) and insights[rank] not in seen:
+                seen.add(insights[rank])
+                merged.append(insights[rank])
+    return merged[:int(no_of_insights)]
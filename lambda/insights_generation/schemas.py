@@ -0,0 +1,199 @@
+import importlib.util
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# pyarrow's multithreaded csv reader is much faster on big files, use it when it is installed
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+
+# column kinds and the dtype they are read with.
+# ids, text and dates are read as categoricals, numbers are validated after parsing and int and flag columns downcast.
+# float columns stay float64, a narrower float (or an int for whole values) would change the numbers written into the prompts.
+READ_DTYPES = {
+    "id": "category",
+    "text": "category",
+    "date": "category",
+    "datetime": "category",
+    "int": None,
+    "flag": None,
+    "float": None,
+}
+
+# columns of the three uploaded files, following the data dictionaries in the prompts.
+# "required" columns must be present, the other listed columns are read when present
+# and any column not listed here is dropped at read time.
+SCHEMAS = {
+    "file_1.csv": {
+        "name": "xyz Day Child Hourly",
+        "columns": {
+            "Group ID": "id",
+            "Child ID": "id",
+            "Day Date": "date",
+            "Begin Time Local": "datetime",
+            "Duration Sum": "int",
+            "CT Avg": "float",
+            "CT Sum": "int",
+            "AWC Avg": "float",
+            "AWC Sum": "int",
+        },
+        "required": ["Group ID", "Child ID", "Day Date", "Begin Time Local", "CT Sum", "AWC Sum"],
+        "optional_patterns": [],
+    },
+    "file_2.csv": {
+        "name": "xyz Day Child",
+        "columns": {
+            "GrowChildxyzDay ID": "id",
+            "Group ID": "id",
+            "Child ID": "id",
+            "Age In Months": "int",
+            "Child Name": "text",
+            "Child xyz Day Index": "int",
+            "Group xyz Day Index": "int",
+            "Day Date": "date",
+            "CT 5 First": "flag",
+            "CT 15 First": "flag",
+            "CT 25 First": "flag",
+            "CT 40 First": "flag",
+            "Star CT 5": "flag",
+            "Star CT 15": "flag",
+            "Star CT 25": "flag",
+            "Star CT 40": "flag",
+            "CT Avg": "float",
+            "CT Sum": "int",
+            "Duration": "int",
+        },
+        "required": ["Group ID", "Child ID", "Day Date", "CT Sum"],
+        # child xyz Day hints from the prompt definitions (Hint 6, 9 and 11)
+        "optional_patterns": [r"^\[?Hint \d+"],
+    },
+    "file_3.csv": {
+        "name": "xyz Day Group",
+        "columns": {
+            "Group ID": "id",
+            "Group Name": "text",
+            "GrowGroupxyzDay ID": "id",
+            "Day Date": "date",
+            "xyz Day Index": "int",
+            "Star CT": "flag",
+            "CT Avg": "float",
+            "AWC Avg": "float",
+            "Star CT 5": "flag",
+            "Star CT 15": "flag",
+            "Star CT 25": "flag",
+            "Star CT 40": "flag",
+            "Star Total xyz Day": "int",
+            "Star Cumulative": "int",
+        },
+        "required": ["Group ID", "Day Date", "CT Avg"],
+        # group xyz Day hints and norms from the prompt definitions
+        "optional_patterns": [r"^\[?Hint \d+", r"^\[?(CT_M_norm_HR|SCH_CT_LOW_HR|SCH_CT_HIGH_HR|AWC_M_norm_HR|SCH_AWC_LOW_HR|SCH_AWC_HIGH_HR)\]?$"],
+    },
+}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _select_columns(header, file_name):
+    '''
+    Maps the raw header names (which may carry extra spaces) to the schema and checks the required columns.
+    Returns {raw column name: kind}.
+    '''
+    schema = SCHEMAS[file_name]
+    selected = {}
+    for raw in header:
+        name = str(raw).strip()
+        if name in schema["columns"]:
+            selected[raw] = schema["columns"][name]
+        elif any(re.match(p, name) for p in schema["optional_patterns"]):
+            selected[raw] = "text"
+    present = {str(raw).strip() for raw in selected}
+    missing = [col for col in schema["required"] if col not in present]
+    if missing:
+        raise SchemaError(f"{file_name} ({schema['name']}) is missing required column(s): {', '.join(missing)}")
+    return selected
+
+
+def _downcast_int(values):
+    if not values.isna().any():
+        return pd.to_numeric(values, downcast="integer")
+    # keep missing values, preprocessing drops those rows
+    low, high = values.min(), values.max()
+    for dtype in ("Int8", "Int16", "Int32"):
+        info = np.iinfo(dtype.lower())
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values.astype("Int64")
+
+
+def _coerce_numbers(column, kind, file_name, row_offset=0):
+    raw = column
+    if raw.dtype == "object":
+        raw = raw.str.strip().replace("", np.nan)
+    values = pd.to_numeric(raw, errors="coerce")
+    bad = values.isna() & raw.notna()
+    if bad.any():
+        row = bad.to_numpy().nonzero()[0][0]
+        raise SchemaError(f"{file_name}: column '{column.name}' expects {kind} values, got {raw[bad].iloc[0]!r} on data row {row_offset + row + 1}")
+    if kind == "float":
+        return values.astype("float64")
+    fractional = values.notna() & (values != np.floor(values))
+    if fractional.any():
+        raise SchemaError(f"{file_name}: column '{column.name}' expects {kind} values, got {values[fractional].iloc[0]!r}")
+    return _downcast_int(values)
+
+
+def _coerce_frame(df, selected, file_name, row_offset=0):
+    numeric = {raw: _coerce_numbers(df[raw], kind, file_name, row_offset) for raw, kind in selected.items() if READ_DTYPES[kind] is None}
+    return df.assign(**numeric) if numeric else df
+
+
+def _concat_chunks(chunks, selected):
+    '''
+    Joins chunks read separately. Categoricals are unioned so they don't fall back to object columns,
+    numbers take the widest dtype of any chunk.
+    '''
+    columns = {}
+    for raw, kind in selected.items():
+        parts = [chunk[raw] for chunk in chunks]
+        if READ_DTYPES[kind] == "category":
+            columns[raw] = pd.Series(union_categoricals(parts), name=raw)
+        else:
+            columns[raw] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def read_csv_with_schema(source, file_name, chunksize=None):
+    '''
+    Reads one of the uploaded csv files with the columns and compact dtypes from SCHEMAS.
+    source is a path or a seekable file object. With chunksize the file is parsed that many rows
+    at a time and each chunk is shrunk before the next one is read, which keeps the peak memory
+    of big files close to the size of the result.
+    Raises SchemaError when the file does not match the schema.
+    '''
+    if file_name not in SCHEMAS:
+        raise SchemaError(f"No schema registered for {file_name}")
+    header = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, "seek"):
+        source.seek(0)
+    selected = _select_columns(header, file_name)
+
+    dtypes = {raw: READ_DTYPES[kind] for raw, kind in selected.items() if READ_DTYPES[kind]}
+    if chunksize:
+        # the pyarrow engine can't read in chunks
+        chunks, rows = [], 0
+        for chunk in pd.read_csv(source, usecols=list(selected), dtype=dtypes, engine="c", chunksize=chunksize):
+            chunks.append(_coerce_frame(chunk, selected, file_name, rows))
+            rows += len(chunk)
+        df = _concat_chunks(chunks, selected)
+    else:
+        df = _coerce_frame(pd.read_csv(source, usecols=list(selected), dtype=dtypes, engine=CSV_ENGINE), selected, file_name)
+    logger.info(f"Read {file_name}: {len(df)} rows, {len(df.columns)} columns, {df.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+    return df
@@ -0,0 +1,388 @@
+import datetime
+import json
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore
+
+from preprocess import preprocess_data, split_by_group, group_ids
+from schemas import SchemaError
+from ingest import Upload, IngestError, CSV_MEMBERS
+from generate_insights import generate_insights, GENERATION_SLOTS
+from paraphrase_insights import paraphrase, paraphrase_all, ParaphrasePool, DEFAULT_PARAPHRASE_CONCURRENCY, PARAPHRASING_SLOTS
+from blocked_words import filter_blocked_words, screen_insights, LOCAL_BLOCKLIST_MAX_WORDS
+from handoff import Table, write_tables
+from fingerprints import fingerprint, compare, delta_insight_count
+from result_store import new_run_id, run_key, run_exists, write_run, split_groups, latest_result
+from pipeline import S3CheckpointStore, Deferred, child_job, child_job_id, handle_sqs_event, first_error, sqs_queue_from_env
+from idempotency import S3MarkerStore, LeaseLost, LEASES_CHECKPOINT, group_lease, lease_holder, processed_marker, renew_job_leases, with_renewed_leases
+from prompt_template import PromptTemplate
+
+s3 = boto3.client('s3')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# parsed once per container, every run only fills in the slots
+Insights_generation_prompt = PromptTemplate.from_file("insights_generation_prompt.txt", GENERATION_SLOTS)
+Insights_paraphrasing_prompt = PromptTemplate.from_file("insights_paraphrasing_prompt.txt", PARAPHRASING_SLOTS)
+
+REQUIRED_CONFIG_KEYS = ['Insights_generation_model_id', 'Insights_paraphrasing_model_id', 'insights_verification_model_id', 'number_of_insights']
+DEFAULT_CONFIG = {
+    "Insights_generation_model_id": "anthropic.claude-3-opus-20240229-v1:0",
+    "Insights_paraphrasing_model_id": "anthropic.claude-3-haiku-20240307-v1:0",
+    "insights_verification_model_id": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+    "number_of_insights": 5,
+    "paraphrase_or_not": True,
+    "prompt_data_mode": "auto",
+    "prompt_token_budget": None,
+    "paraphrase_concurrency": DEFAULT_PARAPHRASE_CONCURRENCY,
+    "verification_rate_limits": None,
+    "verification_concurrency": None,
+    "verification_mode": "agent",
+    "verification_cascade": None,
+    # prompt cache checkpoints for the data section of the verification prompt. They only apply in
+    # "direct" verification mode and the cascade tiers, with models that support them (see prompt_caching),
+    # so the default agent mode with Claude 3.5 Sonnet doesn't use them
+    "verification_prompt_caching": True,
+    "local_blocklist_max_words": LOCAL_BLOCKLIST_MAX_WORDS,
+    "blocked_words": None,
+    "fan_out_groups": True,
+    "use_llm_cache": True,
+}
+NO_INSIGHTS_MESSAGE = "SORRY! NO INSIGHTS GENERATED. TRY AGAIN"
+# how long a job waits before it tries again to get the lease of a group another job is working on
+LEASE_WAIT_SECONDS = 60
+
+# tests and local runs can set this to a MemoryMarkerStore
+marker_store = None
+
+# when set, generate has every insight verified by the verification lambda as soon as it is final,
+# otherwise (e.g. local runs) the verify stage verifies them all
+VERIFICATION_FUNCTION = os.environ.get("VERIFICATION_FUNCTION_NAME")
+# single insight verifications in flight when the config doesn't set verification_concurrency
+DEFAULT_EARLY_VERIFICATIONS = 5
+_lambda_client = None
+
+
+def resolve_config(user_config):
+    '''
+    The run configuration: the uploaded config.json when it has the required keys, the defaults otherwise.
+    '''
+    if not (user_config and all(key in user_config for key in REQUIRED_CONFIG_KEYS)):
+        return dict(DEFAULT_CONFIG)
+    config = dict(DEFAULT_CONFIG)
+    config.update({key: user_config[key] for key in DEFAULT_CONFIG if key in user_config})
+    if config["blocked_words"]:
+        config["blocked_words"] = filter_blocked_words(config["blocked_words"])
+        print("blocked words in the main: ", config["blocked_words"])
+    return config
+
+
+def _tables(tables):
+    return [Table(s3, tables["bucket"], tables[name]).frame() for name in ("hourly", "child", "group")]
+
+
+def _guardrail_words(config):
+    # small word lists are only checked locally, larger ones also go through a Bedrock guardrail
+    blocked_words = config["blocked_words"]
+    return blocked_words if blocked_words and len(blocked_words) > config["local_blocklist_max_words"] else None
+
+
+def _markers():
+    return marker_store or S3MarkerStore(s3, os.environ['S3_BUCKET_NAME'])
+
+
+def acquire_group_leases(job, store, group_ids):
+    '''
+    Takes the leases of all the groups for the job or none of them. While another job holds one,
+    the stage is deferred: that job's result is published first and this one can then reuse it.
+    The groups are kept in the job's leases checkpoint, so they are renewed with each stage and publish releases
+    them even if the job fails.
+    '''
+    markers = _markers()
+    acquired = []
+    for group_id in sorted(group_ids):
+        if not markers.acquire_lease(group_lease(group_id), lease_holder(job)):
+            for name in acquired:
+                markers.release_lease(name, lease_holder(job))
+            raise Deferred(f"group {group_id} is being processed by another job", LEASE_WAIT_SECONDS)
+        acquired.append(group_lease(group_id))
+    store.save(job["job_id"], LEASES_CHECKPOINT, {"groups": sorted(group_ids)})
+
+
+def release_job(job, store, group_ids, failed):
+    '''
+    Releases the job's group leases and, when it failed, the processed marker of its upload,
+    so the same file can be uploaded again to retry it. The marker of an upload that was split into
+    group jobs is only released once every one of them has failed.
+    '''
+    markers = _markers()
+    leased = (store.load(job["job_id"], LEASES_CHECKPOINT) or {}).get("groups", [])
+    for group_id in sorted(set(leased) | set(group_ids)):
+        markers.release_lease(group_lease(group_id), lease_holder(job))
+    if not job.get("content_hash"):
+        return
+    if job.get("parent_id"):
+        # the job that finishes last sees the outcomes of all its siblings
+        store.save(job["job_id"], "outcome", {"failed": failed})
+        siblings = [child_job_id(job["parent_id"], group_id) for group_id in store.load(job["parent_id"], "preprocess")["groups"]]
+        failed = all((store.load(sibling, "outcome") or {}).get("failed") for sibling in siblings)
+    if failed:
+        markers.release(processed_marker(job["content_hash"]))
+
+
+def _verify_early(job, insight):
+    '''
+    Verifies one final insight with the verification lambda. None when that fails, the verify stage does it then.
+    '''
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client('lambda', config=botocore.config.Config(read_timeout=900, retries={"max_attempts": 1}))
+    try:
+        response = _lambda_client.invoke(FunctionName=VERIFICATION_FUNCTION, Payload=json.dumps({"job_id": job["job_id"], "insight": insight}).encode("utf-8"))
+        payload = json.loads(response["Payload"].read().decode("utf-8"))
+    except Exception as e:
+        logger.error(f"Couldn't verify an insight while generating, the verify stage will: {e}")
+        return None
+    if response.get("FunctionError"):
+        logger.error(f"Couldn't verify an insight while generating, the verify stage will: {payload}")
+        return None
+    return payload
+
+
+def _rewrite(config):
+    return lambda ins, found: paraphrase(ins, Insights_paraphrasing_prompt, config["Insights_paraphrasing_model_id"], avoid_words=found, use_cache=config["use_llm_cache"])
+
+
+def ingest(job, store):
+    '''
+    Checks the upload and reads its configuration. Problems with the upload itself skip to publish without retries,
+    which only releases the job: retrying can't fix them.
+    '''
+    try:
+        with Upload(s3, job["bucket"], job["key"]) as upload:
+            if not all(upload.has(name) for name in CSV_MEMBERS):
+                logger.error("One or more expected files are missing in the ZIP archive")
+                return {"error": "One or more expected files are missing in the ZIP archive", "next": "publish"}
+            return {"config": resolve_config(upload.read_config())}
+    except IngestError as e:
+        logger.error(f"Uploaded file can't be read: {e}")
+        return {"error": str(e), "next": "publish"}
+
+
+def plan_group(bucket_name, group_id, hourly, child, group, config):
+    '''
+    The preprocess output of one group and the stage its job continues with. The data is fingerprinted per day
+    and compared with the fingerprints stored with the group's last result: unchanged data reuses that result,
+    new days only are generated from the new days, anything else is a full run.
+    '''
+    fingerprints = fingerprint(hourly, child, group, config)
+    previous = latest_result(s3, bucket_name, group_id)
+    previous_fingerprints = previous.get("fingerprints") if previous and "insights" in previous else None
+    plan, new_days = compare(previous_fingerprints, fingerprints)
+    output = {"prefix": group_id, "fingerprints": fingerprints}
+    if plan == "reuse":
+        logger.info(f"Data of group {group_id} is unchanged since {previous['Insight_generation_timestamp']}, reusing that result")
+        output["reuse"] = {key: previous[key] for key in ("insights", "verification_result", "verification_details", "Insight_generation_timestamp")}
+        return output, "publish"
+
+    output["tables"] = dict(write_tables(s3, bucket_name, {"hourly": hourly, "child": child, "group": group}), bucket=bucket_name)
+    if plan == "delta":
+        no_of_insights = delta_insight_count(config["number_of_insights"], new_days, fingerprints["days"])
+        logger.info(f"Group {group_id} has {len(new_days)} new days, generating {no_of_insights} insights for them")
+        delta = {name: df[df["Day Date"].isin(new_days)] if "Day Date" in df.columns else df for name, df in (("hourly", hourly), ("child", child), ("group", group))}
+        output["delta_tables"] = dict(write_tables(s3, bucket_name, delta), bucket=bucket_name)
+        # the previous insights that were verified correct fill the rest of the result if they still check out,
+        # only as many as there are slots left are checked again
+        carried_slots = config["number_of_insights"] - no_of_insights
+        carried = [
+            {"insight": insight, "verdict": verdict, "details": details}
+            for insight, verdict, details in zip(previous["insights"], previous["verification_result"], previous["verification_details"])
+            if verdict == "correct"
+        ][:carried_slots]
+        output["incremental"] = {"new_days": new_days, "no_of_insights": no_of_insights, "carried": carried, "carried_slots": carried_slots, "base": previous["Insight_generation_timestamp"]}
+    return output, "generate"
+
+
+def preprocess(job, store):
+    with Upload(s3, job["bucket"], job["key"]) as upload:
+        try:
+            # the small group file names the groups, their leases are taken before the large files are read,
+            # so a job that has to wait for another one only reads this much each time it tries
+            group = upload.read_csv('file_3.csv')
+            # the groups' last results are read below and replaced when the job publishes, one job per group at a time
+            acquire_group_leases(job, store, group_ids(group))
+            hourly = upload.read_csv('file_1.csv')
+            child = upload.read_csv('file_2.csv')
+        except SchemaError as e:
+            logger.error(f"Uploaded data does not match the expected schema: {e}")
+            return {"error": str(e), "next": "publish"}
+    hourly, child, group, prefix = preprocess_data(hourly, child, group)
+    # the later stages (and the verification lambda) read the data from these keys
+    bucket_name = os.environ['S3_BUCKET_NAME']
+    config = store.load(job["job_id"], "ingest")["config"]
+    units = split_by_group(hourly, child, group)
+    if len(units) == 1:
+        output, stage = plan_group(bucket_name, prefix, hourly, child, group, config)
+        return dict(output, next=stage)
+    if len(units) < 2 or not config["fan_out_groups"]:
+        # a run over several groups is stored with each of them, it's always a full run
+        tables = dict(write_tables(s3, bucket_name, {"hourly": hourly, "child": child, "group": group}), bucket=bucket_name)
+        return {"prefix": prefix, "tables": tables}
+
+    # every group becomes its own job with a small prompt and its own result, they run in parallel
+    children = []
+    for group_id, group_hourly, group_child, group_group in units:
+        output, stage = plan_group(bucket_name, group_id, group_hourly, group_child, group_group, config)
+        child_record = child_job(job, group_id, stage)
+        store.save(child_record["job_id"], "ingest", {"config": config})
+        store.save(child_record["job_id"], "preprocess", output)
+        # the parent took the leases, each group job renews and releases its own
+        store.save(child_record["job_id"], LEASES_CHECKPOINT, {"groups": [group_id]})
+        children.append(child_record)
+    logger.info(f"Split the upload into {len(children)} group jobs")
+    return {"prefix": prefix, "groups": [u[0] for u in units], "fan_out": children, "next": None}
+
+
+def generate(job, store):
+    '''
+    Generates the insights. The response is streamed and every insight is screened for blocked words,
+    paraphrased when paraphrasing is on, and verified when the verification lambda is set, as soon as it is
+    complete, while the rest are still being generated. This runs on worker threads, the model calls don't
+    hold up reading the stream. The later stages only do what couldn't be done here.
+    '''
+    config = store.load(job["job_id"], "ingest")["config"]
+    preprocessed = store.load(job["job_id"], "preprocess")
+    # an upload that only adds days to the group's last result is generated from the new days only
+    hourly, child, group = _tables(preprocessed.get("delta_tables") or preprocessed["tables"])
+    no_of_insights = preprocessed["incremental"]["no_of_insights"] if "incremental" in preprocessed else config["number_of_insights"]
+    # one future per insight in stream order, each giving the screened insight, its paraphrase and its verification
+    followed = []
+    workers = int(config["paraphrase_concurrency"])
+    if VERIFICATION_FUNCTION:
+        workers = max(workers, int(config["verification_concurrency"] or DEFAULT_EARLY_VERIFICATIONS))
+    downstream = ThreadPoolExecutor(max_workers=max(1, workers))
+    pool = None
+    if config["paraphrase_or_not"]:
+        pool = ParaphrasePool(Insights_paraphrasing_prompt, config["Insights_paraphrasing_model_id"], _guardrail_words(config), config["paraphrase_concurrency"], config["use_llm_cache"])
+
+    def follow(insight):
+        # the same steps as the paraphrase and verify stages, for this insight only
+        screened = screen_insights([insight], config["blocked_words"], _rewrite(config))[0]
+        final, paraphrased = screened, None
+        if pool:
+            paraphrased = pool.submit(screened).result()
+            final = screen_insights([paraphrased], config["blocked_words"], _rewrite(config))[0]
+        return screened, paraphrased, _verify_early(job, final) if VERIFICATION_FUNCTION else None
+
+    def on_insight(insight):
+        followed.append(downstream.submit(follow, insight))
+
+    try:
+        insights = generate_insights(hourly, child, group, no_of_insights, Insights_generation_prompt, config["Insights_generation_model_id"], _guardrail_words(config), config["paraphrase_or_not"], config["prompt_data_mode"], config["prompt_token_budget"], config["use_llm_cache"], on_insight)
+        # a failed model call raises and the stage is retried, this is an answer without insights
+        if type(insights) != list or len(insights) == 0:
+            return {"error": NO_INSIGHTS_MESSAGE, "next": "publish"}
+        logger.info("Waiting for the insights still being paraphrased or verified...")
+        results = [future.result() for future in followed]
+        output = {"insights": [screened for screened, _, _ in results]}
+        if pool:
+            output["paraphrased"] = [paraphrased for _, paraphrased, _ in results]
+        if VERIFICATION_FUNCTION:
+            output["verified"] = [verified for _, _, verified in results]
+        return output
+    finally:
+        downstream.shutdown(wait=True, cancel_futures=True)
+        if pool:
+            pool.close()
+
+
+def paraphrase_stage(job, store):
+    config = store.load(job["job_id"], "ingest")["config"]
+    generated = store.load(job["job_id"], "generate")
+    insights = generated["insights"]
+    if not config["paraphrase_or_not"]:
+        return {"insights": insights}
+    # paraphrased while they were generated, a checkpoint from before that still has to be done here
+    paraphrased_insights = generated.get("paraphrased")
+    if paraphrased_insights is None:
+        logger.info("Paraphrasing insights...")
+        paraphrased_insights = paraphrase_all(insights, Insights_paraphrasing_prompt, config["Insights_paraphrasing_model_id"], _guardrail_words(config), config["paraphrase_concurrency"], config["use_llm_cache"])
+    return {"insights": screen_insights(paraphrased_insights, config["blocked_words"], _rewrite(config))}
+
+
+def publish(job, store):
+    job_id = job["job_id"]
+    preprocessed = store.load(job_id, "preprocess")
+    error = first_error(store, job_id)
+    if not preprocessed or "prefix" not in preprocessed:
+        logger.error(f"Job {job_id} failed before its groups were known, nothing to publish: {error}")
+        release_job(job, store, [], failed=True)
+        return {"next": None}
+    try:
+        renew_job_leases(_markers(), job, store)
+    except LeaseLost as e:
+        # another job works on the groups now and publishes its own result for them
+        logger.error(f"Job {job_id} lost its group leases, nothing to publish: {e}")
+        release_job(job, store, [], failed=True)
+        return {"next": None}
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    if error:
+        result = {"error message": NO_INSIGHTS_MESSAGE, "Insight_generation_timestamp": timestamp}
+    elif "reuse" in preprocessed:
+        reused = preprocessed["reuse"]
+        result = {key: reused[key] for key in ("insights", "verification_result", "verification_details")}
+        result.update({"Insight_generation_timestamp": timestamp, "reused_from": reused["Insight_generation_timestamp"], "fingerprints": preprocessed["fingerprints"]})
+    else:
+        verification = store.load(job_id, "verify")
+        result = {"insights": store.load(job_id, "paraphrase")["insights"], "verification_result": verification["verdicts"], "verification_details": verification["details"], "Insight_generation_timestamp": timestamp}
+        if "incremental" in preprocessed:
+            # the new days' insights first, then the previous ones that still held up against all the data
+            carried = verification.get("carried", [])[:preprocessed["incremental"]["carried_slots"]]
+            result["insights"] = result["insights"] + [c["insight"] for c in carried]
+            result["verification_result"] = result["verification_result"] + [c["verdict"] for c in carried]
+            result["verification_details"] = result["verification_details"] + [c["details"] for c in carried]
+            result["incremental"] = {"new_days": preprocessed["incremental"]["new_days"], "base": preprocessed["incremental"]["base"]}
+        if "fingerprints" in preprocessed:
+            result["fingerprints"] = preprocessed["fingerprints"]
+
+    # every attempt writes under a new run id: an id from an attempt that died before writing could sort
+    # before runs that were compacted meanwhile. the ids of earlier attempts are kept so a retried publish
+    # doesn't store a second result for a group that one of them already wrote
+    previous_run_ids = (store.load(job_id, "publish_run") or {}).get("run_ids", [])
+    run_id = new_run_id()
+    store.save(job_id, "publish_run", {"run_ids": previous_run_ids + [run_id]})
+    bucket_name = os.environ['S3_BUCKET_NAME']
+    keys = []
+    for group_id in split_groups(preprocessed["prefix"]):
+        written = next((previous for previous in previous_run_ids if run_exists(s3, bucket_name, group_id, previous)), None)
+        if written:
+            logger.info(f"Result of job {job_id} for group {group_id} was already stored")
+            keys.append(run_key(group_id, written))
+            continue
+        keys.append(write_run(s3, bucket_name, group_id, run_id, result))
+    logger.info(f"Result stored at {keys}")
+    release_job(job, store, split_groups(preprocessed["prefix"]), failed=bool(error))
+    return {"keys": keys}
+
+
+# the stages after preprocess renew the job's group leases first, publish checks them itself
+HANDLERS = {
+    "ingest": ingest,
+    "preprocess": preprocess,
+    "generate": with_renewed_leases(generate, _markers),
+    "paraphrase": with_renewed_leases(paraphrase_stage, _markers),
+    "publish": publish,
+}
+
+
+def handler(event, context):
+    '''
+    Pipeline worker, triggered by the pipeline queue. Verification runs in its own lambda.
+    '''
+    queue = sqs_queue_from_env(boto3.client('sqs'))
+    store = S3CheckpointStore(s3, os.environ['S3_BUCKET_NAME'])
+    handle_sqs_event(event, HANDLERS, queue, store)
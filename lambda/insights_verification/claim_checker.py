@@ -0,0 +1,335 @@
+import io
+import re
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# metric names as they show up in insights, most specific first
+METRIC_PATTERNS = [
+    (re.compile(r"\bCT\s*(?:Sum|total)\b", re.IGNORECASE), "CT Sum"),
+    (re.compile(r"\bCT\s*(?:Avg|Average)\b|average (?:number of )?conversation(?:al)? turns", re.IGNORECASE), "CT Avg"),
+    (re.compile(r"\bAWC\s*(?:Sum|total)\b", re.IGNORECASE), "AWC Sum"),
+    (re.compile(r"\bAWC\s*(?:Avg|Average)\b|average adult word count", re.IGNORECASE), "AWC Avg"),
+    (re.compile(r"conversation(?:al)? turns|\bturns\b|\bCT\b", re.IGNORECASE), "CT Sum"),
+    (re.compile(r"adult word count|\bAWC\b|\bwords\b", re.IGNORECASE), "AWC Sum"),
+]
+CHILD = re.compile(r"\bchild(?:\s+ID)?\s*#?\s*(\d+)", re.IGNORECASE)
+APPROXIMATE = re.compile(r"\b(?:about|approximately|roughly|nearly|around|almost|over|more than|less than)\s+\d", re.IGNORECASE)
+CHANGE = re.compile(
+    r"\b(dropped|decreased|declined|fell|reduced|went down|increased|rose|grew|improved|jumped|went up)\s+(?:by\s+)?"
+    r"(?:about\s+|approximately\s+|roughly\s+|nearly\s+|around\s+|almost\s+|over\s+|more than\s+)?(\d+(?:\.\d+)?)\s*%",
+    re.IGNORECASE,
+)
+NEGATIVE_CHANGE = {"dropped", "decreased", "declined", "fell", "reduced", "went down"}
+INDEX_PERIODS = re.compile(r"\b(?:between|from)\s+(?:xyz\s+)?(week|day)\s+(\d+)\s+(?:and|to)\s+(?:(?:xyz\s+)?(?:week|day)\s+)?(\d+)", re.IGNORECASE)
+DATE = r"(\d{1,2}/\d{1,2}/\d{4})"
+DATE_PERIODS = re.compile(rf"\b(?:between|from)\s+{DATE}\s+(?:and|to)\s+{DATE}", re.IGNORECASE)
+ON_DATE = re.compile(rf"\bon\s+{DATE}", re.IGNORECASE)
+EXTREME = re.compile(r"\b(highest|lowest|most|least|peak|fewest|greatest|best|worst)\b", re.IGNORECASE)
+HOUR = re.compile(r"\b(?:in|at|during|around)\s+(?:the\s+)?(\d{1,2})(?::00)?\s*(am|pm|a\.m\.|p\.m\.|o'clock|hour)", re.IGNORECASE)
+NUMBER = re.compile(r"(?<![\d/.])(\d+(?:\.\d+)?)(?![\d/]|\s*%)")
+PERCENT = re.compile(r"(?<![\d/.])\d+(?:\.\d+)?\s*%")
+HIGH_WORDS = {"highest", "most", "peak", "greatest", "best"}
+
+# relative tolerance for values and percentage points for changes, wider when the insight says "about"
+VALUE_TOLERANCE = 0.01
+CHANGE_TOLERANCE = 1.0
+APPROXIMATE_CHANGE_TOLERANCE = 5.0
+
+
+def load_frames(hourly_csv, child_csv, group_csv):
+    return prepare_frames(*[pd.read_csv(io.StringIO(text)) if text.strip() else pd.DataFrame() for text in (hourly_csv, child_csv, group_csv)])
+
+
+def prepare_frames(hourly, child, group):
+    '''
+    Adds the parsed date (and the hour for the hourly rows) the checks work with.
+    Frames that kept their dtypes (e.g. from parquet) have their categorical ids turned back into numbers.
+    '''
+    frames = []
+    for df in (hourly, child, group):
+        df = df.copy()
+        df.columns = [str(col).strip() for col in df.columns]
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                numbers = pd.to_numeric(df[col].astype(str), errors="coerce")
+                df[col] = numbers if numbers.notna().all() else df[col].astype(str)
+        if "Day Date" in df.columns:
+            df["date"] = pd.to_datetime(df["Day Date"], format="%m/%d/%Y", errors="coerce")
+        frames.append(df)
+    hourly = frames[0]
+    if "Begin Time Local" in hourly.columns:
+        hourly["hour"] = pd.to_datetime(hourly["Begin Time Local"], errors="coerce").dt.hour
+    return frames
+
+
+def _sentences(text):
+    return [s for s in re.split(r"(?<=[.;!?])\s+(?=[A-Z])", text) if s.strip()]
+
+
+def _metric_mentions(text):
+    '''
+    The metrics named in the text as (position, metric) in text order. Where names overlap
+    ("CT Sum" also matches "CT") the more specific pattern wins.
+    '''
+    mentions, taken = [], []
+    for pattern, metric in METRIC_PATTERNS:
+        for match in pattern.finditer(text):
+            if not any(match.start() < end and start < match.end() for start, end in taken):
+                taken.append(match.span())
+                mentions.append((match.start(), metric))
+    return sorted(mentions)
+
+
+def _metric(sentence):
+    mentions = _metric_mentions(sentence)
+    for pattern, metric in METRIC_PATTERNS:
+        if any(m == metric for _, m in mentions):
+            return metric
+    return None
+
+
+def _metric_before(mentions, start, end):
+    # the metric named closest before a phrase, within the text since the previous phrase
+    before = [metric for position, metric in mentions if start <= position < end]
+    return before[-1] if before else None
+
+
+def extract_claims(insight):
+    '''
+    Finds the numeric claims in an insight. Each claim is a dict with the entity, metric,
+    aggregation, comparison and claimed value. Sentences without a recognisable claim are skipped.
+    '''
+    claims = []
+    for sentence in _sentences(insight):
+        mentions = _metric_mentions(sentence)
+        metric = _metric(sentence)
+        if not metric:
+            continue
+        child = CHILD.search(sentence)
+        entity = {"type": "child", "id": int(child.group(1))} if child else {"type": "group"}
+        # with several metrics in the sentence a claim may have been tied to the wrong one
+        mixed = len({m for _, m in mentions}) > 1
+        base = {"text": sentence.strip(), "entity": entity, "mixed_metrics": mixed}
+
+        changes = list(CHANGE.finditer(sentence))
+        periods = INDEX_PERIODS.search(sentence) or DATE_PERIODS.search(sentence)
+        if changes and periods:
+            if periods.re is INDEX_PERIODS:
+                unit = periods.group(1).lower()
+                period = [(unit, int(periods.group(2))), (unit, int(periods.group(3)))]
+            else:
+                period = [("date", periods.group(1)), ("date", periods.group(2))]
+            # one claim per change phrase, about the metric named right before it
+            previous_end = 0
+            for change in changes:
+                change_metric = _metric_before(mentions, previous_end, change.start()) or _metric_before(mentions, 0, change.start()) or metric
+                previous_end = change.end()
+                sign = -1 if change.group(1).lower() in NEGATIVE_CHANGE else 1
+                claims.append(dict(base, metric=change_metric, aggregation=_aggregation(change_metric), comparison="change", value=sign * float(change.group(2)), periods=period, approximate=bool(APPROXIMATE.search(change.group(0)))))
+            continue
+
+        base = dict(base, metric=metric, aggregation=_aggregation(metric))
+
+        extreme = EXTREME.search(sentence)
+        hour = HOUR.search(sentence)
+        if extreme and hour:
+            claims.append(dict(base, comparison="highest" if extreme.group(1).lower() in HIGH_WORDS else "lowest", value=_hour(hour)))
+            continue
+
+        on_date = ON_DATE.search(sentence)
+        if on_date:
+            skip = {str(entity.get("id"))}
+            numbers = [n for n in NUMBER.findall(ON_DATE.sub(" ", sentence)) if n not in skip]
+            if len(numbers) == 1:
+                claims.append(dict(base, comparison="value", value=float(numbers[0]), periods=[("date", on_date.group(1))]))
+    return claims
+
+
+def _aggregation(metric):
+    return "avg" if metric.endswith("Avg") else "sum"
+
+
+def _hour(match):
+    hour = int(match.group(1))
+    suffix = (match.group(2) or "").lower().replace(".", "")
+    if suffix == "pm" and hour < 12:
+        hour += 12
+    if suffix == "am" and hour == 12:
+        hour = 0
+    return hour
+
+
+def _rows(frame, entity):
+    if entity["type"] == "child":
+        if "Child ID" not in frame.columns:
+            return None
+        return frame[frame["Child ID"] == entity["id"]]
+    return frame
+
+
+def _daily_values(claim, hourly, child, group):
+    '''
+    Per-day values of the claim's metric for its entity, taken from the file that has them
+    (child or group summary first, otherwise aggregated from the hourly rows).
+    '''
+    metric, entity = claim["metric"], claim["entity"]
+    summary = child if entity["type"] == "child" else group
+    rows = _rows(summary, entity)
+    if rows is not None and metric in rows.columns and len(rows):
+        return rows.groupby("date")[metric].sum() if claim["aggregation"] == "sum" else rows.groupby("date")[metric].mean()
+    rows = _rows(hourly, entity)
+    if rows is not None and metric in rows.columns and len(rows):
+        per_day = rows.groupby("date")[metric]
+        return per_day.sum() if claim["aggregation"] == "sum" else per_day.mean()
+    return None
+
+
+def _period_dates(period, all_dates):
+    unit, value = period
+    if unit == "date":
+        date = pd.to_datetime(value, format="%m/%d/%Y", errors="coerce")
+        return [date] if date in set(all_dates) else []
+    if unit == "day":
+        return [all_dates[value - 1]] if 0 < value <= len(all_dates) else []
+    weeks = pd.Index(all_dates).to_period("W-SUN")
+    week_order = weeks.unique().sort_values()
+    if not 0 < value <= len(week_order):
+        return []
+    return [d for d, w in zip(all_dates, weeks) if w == week_order[value - 1]]
+
+
+def _check_change(claim, daily, all_dates):
+    values = []
+    for period in claim["periods"]:
+        dates = [d for d in _period_dates(period, all_dates) if d in daily.index]
+        if not dates:
+            return "unresolved", {"reason": f"no data for {period[0]} {period[1]}"}
+        values.append((daily.loc[dates].mean(), daily.loc[dates].sum()))
+    tolerance = APPROXIMATE_CHANGE_TOLERANCE if claim["approximate"] else CHANGE_TOLERANCE
+    # the insight may compare daily averages or period totals, accept either reading
+    changes = {}
+    for name, i in (("daily_mean", 0), ("total", 1)):
+        start, end = values[0][i], values[1][i]
+        if start:
+            changes[name] = round(float((end - start) / start * 100), 2)
+    evidence = {"start": {"daily_mean": float(values[0][0]), "total": float(values[0][1])}, "end": {"daily_mean": float(values[1][0]), "total": float(values[1][1])}, "change_pct": changes}
+    if not changes:
+        return "unresolved", dict(evidence, reason="starting value is zero")
+    supported = any(abs(change - claim["value"]) <= tolerance for change in changes.values())
+    return ("supported" if supported else "refuted"), evidence
+
+
+def _check_extreme(claim, hourly):
+    rows = _rows(hourly, claim["entity"])
+    if rows is None or "hour" not in rows.columns or claim["metric"] not in rows.columns or not len(rows):
+        return "unresolved", {"reason": "no hourly data for the claim"}
+    per_hour = rows.dropna(subset=["hour"]).groupby("hour")[claim["metric"]]
+    # the hour can be ranked by the average or the total, and 3 may mean 15 (see the verification prompt)
+    candidates = {}
+    for name, values in (("mean", per_hour.mean()), ("total", per_hour.sum())):
+        candidates[name] = int(values.idxmax() if claim["comparison"] == "highest" else values.idxmin())
+    claimed = {claim["value"], claim["value"] + 12} if claim["value"] < 12 else {claim["value"]}
+    evidence = {"claimed_hour": claim["value"], claim["comparison"] + "_hour": candidates, "per_hour_mean": {int(h): round(float(v), 2) for h, v in per_hour.mean().items()}}
+    return ("supported" if claimed & set(candidates.values()) else "refuted"), evidence
+
+
+def _check_value(claim, daily):
+    date = pd.to_datetime(claim["periods"][0][1], format="%m/%d/%Y", errors="coerce")
+    if date not in daily.index:
+        return "unresolved", {"reason": f"no data on {claim['periods'][0][1]}"}
+    actual = float(daily.loc[date])
+    supported = abs(actual - claim["value"]) <= max(VALUE_TOLERANCE * abs(actual), 0.5)
+    return ("supported" if supported else "refuted"), {"actual": round(actual, 2)}
+
+
+def check_claim(claim, frames):
+    hourly, child, group = frames
+    try:
+        if claim["comparison"] in ("highest", "lowest"):
+            return _check_extreme(claim, hourly)
+        daily = _daily_values(claim, hourly, child, group)
+        if daily is None or daily.empty:
+            return "unresolved", {"reason": f"no {claim['metric']} data for the {claim['entity']['type']}"}
+        all_dates = sorted(set().union(*[set(df["date"].dropna()) for df in frames if "date" in df.columns]))
+        if claim["comparison"] == "change":
+            return _check_change(claim, daily, all_dates)
+        return _check_value(claim, daily)
+    except Exception as e:
+        logger.info(f"Couldn't check claim {claim['text']!r}: {e}")
+        return "unresolved", {"reason": str(e)}
+
+
+def _covered_spans_removed(sentence, claims):
+    # takes out what each claim of the sentence was read from, whatever is left wasn't checked
+    text = sentence
+    for claim in claims:
+        if claim["entity"]["type"] == "child":
+            text = CHILD.sub(" ", text, count=1)
+        if claim["comparison"] == "change":
+            text = CHANGE.sub(" ", text, count=1)
+            periods = INDEX_PERIODS if INDEX_PERIODS.search(text) else DATE_PERIODS
+            text = periods.sub(" ", text, count=1)
+        elif claim["comparison"] in ("highest", "lowest"):
+            text = EXTREME.sub(" ", text, count=1)
+            text = HOUR.sub(" ", text, count=1)
+        else:
+            text = ON_DATE.sub(" ", text, count=1)
+            text = NUMBER.sub(lambda m: " " if float(m.group(1)) == claim["value"] else m.group(0), text, count=1)
+    return text
+
+
+def uncovered_parts(insight, claims):
+    '''
+    The numbers, percentages, extremes and children of the insight that none of its claims accounts for.
+    '''
+    uncovered = []
+    for sentence in _sentences(insight):
+        rest = _covered_spans_removed(sentence, [c for c in claims if c["text"] == sentence.strip()])
+        for pattern in (NUMBER, PERCENT, EXTREME, CHILD):
+            uncovered.extend(m.group(0) for m in pattern.finditer(rest))
+    return uncovered
+
+
+def whole_period_sentences(insight):
+    '''
+    The sentences of the insight that say something about the data without naming the dates, days or weeks
+    they are about. Days added to the data can change such a claim ("the most words", "the highest hour"),
+    a claim tied to earlier days still holds.
+    '''
+    sentences = []
+    for sentence in _sentences(insight):
+        claims_something = _metric_mentions(sentence) or any(p.search(sentence) for p in (EXTREME, NUMBER, PERCENT))
+        if claims_something and not any(p.search(sentence) for p in (ON_DATE, DATE_PERIODS, INDEX_PERIODS)):
+            sentences.append(sentence.strip())
+    return sentences
+
+
+def check_insight(insight, frames):
+    '''
+    Checks the numeric claims of an insight against the data.
+    Returns the verdict ("correct", "incorrect" or None when the model has to decide) and the per-claim evidence.
+    "correct" needs every number and comparison of the insight to be covered by a supported claim.
+    '''
+    claims = extract_claims(insight)
+    results = []
+    for claim in claims:
+        status, evidence = check_claim(claim, frames)
+        results.append(dict(claim, status=status, evidence=evidence))
+    statuses = {r["status"] for r in results}
+    if any(r["status"] == "refuted" and not r["mixed_metrics"] for r in results):
+        verdict = "incorrect"
+    elif "refuted" in statuses:
+        logger.info("A claim from a sentence with several metrics doesn't check out, leaving it to the model")
+        verdict = None
+    elif statuses == {"supported"}:
+        uncovered = uncovered_parts(insight, claims)
+        if uncovered:
+            logger.info(f"Claims check out but {uncovered} of the insight weren't checked, leaving it to the model")
+        verdict = None if uncovered else "correct"
+    else:
+        verdict = None
+    return verdict, results
@@ -1,12 +1,24 @@
-from langchain_community.chat_models import BedrockChat
-from langchain.agents import initialize_agent
-from langchain.agents import AgentType
 import re
+import os
 import boto3
 import json
 from botocore.exceptions import ClientError
 import botocore
 import time
+import math
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from claim_checker import prepare_frames, check_insight, whole_period_sentences
+from handoff import Table
+from llm_cache import cache_key, get_cache, invoke_model_cached
+from pipeline import S3CheckpointStore, handle_sqs_event, sqs_queue_from_env
+from idempotency import S3MarkerStore, with_renewed_leases
+from prompt_template import PromptTemplate
+from prompt_caching import cached_prefix_content, report_cache_usage, supports_prompt_caching
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 config = botocore.config.Config(
     read_timeout=900,
@@ -15,54 +27,274 @@ config = botocore.config.Config(
 )
 
 client = boto3.client("bedrock-runtime", region_name="us-west-2", config=config)
+# the verification model is called in us-east-1, by the agent and by the direct path alike
+verification_client = boto3.client("bedrock-runtime", region_name="us-east-1", config=config)
+s3 = boto3.client("s3")
+
+# the prompt ships with this lambda, the event only carries the insights and the keys of the data
+VERIFICATION_PROMPT = PromptTemplate.from_file("insights_verification_prompt.txt", ("hourly_csv", "child_csv", "group_csv", "insight"))
+# the data section is the same for every insight of a run, the insight comes at the very end
+VERIFICATION_DATA, VERIFICATION_QUESTION = VERIFICATION_PROMPT.split("insight")
 haiku_mode_id = "anthropic.claude-3-haiku-20240307-v1:0"
 
-def verify_without_python_with_agent(hourly_csv, child_csv, group_csv, insight, verification_prompt, insights_verification_model_id):
-
-    verification_prompt = f'''{verification_prompt.replace(r'{hourly_csv}', hourly_csv).replace(r'{child_csv}', child_csv).replace(r'{group_csv}', group_csv).replace(r'{insight}', insight)}'''
-    llm = BedrockChat(
-    model_id=insights_verification_model_id, region_name="us-east-1", config=config
-    )
-    agent_chain = initialize_agent([], llm, agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION, verbose=True)
-
-    from langchain.agents import AgentExecutor
-    agent_executor = AgentExecutor(
-        agent=agent_chain.agent,
-        tools=[],
-        verbose=True,
-        max_iterations=10,
-    )
+# default on-demand quotas per model id, can be overridden per run with "verification_rate_limits" in the event
+DEFAULT_RATE_LIMITS = {
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {"requests_per_minute": 50, "tokens_per_minute": 400000},
+    "anthropic.claude-3-opus-20240229-v1:0": {"requests_per_minute": 50, "tokens_per_minute": 400000},
+    "anthropic.claude-3-sonnet-20240229-v1:0": {"requests_per_minute": 500, "tokens_per_minute": 1000000},
+    "anthropic.claude-3-haiku-20240307-v1:0": {"requests_per_minute": 1000, "tokens_per_minute": 2000000},
+}
+FALLBACK_RATE_LIMIT = {"requests_per_minute": 20, "tokens_per_minute": 200000}
+DEFAULT_VERIFICATION_CONCURRENCY = 5
+# "agent" verifies through the langchain agent, "direct" sends the same prompt to the model in a single call
+VERIFICATION_MODES = ("agent", "direct")
+AGENT_TYPE = "structured-chat-zero-shot-react-description"
+DIRECT_MAX_TOKENS = 4096
+# a cascade tier's verdict stands when it is "correct" with at least this confidence, unless the tier sets its own
+DEFAULT_MIN_CONFIDENCE = 0.8
+CONFIDENCE_INSTRUCTION = """
+
+Right before the verdict block, give your confidence that the verdict is right as a number between 0 and 1, exactly in this format:
+<confidence>0.9</confidence>
+The verdict block stays the very last line of your answer."""
+CONFIDENCE_BLOCK = re.compile(r"<confidence>\s*([01](?:\.\d+)?)\s*</confidence>", re.IGNORECASE)
+# rough characters per token used to estimate the size of a verification prompt
+CHARS_PER_TOKEN = 3
+
+
+class TokenBucket:
+    '''
+    Request and token buckets for one model, refilled continuously from the per-minute quotas.
+    acquire blocks until both buckets hold enough for the call.
+    '''
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute / 60)
+        self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0):
+        # a single call can't need more than the whole minute's quota
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.requests_per_minute, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+            time.sleep(max(wait, 0.01))
+
+
+# one bucket per model id, kept across warm invocations
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_id, overrides=None):
+    limits = dict(DEFAULT_RATE_LIMITS.get(model_id, FALLBACK_RATE_LIMIT))
+    limits.update((overrides or {}).get(model_id, {}))
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(model_id)
+        if limiter is None or (limiter.requests_per_minute, limiter.tokens_per_minute) != (limits["requests_per_minute"], limits["tokens_per_minute"]):
+            limiter = TokenBucket(limits["requests_per_minute"], limits["tokens_per_minute"])
+            rate_limiters[model_id] = limiter
+        return limiter
+
+# the agent executor of each model id, they only depend on the model and are kept across warm invocations
+agent_executors = {}
+agent_executors_lock = threading.Lock()
+
+
+def get_agent_executor(model_id):
+    with agent_executors_lock:
+        executor = agent_executors.get(model_id)
+        if executor is None:
+            # langchain is only imported when the agent is used, the direct path doesn't pay for it on a cold start
+            from langchain_community.chat_models import BedrockChat
+            from langchain.agents import AgentExecutor, AgentType, initialize_agent
+            llm = BedrockChat(model_id=model_id, client=verification_client)
+            agent_chain = initialize_agent([], llm, agent=AgentType(AGENT_TYPE), verbose=True)
+            executor = AgentExecutor(
+                agent=agent_chain.agent,
+                tools=[],
+                verbose=True,
+                max_iterations=10,
+            )
+            agent_executors[model_id] = executor
+        return executor
+
+
+def verify_without_python_with_agent(data_prompt, insight, insights_verification_model_id, use_cache=True, prompt_caching=True):
+    # the agent builds its own messages, they carry no prompt cache checkpoints whatever prompt_caching says
+
+    verification_prompt = data_prompt + VERIFICATION_QUESTION.render(insight=insight)
+    # the agent makes its own model calls, its final answer is cached by the prompt it was given
+    cache = get_cache() if use_cache else None
+    key = cache_key(insights_verification_model_id, {"agent": AGENT_TYPE, "input": verification_prompt})
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return cached
     try:
+        agent_executor = get_agent_executor(insights_verification_model_id)
         out = agent_executor.invoke({"input": verification_prompt}, handle_parsing_errors=True)
+        # an answer without a readable verdict (e.g. the agent ran out of iterations) is asked for again next time
+        if cache is not None and parse_verdict(out["output"]) is not None:
+            cache.put(key, out["output"])
         return out["output"]
 
     except Exception as e:
         print(e)
         return "Failed"
-    
 
-def extract_final_results(verification):
+
+def verify_direct(data_prompt, insight, insights_verification_model_id, use_cache=True, instruction="", prompt_caching=True):
+    '''
+    Verifies the insight with the same prompt as the agent, in one model call without tools.
+    With prompt_caching the data section is sent as a prompt cache prefix (for the models that support it),
+    so only the first insight of a run pays for it in full.
+    '''
+    content = cached_prefix_content(data_prompt, VERIFICATION_QUESTION.render(insight=insight) + instruction, insights_verification_model_id, prompt_caching)
+    native_request = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": DIRECT_MAX_TOKENS,
+        "temperature": 0,
+        "messages": [
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+    }
+    try:
+        model_response = invoke_model_cached(verification_client.invoke_model, use_cache, modelId=insights_verification_model_id, body=json.dumps(native_request))
+        report_cache_usage(insights_verification_model_id, model_response)
+        return model_response["content"][0]["text"]
+    except (ClientError, Exception) as e:
+        logger.error(f"ERROR: Can't verify with '{insights_verification_model_id}'. Reason: {e}")
+        return "Failed"
+
+
+VERIFIERS = {
+    "agent": verify_without_python_with_agent,
+    "direct": verify_direct,
+}
+
+
+def cascade_tiers(cascade):
+    '''
+    The tiers of the "verification_cascade" config, cheapest first. An entry is a model id or
+    {"model_id": ..., "min_confidence": ...}.
+    '''
+    tiers = []
+    for entry in cascade or []:
+        if isinstance(entry, str):
+            entry = {"model_id": entry}
+        tiers.append({"model_id": entry["model_id"], "min_confidence": float(entry.get("min_confidence", DEFAULT_MIN_CONFIDENCE))})
+    return tiers
+
+
+def verify_with_confidence(data_prompt, insight, model_id, use_cache=True, prompt_caching=True):
+    '''
+    A cascade tier: a direct verification that also asks for the model's confidence.
+    Returns the answer, its verdict (None if unreadable) and the confidence (None if missing, which escalates).
+    '''
+    out = verify_direct(data_prompt, insight, model_id, use_cache, CONFIDENCE_INSTRUCTION, prompt_caching)
+    confidence = CONFIDENCE_BLOCK.findall(out)
+    # a confidence block given after the verdict anyway would hide a trailing verdict line from the parser
+    verdict = parse_verdict(CONFIDENCE_BLOCK.sub("", out))
+    if not confidence:
+        logger.info(f"{model_id} gave no confidence for its verdict {verdict}, escalating the insight")
+        return out, verdict, None
+    return out, verdict, min(float(confidence[-1]), 1.0)
+
+
+class CacheWarmup:
+    '''
+    Lets the first model call of a run go alone and holds the others until it has returned,
+    by then it has written the prompt cache and the others read the data section from it.
+    '''
+
+    def __init__(self, enabled):
+        self.lock = threading.Lock()
+        self.started = False
+        self.done = threading.Event()
+        if not enabled:
+            self.done.set()
+
+    def __enter__(self):
+        with self.lock:
+            first = not self.started
+            self.started = True
+        if not first:
+            self.done.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+
+
+VERDICTS = ("correct", "incorrect", "failed")
+VERDICT_BLOCK = re.compile(r"<verdict>\s*(correct|incorrect)\s*</verdict>", re.IGNORECASE)
+VERDICT_LINE = re.compile(r"(?:final answer|verdict|conclusion)\s*[:\-]?\s*\**\s*\"?(correct|incorrect)\b", re.IGNORECASE)
+
+
+def parse_verdict(verification):
+    '''
+    Reads the verdict from the verification answer without a model call.
+    Returns "correct", "incorrect" or "failed", or None when the answer is ambiguous.
+    '''
+    text = verification.strip()
+    if text.lower() in VERDICTS:
+        return text.lower()
+    blocks = VERDICT_BLOCK.findall(text)
+    if blocks:
+        return blocks[-1].lower()
+    lines = VERDICT_LINE.findall(text)
+    if lines:
+        return lines[-1].lower()
+    return None
+
+
+def extract_final_results(verifications, use_cache=True):
+    '''
+    Classifies the verification answers the local parser couldn't read with a single model call.
+    Returns one of "correct", "incorrect" or "failed" per answer, "failed" for all of them if the call fails.
+    '''
+    answers = "\n".join(f"<ANSWER {i + 1}>\n{verification}\n</ANSWER {i + 1}>" for i, verification in enumerate(verifications))
     extract_promt = f'''
     <IMMEDIATE TASK>
-    you task is to find the final conclusion for the insight whether they are correct or not? string
-    already contain the answer but they are unstructured. 
+    you task is to find the final conclusion for each of the {len(verifications)} answers below, whether the insight they verify is correct or not?
+    the answers already contain the conclusion but they are unstructured.
     </IMMEDIATE TASK>
 
     <INSTRUCTIONS>
-    1. *STRICTLY* you must only return one word "correct" or "incorrect".
+    1. *STRICTLY* you must only return a JSON list with one word per answer, in the same order: "correct", "incorrect" or "failed".
+    for example ["correct", "failed"]. do not output anything else.
     2. *STRICTLY* YOU MUST COME UP WITH THE CONCLUSION YOUSELF, IF THERE IS NO CONCLUSION OR CORRECT OR INCORRECT MENTIONED
     THEN YOU MUST OUTPUT "failed" word.
     3. *STRICTLY* YOU MUST RETURN "failed" IF THERE IS NO FINAL ANSWER, DO NOT COME UP WITH YOUR OWN ANSWER.
     </INSTRUCTIONS>
 
-    <GIVEN STRING>
-    {verification}
-    </GIVEN STRING>
+    <GIVEN ANSWERS>
+    {answers}
+    </GIVEN ANSWERS>
     '''
     native_request = {
         "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 200000,
-        "temperature": 0.5,
+        "max_tokens": 20 * len(verifications) + 50,
+        "temperature": 0,
         "messages": [
             {
                 "role": "user",
@@ -76,55 +308,225 @@ def extract_final_results(verification):
 
     try:
         # Invoke the model with the request.
-        response = client.invoke_model(modelId=haiku_mode_id, body=request)
-
+        model_response = invoke_model_cached(client.invoke_model, use_cache, modelId=haiku_mode_id, body=request)
+        response_text = model_response["content"][0]["text"]
+        labels = json.loads(response_text[response_text.index("["):response_text.rindex("]") + 1])
     except (ClientError, Exception) as e:
-        print(f"ERROR: Can't invoke haiku. Reason: {e}")
-        exit(1)
+        logger.error(f"ERROR: Can't classify the verification answers with haiku. Reason: {e}")
+        return ["failed"] * len(verifications)
+
+    if len(labels) != len(verifications):
+        logger.error(f"Expected {len(verifications)} verdicts from haiku, got {len(labels)}")
+        return ["failed"] * len(verifications)
+    return [label.strip().lower() if str(label).strip().lower() in VERDICTS else "failed" for label in map(str, labels)]
+
+
+class HandoffData:
+    '''
+    The three tables handed off by the generation lambda, fetched from S3 the first time an insight needs them.
+    The frames are enough for the claim checker, the csv text is only built for insights that go to the model.
+    '''
+
+    def __init__(self, artifact):
+        self.tables = [Table(s3, artifact["bucket"], artifact[name]) for name in ("hourly", "child", "group")]
+        self.lock = threading.RLock()
+        self._frames = None
+        self._csvs = None
+        self._prompt = None
+
+    def frames(self):
+        with self.lock:
+            if self._frames is None:
+                self._frames = prepare_frames(*[table.frame() for table in self.tables])
+            return self._frames
 
-    # Decode the response body.
-    model_response = json.loads(response["body"].read())
+    def csvs(self):
+        with self.lock:
+            if self._csvs is None:
+                self._csvs = [table.csv() for table in self.tables]
+            return self._csvs
 
-    # Extract and print the response text.
-    response_text = model_response["content"][0]["text"]
+    def prompt_prefix(self):
+        '''
+        The data section of the verification prompt, rendered once for all insights.
+        '''
+        with self.lock:
+            if self._prompt is None:
+                hourly_csv, child_csv, group_csv = self.csvs()
+                self._prompt = VERIFICATION_DATA.render(hourly_csv=hourly_csv, child_csv=child_csv, group_csv=group_csv)
+            return self._prompt
 
-    return response_text
+
+def recheck_carried(carried, verdicts, details):
+    '''
+    The insights carried over from a group's previous result that still hold with the new days.
+    They were checked again with the claim checker, what it couldn't settle went to the model only when it makes
+    whole-period claims; only the ones still correct are kept.
+    '''
+    kept = []
+    for entry, verdict, detail in zip(carried, verdicts, details):
+        if verdict != "correct":
+            logger.info(f"Carried insight no longer holds with the new days ({verdict}): {entry['insight']}")
+            continue
+        kept.append({"insight": entry["insight"], "verdict": verdict, "details": dict(detail, carried=True)})
+    return kept
 
 
 def verify_insights(event, context):
-    insights = event["insights"]
-    hourly_csv = event["hourly"]
-    child_csv = event["child"]
-    group_csv = event["group"]
-    verification_prompt = event["verification_prompt"]
+    # insights carried over from the previous result are checked again along with the new ones
+    carried = event.get("carried") or []
+    new = len(event["insights"])
+    insights = event["insights"] + [entry["insight"] for entry in carried]
+    data = HandoffData(event["artifact"])
     insights_verification_model_id = event["insights_verification_model_id"]
-    verification_result = []
-    for insight in insights:
+    limiter = get_rate_limiter(insights_verification_model_id, event.get("verification_rate_limits"))
+    concurrency = int(event.get("verification_concurrency") or DEFAULT_VERIFICATION_CONCURRENCY)
+    use_cache = event.get("use_llm_cache", True)
+    mode = event.get("verification_mode") or "agent"
+    if mode not in VERIFICATION_MODES:
+        logger.error(f"Unknown verification mode {mode}, using the agent")
+        mode = "agent"
+    verify = VERIFIERS[mode]
+    # cache checkpoints go only to direct calls of models that take them, see prompt_caching
+    prompt_caching = event.get("verification_prompt_caching", True)
+    caches = prompt_caching and mode == "direct" and supports_prompt_caching(insights_verification_model_id)
+    if prompt_caching and not caches:
+        logger.info(f"Prompt caching doesn't apply to {insights_verification_model_id} in {mode} mode, it needs direct mode and a model that supports it")
+    warmup = CacheWarmup(caches)
+    # cheaper models that settle the insights they are confident are correct, the rest go on to the verification model
+    tiers = cascade_tiers(event.get("verification_cascade"))
+    for tier in tiers:
+        tier["limiter"] = get_rate_limiter(tier["model_id"], event.get("verification_rate_limits"))
+        tier["warmup"] = CacheWarmup(prompt_caching and supports_prompt_caching(tier["model_id"]))
+
+    details = [{"decided_by": None, "tier": None, "claims": [], "escalations": []} for _ in insights]
+
+    def verify_one(index):
+        insight = insights[index]
         print("Insight: ", insight)
         if insight == "HARSH WORDS DETECTED":
-            out = "failed"
-        else:
-            out = verify_without_python_with_agent(hourly_csv, child_csv, group_csv,insight, verification_prompt, insights_verification_model_id)
-        verification_result.append(out)
+            details[index]["decided_by"] = "guardrail"
+            return "failed"
+        # numeric claims are checked against the data first, only what they can't settle goes to the model
+        verdict, claims = check_insight(insight, data.frames())
+        details[index]["claims"] = claims
+        if verdict:
+            details[index]["decided_by"] = "claim_checker"
+            print("Claim checker: ", verdict)
+            return verdict
+        if index >= new and not whole_period_sentences(insight):
+            # its claims are about days that didn't change when the new ones were added, the previous verdict stands
+            details[index]["decided_by"] = "previous_result"
+            return carried[index - new]["verdict"]
+        details[index]["decided_by"] = "llm"
+        data_prompt = data.prompt_prefix()
+        # every verification prompt carries the three csvs, the insight itself is small.
+        # the agent may take a few model turns, the bucket is charged for the prompt of the first one
+        prompt_tokens = math.ceil((len(data_prompt) + VERIFICATION_QUESTION.size(insight=insight)) / CHARS_PER_TOKEN)
+        for tier in tiers:
+            tier["limiter"].acquire(prompt_tokens)
+            with tier["warmup"]:
+                out, verdict, confidence = verify_with_confidence(data_prompt, insight, tier["model_id"], use_cache, prompt_caching)
+            print(f"{tier['model_id']}: {verdict} ({confidence})")
+            if verdict == "correct" and confidence is not None and confidence >= tier["min_confidence"]:
+                details[index]["tier"] = tier["model_id"]
+                return out
+            details[index]["escalations"].append({"model_id": tier["model_id"], "verdict": verdict, "confidence": confidence})
+        details[index]["tier"] = insights_verification_model_id
+        limiter.acquire(prompt_tokens)
+        with warmup:
+            out = verify(data_prompt, insight, insights_verification_model_id, use_cache, prompt_caching=prompt_caching)
         print("LLM: ",out)
         print("=====================================")
-        time.sleep(60)
+        return out
+
+    # verify concurrently, the rate limiter keeps the calls within the model quota and map keeps the input order
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(insights) or 1))) as executor:
+        verification_result = list(executor.map(verify_one, range(len(insights))))
     print("Verification Done")
-    # with open("temp_ver_results.txt", "w") as f:
-    #     for i, answer in enumerate(verification_result):
-    #         f.write(f"{i+1}. {answer}\n")
-    final_answers = []
-    for ver in verification_result:
-        if ver == "failed":
-            final_answers.append("failed")
-        else:
-            final_answers.append(extract_final_results(ver))
+    final_answers = [parse_verdict(ver) for ver in verification_result]
+    # answers without a readable verdict are classified together in one call
+    ambiguous = [i for i, ans in enumerate(final_answers) if ans is None]
+    if ambiguous:
+        logger.info(f"{len(ambiguous)} verification answers without a verdict block, classifying them in one call")
+        for i, ans in zip(ambiguous, extract_final_results([verification_result[i] for i in ambiguous], use_cache)):
+            final_answers[i] = ans
     for f_ans in final_answers:
         print(f_ans)
-    # write the results
-    # with open("verification_results.txt", "w") as f:
-    #     for i, answer in enumerate(final_answers):
-    #         f.write(f"{i+1}. {answer}\n")
-    return final_answers
+    cache = get_cache()
+    if cache is not None:
+        logger.info(f"LLM cache: {cache.stats()}")
+    result = {"verdicts": final_answers[:new], "details": details[:new]}
+    if carried:
+        result["carried"] = recheck_carried(carried, final_answers[new:], details[new:])
+    return result
 
 
+def verification_event(job_id, store, insights, carried=None):
+    '''
+    The verify_insights event for insights of a pipeline job, with the handed off tables and the config from its checkpoints.
+    '''
+    config = store.load(job_id, "ingest")["config"]
+    preprocessed = store.load(job_id, "preprocess")
+    return {
+        "insights": insights,
+        "artifact": preprocessed["tables"],
+        "carried": carried,
+        "insights_verification_model_id": config["insights_verification_model_id"],
+        "verification_rate_limits": config.get("verification_rate_limits"),
+        "verification_concurrency": config.get("verification_concurrency"),
+        "use_llm_cache": config.get("use_llm_cache", True),
+        "verification_mode": config.get("verification_mode"),
+        "verification_cascade": config.get("verification_cascade"),
+        "verification_prompt_caching": config.get("verification_prompt_caching", True),
+    }
+
+
+def verify_stage(job, store):
+    '''
+    The verify stage of a pipeline job, takes the paraphrased insights and the handed off tables from the job's checkpoints.
+    Insights the generate stage already had verified one by one while they streamed in aren't verified again.
+    '''
+    job_id = job["job_id"]
+    insights = store.load(job_id, "paraphrase")["insights"]
+    carried = store.load(job_id, "preprocess").get("incremental", {}).get("carried")
+    early = (store.load(job_id, "generate") or {}).get("verified") or []
+    if len(early) != len(insights):
+        early = [None] * len(insights)
+    pending = [i for i, (insight, entry) in enumerate(zip(insights, early)) if not entry or entry["insight"] != insight]
+    logger.info(f"{len(insights) - len(pending)} insights were verified while they were generated, {len(pending)} left")
+    result = {"verdicts": [entry and entry["verdict"] for entry in early], "details": [entry and entry["details"] for entry in early]}
+    if not pending and not carried:
+        return result
+    verified = verify_insights(verification_event(job_id, store, [insights[i] for i in pending], carried), None)
+    for i, verdict, details in zip(pending, verified["verdicts"], verified["details"]):
+        result["verdicts"][i], result["details"][i] = verdict, details
+    if "carried" in verified:
+        result["carried"] = verified["carried"]
+    return result
+
+
+def insight_handler(event, context):
+    '''
+    Verifies one insight of a pipeline job, invoked by the generate stage as soon as the insight is final.
+    The event is {"job_id": ..., "insight": ...}, returns {"insight": ..., "verdict": ..., "details": ...}.
+    '''
+    store = S3CheckpointStore(s3, os.environ["S3_BUCKET_NAME"])
+    result = verify_insights(verification_event(event["job_id"], store, [event["insight"]]), context)
+    return {"insight": event["insight"], "verdict": result["verdicts"][0], "details": result["details"][0]}
+
+
+# verification can take long, the job's group leases are renewed before it starts
+HANDLERS = {"verify": with_renewed_leases(verify_stage, lambda: S3MarkerStore(s3, os.environ["S3_BUCKET_NAME"]))}
+
+
+def queue_handler(event, context):
+    '''
+    Triggered by the verification queue. The job goes back to the pipeline queue for publishing when it's verified.
+    Invoked directly (without SQS records) it verifies a single insight, see insight_handler.
+    '''
+    if "Records" not in event:
+        return insight_handler(event, context)
+    queue = sqs_queue_from_env(boto3.client("sqs"))
+    store = S3CheckpointStore(s3, os.environ["S3_BUCKET_NAME"])
+    handle_sqs_event(event, HANDLERS, queue, store)
@@ -0,0 +1,29 @@
+import os
+import logging
+
+import boto3
+
+from result_store import compact_group, list_groups
+
+s3 = boto3.client('s3')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def handler(event, context):
+    '''
+    Runs on a schedule and folds the new runs of every group into the group's manifest.
+    An event with "group_ids" compacts only those groups.
+    '''
+    bucket_name = os.environ['S3_BUCKET_NAME']
+    group_ids = (event or {}).get("group_ids") or list_groups(s3, bucket_name)
+    compacted = {}
+    for group_id in group_ids:
+        try:
+            compacted[group_id] = compact_group(s3, bucket_name, group_id)
+        except Exception as e:
+            # one group failing shouldn't hold back the others, it is retried on the next schedule
+            logger.error(f"Compacting group {group_id} failed: {e}")
+    logger.info(f"Compacted runs per group: {compacted}")
+    return compacted
@@ -0,0 +1,91 @@
+import gzip
+import hashlib
+import importlib.util
+import io
+import logging
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# tables handed from generation to verification, stored once per distinct content and expired by a bucket lifecycle rule
+ARTIFACT_PREFIX = "artifacts/verification/"
+
+# parquet keeps the dtypes and is much smaller, gzipped csv is used where pyarrow isn't installed.
+# the reader picks the format from the key, so a parquet artifact needs pyarrow on the reading side too
+PARQUET = ".parquet"
+CSV_GZ = ".csv.gz"
+TABLE_FORMAT = PARQUET if importlib.util.find_spec("pyarrow") else CSV_GZ
+
+
+def _serialize(df, table_format):
+    if table_format == PARQUET:
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False, compression="zstd")
+        return buffer.getvalue()
+    # mtime 0 so the same table always gives the same bytes, and the same key
+    return gzip.compress(df.to_csv(index=False).encode("utf-8"), mtime=0)
+
+
+def write_table(s3, bucket_name, df, table_format=None):
+    '''
+    Stores a data frame under a key derived from its content and returns the key.
+    A table that was already handed off (e.g. a rerun on the same upload) isn't written again.
+    '''
+    table_format = table_format or TABLE_FORMAT
+    data = _serialize(df, table_format)
+    key = f"{ARTIFACT_PREFIX}{hashlib.sha256(data).hexdigest()}{table_format}"
+    try:
+        s3.head_object(Bucket=bucket_name, Key=key)
+        return key
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+            raise
+    s3.put_object(Bucket=bucket_name, Key=key, Body=data)
+    logger.info(f"Handed off {len(df)} rows as {key} ({len(data)} bytes)")
+    return key
+
+
+def write_tables(s3, bucket_name, tables):
+    '''
+    tables is {name: data frame}, returns {name: key}.
+    '''
+    return {name: write_table(s3, bucket_name, df) for name, df in tables.items()}
+
+
+class Table:
+    '''
+    A handed off table, fetched from S3 the first time it is used. frame() gives the data frame,
+    csv() the same text the generation side had from df.to_csv(index=False).
+    '''
+
+    def __init__(self, s3, bucket_name, key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self._data = None
+        self._frame = None
+        self._csv = None
+
+    def _bytes(self):
+        if self._data is None:
+            self._data = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)["Body"].read()
+        return self._data
+
+    def frame(self):
+        if self._frame is None:
+            if self.key.endswith(PARQUET):
+                self._frame = pd.read_parquet(io.BytesIO(self._bytes()))
+            else:
+                self._frame = pd.read_csv(io.StringIO(self.csv()))
+        return self._frame
+
+    def csv(self):
+        if self._csv is None:
+            if self.key.endswith(PARQUET):
+                self._csv = self.frame().to_csv(index=False)
+            else:
+                self._csv = gzip.decompress(self._bytes()).decode("utf-8")
+        return self._csv
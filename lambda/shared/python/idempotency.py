@@ -0,0 +1,175 @@
+import hashlib
+import json
+import threading
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+from result_store import CONDITIONAL_WRITE_ERRORS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# an upload is processed once per content: its marker is created when its job starts and kept.
+# a group is worked on by one job at a time: the job holds the group's lease until it publishes
+MARKER_PREFIX = "ingest/"
+PROCESSED_DIR = "processed/"
+LEASES_DIR = "leases/"
+# the lease is renewed when each of the job's stages starts, so it only has to outlive one stage with its
+# retries and queue wait. one left behind by a crashed job is taken over after it expires
+LEASE_SECONDS = 3600
+# the job checkpoint that lists the groups a job holds the leases of
+LEASES_CHECKPOINT = "leases"
+HASH_BLOCK_BYTES = 8 * 1024 ** 2
+
+
+def content_hash(s3, bucket_name, key):
+    '''
+    sha256 of the object's content, read in blocks. The ETag isn't used, a multipart upload of the same file has another one.
+    '''
+    digest = hashlib.sha256()
+    body = s3.get_object(Bucket=bucket_name, Key=key)["Body"]
+    for block in iter(lambda: body.read(HASH_BLOCK_BYTES), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def processed_marker(digest):
+    return f"{PROCESSED_DIR}{digest}"
+
+
+def group_lease(group_id):
+    return f"{LEASES_DIR}{group_id}"
+
+
+def lease_holder(job):
+    # the group jobs of a fan-out publish under the leases their parent took
+    return job.get("parent_id") or job["job_id"]
+
+
+class LeaseLost(Exception):
+    '''
+    Another job took over a lease this job held, after it had expired.
+    '''
+
+
+def renew_job_leases(markers, job, store):
+    '''
+    Renews the leases of the groups in the job's leases checkpoint. Raises LeaseLost when another job holds one of them.
+    '''
+    groups = (store.load(job["job_id"], LEASES_CHECKPOINT) or {}).get("groups", [])
+    lost = [group_id for group_id in groups if not markers.acquire_lease(group_lease(group_id), lease_holder(job))]
+    if lost:
+        raise LeaseLost(f"groups {lost} were taken over by another job")
+
+
+def with_renewed_leases(handler, markers):
+    '''
+    Wraps a stage handler so the job's leases are renewed when the stage starts, a job that waited in the
+    queue or is retried keeps its groups. markers() gives the marker store. A lost lease fails the stage.
+    '''
+    def run(job, store):
+        renew_job_leases(markers(), job, store)
+        return handler(job, store)
+    return run
+
+
+class MemoryMarkerStore:
+    '''
+    In-process stand-in for S3MarkerStore, for tests and local runs.
+    '''
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def claim(self, name, record):
+        with self.lock:
+            if name in self.records:
+                return False
+            self.records[name] = dict(record)
+            return True
+
+    def get(self, name):
+        with self.lock:
+            record = self.records.get(name)
+            return dict(record) if record is not None else None
+
+    def release(self, name):
+        with self.lock:
+            self.records.pop(name, None)
+
+    def acquire_lease(self, name, holder, seconds=LEASE_SECONDS, now=None):
+        now = now or time.time()
+        with self.lock:
+            lease = self.records.get(name)
+            if lease and lease["holder"] != holder and lease["expires"] > now:
+                return False
+            self.records[name] = {"holder": holder, "expires": now + seconds}
+            return True
+
+    def release_lease(self, name, holder):
+        with self.lock:
+            lease = self.records.get(name)
+            if lease and lease["holder"] == holder:
+                del self.records[name]
+
+
+class S3MarkerStore:
+    '''
+    Markers and leases as small objects under MARKER_PREFIX. Creating one is a put with If-None-Match,
+    taking over an expired lease a put with If-Match on the ETag it was read with, so of two
+    concurrent claims only one succeeds.
+    '''
+
+    def __init__(self, s3, bucket_name, prefix=MARKER_PREFIX):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _read(self, name):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.prefix + name)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None, None
+            raise
+        return json.loads(obj["Body"].read().decode("utf-8")), obj["ETag"]
+
+    def _put(self, name, record, **conditions):
+        try:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.prefix + name, Body=json.dumps(record).encode("utf-8"), ContentType="application/json", **conditions)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_ERRORS:
+                return False
+            raise
+        return True
+
+    def claim(self, name, record):
+        '''
+        Creates the marker, False when it already exists.
+        '''
+        return self._put(name, record, IfNoneMatch="*")
+
+    def get(self, name):
+        return self._read(name)[0]
+
+    def release(self, name):
+        self.s3.delete_object(Bucket=self.bucket_name, Key=self.prefix + name)
+
+    def acquire_lease(self, name, holder, seconds=LEASE_SECONDS, now=None):
+        '''
+        Takes the lease for holder, or renews it when holder has it already. False while someone else holds it.
+        '''
+        now = now or time.time()
+        lease, etag = self._read(name)
+        if lease and lease["holder"] != holder and lease["expires"] > now:
+            return False
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        return self._put(name, {"holder": holder, "expires": now + seconds}, **condition)
+
+    def release_lease(self, name, holder):
+        lease, _ = self._read(name)
+        if lease and lease["holder"] == holder:
+            self.release(name)
@@ -0,0 +1,272 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# model responses by request, so a rerun of the same upload doesn't call Bedrock again.
+# looked up in memory, then on the lambda's local disk, then in S3; a hit in a lower tier is copied to the ones above
+DEFAULT_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+MEMORY_MAX_BYTES = 64 * 1024 ** 2
+DISK_DIR = os.path.join("/tmp", "llm-cache")
+DISK_MAX_BYTES = 256 * 1024 ** 2
+S3_PREFIX = "llm-cache/"
+# only complete answers are cached, a cut off or blocked one has to be asked for again on the next try
+CACHEABLE_STOP_REASONS = ("end_turn", "stop_sequence")
+GUARDRAIL_ACTION = "amazon-bedrock-guardrailAction"
+
+
+def _parse(body):
+    return json.loads(body) if isinstance(body, (bytes, str)) else body
+
+
+def cache_key(model_id, body, guardrail_id=None, guardrail_version=None):
+    '''
+    Key of a model request: the model, the request body (which holds the prompt, temperature and max_tokens)
+    with its keys sorted, and the guardrail version that filtered the response.
+    '''
+    body = _parse(body)
+    normalized = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    temperature = body.get("temperature") if isinstance(body, dict) else None
+    material = json.dumps([model_id, hashlib.sha256(normalized.encode("utf-8")).hexdigest(), temperature, guardrail_id, guardrail_version])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def cacheable(model_response):
+    '''
+    Whether a decoded response is worth caching: the model finished on its own and no guardrail intervened.
+    '''
+    return model_response.get("stop_reason") in CACHEABLE_STOP_REASONS and model_response.get(GUARDRAIL_ACTION) != "INTERVENED"
+
+
+class MemoryTier:
+    name = "memory"
+
+    def __init__(self, max_bytes=MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+
+class DiskTier:
+    name = "disk"
+
+    def __init__(self, directory=DISK_DIR, max_bytes=DISK_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # the access time drives the eviction
+        os.utime(self._path(key))
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                try:
+                    stat = os.stat(self._path(name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+            size = sum(f[1] for f in files)
+            for _, file_size, name in sorted(files):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
+                size -= file_size
+
+
+class S3Tier:
+    '''
+    Shared by every lambda and container. Old entries are also removed by a bucket lifecycle rule on the prefix.
+    '''
+    name = "s3"
+
+    def __init__(self, s3, bucket_name, prefix=S3_PREFIX):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            return self.s3.get_object(Bucket=self.bucket_name, Key=self.prefix + key)["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def put(self, key, data):
+        self.s3.put_object(Bucket=self.bucket_name, Key=self.prefix + key, Body=data, ContentType="application/json")
+
+
+class ResponseCache:
+    '''
+    Tiered cache of model responses. Entries older than ttl_seconds are treated as missing.
+    A failing tier is logged and skipped, the cache never makes a model call fail.
+    '''
+
+    def __init__(self, tiers, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.tiers = tiers
+        self.ttl_seconds = ttl_seconds
+        self.hits = collections.Counter()
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            try:
+                data = tier.get(key)
+            except Exception as e:
+                logger.info(f"LLM cache {tier.name} tier read failed: {e}")
+                continue
+            if data is None:
+                continue
+            entry = json.loads(data)
+            if time.time() - entry["created"] > self.ttl_seconds:
+                continue
+            for upper in self.tiers[:i]:
+                self._put(upper, key, data)
+            with self.lock:
+                self.hits[tier.name] += 1
+            return entry["response"]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _put(self, tier, key, data):
+        try:
+            tier.put(key, data)
+        except Exception as e:
+            logger.info(f"LLM cache {tier.name} tier write failed: {e}")
+
+    def put(self, key, response):
+        data = json.dumps({"created": time.time(), "response": response}).encode("utf-8")
+        for tier in self.tiers:
+            self._put(tier, key, data)
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.hits.values()) + self.misses
+            return {"hits": dict(self.hits), "misses": self.misses, "hit_rate": round(sum(self.hits.values()) / lookups, 3) if lookups else None}
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    '''
+    The cache of this process, built on first use. LLM_CACHE_DISABLED=1 turns caching off,
+    the S3 tier is used when S3_BUCKET_NAME is set.
+    '''
+    global _default_cache
+    if os.environ.get("LLM_CACHE_DISABLED", "").lower() in ("1", "true", "yes"):
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            tiers = [MemoryTier(), DiskTier()]
+            if os.environ.get("S3_BUCKET_NAME"):
+                tiers.append(S3Tier(boto3.client("s3"), os.environ["S3_BUCKET_NAME"]))
+            _default_cache = ResponseCache(tiers)
+        return _default_cache
+
+
+def invoke_model_cached(invoke, use_cache=True, **kwargs):
+    '''
+    Returns the decoded response body of invoke(**kwargs), a bedrock-runtime invoke_model call
+    (or a wrapper around it), from the cache when the same request was answered before.
+    use_cache=False skips the cache for this call. Only cacheable() responses are stored.
+    '''
+    cache = get_cache() if use_cache else None
+    key = None
+    if cache is not None:
+        key = cache_key(kwargs["modelId"], kwargs["body"], kwargs.get("guardrailIdentifier"), kwargs.get("guardrailVersion"))
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"LLM cache hit for {kwargs['modelId']} ({cache.stats()})")
+            return cached
+    model_response = json.loads(invoke(**kwargs)["body"].read())
+    if cache is not None and cacheable(model_response):
+        cache.put(key, model_response)
+    return model_response
+
+
+def stream_model_cached(client, on_text, use_cache=True, **kwargs):
+    '''
+    invoke_model_with_response_stream(**kwargs) on a bedrock-runtime client for an Anthropic model.
+    on_text is called with every piece of generated text as it arrives (with the whole text at once on a
+    cache hit). Returns the response in the shape of an invoke_model body, which is what gets cached.
+    '''
+    cache = get_cache() if use_cache else None
+    key = None
+    if cache is not None:
+        key = cache_key(kwargs["modelId"], kwargs["body"], kwargs.get("guardrailIdentifier"), kwargs.get("guardrailVersion"))
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"LLM cache hit for {kwargs['modelId']} ({cache.stats()})")
+            on_text(cached["content"][0]["text"])
+            return cached
+    pieces = []
+    model_response = {"stop_reason": None}
+    for event in client.invoke_model_with_response_stream(**kwargs)["body"]:
+        if "chunk" not in event:
+            continue
+        data = json.loads(event["chunk"]["bytes"])
+        if data.get("type") == "content_block_delta":
+            text = data["delta"].get("text", "")
+            pieces.append(text)
+            on_text(text)
+        elif data.get("type") == "message_delta":
+            model_response["stop_reason"] = data.get("delta", {}).get("stop_reason")
+        if GUARDRAIL_ACTION in data:
+            model_response[GUARDRAIL_ACTION] = data[GUARDRAIL_ACTION]
+    model_response["content"] = [{"type": "text", "text": "".join(pieces)}]
+    if cache is not None and cacheable(model_response):
+        cache.put(key, model_response)
+    return model_response
@@ -0,0 +1,298 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# a job goes through the stages in this order. stages pass a small job record through the queues,
+# what a stage produces is stored as its checkpoint and read from there by the later stages
+STAGES = ["ingest", "preprocess", "generate", "paraphrase", "verify", "publish"]
+
+# verification runs in its own lambda, every other stage in the pipeline worker
+PIPELINE_QUEUE = "pipeline"
+VERIFICATION_QUEUE = "verification"
+STAGE_QUEUES = {"verify": VERIFICATION_QUEUE}
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 30
+CHECKPOINT_PREFIX = "jobs/"
+
+
+class Deferred(Exception):
+    '''
+    Raised by a stage that can't run yet, e.g. while another job holds a lease it needs.
+    The job is sent back to run the stage again after delay seconds, this doesn't count as a failed attempt.
+    '''
+
+    def __init__(self, reason, delay=RETRY_DELAY_SECONDS):
+        super().__init__(reason)
+        self.delay = delay
+
+
+def queue_for(stage):
+    return STAGE_QUEUES.get(stage, PIPELINE_QUEUE)
+
+
+def new_job(bucket_name, key):
+    '''
+    The record of a new job for an uploaded file, starting at the first stage.
+    '''
+    return {"job_id": uuid.uuid4().hex, "stage": STAGES[0], "attempt": 1, "bucket": bucket_name, "key": key}
+
+
+def child_job_id(parent_id, name):
+    return f"{parent_id}-{name}"
+
+
+def child_job(job, name, stage):
+    '''
+    A job split off from job, starting at stage. Its checkpoints for the earlier stages are written by the parent.
+    '''
+    return dict(job, job_id=child_job_id(job["job_id"], name), parent_id=job["job_id"], stage=stage, attempt=1)
+
+
+def next_stage(stage):
+    index = STAGES.index(stage)
+    return STAGES[index + 1] if index + 1 < len(STAGES) else None
+
+
+class MemoryQueue:
+    '''
+    In-process queues for tests and benchmarks. Messages are handed out once their delay has passed.
+    '''
+
+    def __init__(self):
+        self.queues = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def send(self, queue_name, message, delay=0):
+        with self.lock:
+            heapq.heappush(self.queues.setdefault(queue_name, []), (time.time() + delay, next(self.counter), json.dumps(message)))
+
+    def receive(self, queue_name):
+        with self.lock:
+            queue = self.queues.get(queue_name)
+            if not queue or queue[0][0] > time.time():
+                return None
+            return json.loads(heapq.heappop(queue)[2])
+
+    def pending(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+
+class FileQueue:
+    '''
+    Queues in a local directory, one sub directory per queue and one file per message, so a run
+    can be stopped and picked up again. A message is claimed by renaming its file.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, queue_name):
+        path = os.path.join(self.root, queue_name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def send(self, queue_name, message, delay=0):
+        # the file name starts with the time the message becomes visible, so sorting the names orders the queue
+        name = f"{time.time() + delay:017.6f}-{uuid.uuid4().hex}.json"
+        path = os.path.join(self._dir(queue_name), name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(message, f)
+        os.replace(path + ".tmp", path)
+
+    def receive(self, queue_name):
+        directory = self._dir(queue_name)
+        for name in sorted(n for n in os.listdir(directory) if n.endswith(".json")):
+            if float(name.split("-", 1)[0]) > time.time():
+                return None
+            claimed = os.path.join(directory, name + ".claimed")
+            try:
+                os.rename(os.path.join(directory, name), claimed)
+            except FileNotFoundError:
+                # another worker got it first
+                continue
+            with open(claimed) as f:
+                message = json.load(f)
+            os.remove(claimed)
+            return message
+        return None
+
+    def pending(self):
+        return sum(len([n for n in os.listdir(os.path.join(self.root, q)) if n.endswith(".json")]) for q in os.listdir(self.root)) if os.path.isdir(self.root) else 0
+
+
+class SqsQueue:
+    '''
+    Production queues. queue_urls maps the queue names to SQS queue urls, the lambdas are
+    triggered by the queues so there is no receive here.
+    '''
+
+    def __init__(self, sqs, queue_urls):
+        self.sqs = sqs
+        self.queue_urls = queue_urls
+
+    def send(self, queue_name, message, delay=0):
+        # SQS delays messages by at most 15 minutes
+        self.sqs.send_message(QueueUrl=self.queue_urls[queue_name], MessageBody=json.dumps(message), DelaySeconds=min(int(delay), 900))
+
+
+def sqs_queue_from_env(sqs):
+    return SqsQueue(sqs, {PIPELINE_QUEUE: os.environ["PIPELINE_QUEUE_URL"], VERIFICATION_QUEUE: os.environ["VERIFICATION_QUEUE_URL"]})
+
+
+class FileCheckpointStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, job_id, name):
+        return os.path.join(self.root, job_id, f"{name}.json")
+
+    def save(self, job_id, name, data):
+        path = self._path(job_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, job_id, name):
+        try:
+            with open(self._path(job_id, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+class S3CheckpointStore:
+    def __init__(self, s3, bucket_name):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+
+    def _key(self, job_id, name):
+        return f"{CHECKPOINT_PREFIX}{job_id}/{name}.json"
+
+    def save(self, job_id, name, data):
+        self.s3.put_object(Bucket=self.bucket_name, Key=self._key(job_id, name), Body=json.dumps(data).encode("utf-8"), ContentType="application/json")
+
+    def load(self, job_id, name):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket_name, Key=self._key(job_id, name))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def run_stage(job, handlers, queue, store):
+    '''
+    Runs the stage named in the job record and sends the job on to the next stage.
+
+    handler(job, store) returns the stage output, which is saved as the stage's checkpoint.
+    A stage that already has a checkpoint (a redelivered or resumed job) isn't run again.
+    The output may name the next stage with "next", None ends the job, and list further job records
+    to start with "fan_out". A failing stage is sent back to the queue with a growing delay, after
+    MAX_ATTEMPTS the job skips to publish with the error. A Deferred stage is sent back with its delay
+    as often as it takes.
+    '''
+    job_id, stage = job["job_id"], job["stage"]
+    output = store.load(job_id, stage)
+    if output is None:
+        started = time.time()
+        try:
+            output = handlers[stage](job, store)
+        except Deferred as e:
+            logger.info(f"Job {job_id}: {stage} deferred for {e.delay}s: {e}")
+            queue.send(queue_for(stage), job, delay=e.delay)
+            return None
+        except Exception as e:
+            if job["attempt"] < MAX_ATTEMPTS:
+                logger.error(f"Job {job_id}: {stage} failed on attempt {job['attempt']}, retrying: {e}")
+                queue.send(queue_for(stage), dict(job, attempt=job["attempt"] + 1), delay=RETRY_DELAY_SECONDS * job["attempt"])
+                return None
+            if stage == "publish":
+                raise
+            logger.error(f"Job {job_id}: {stage} failed after {job['attempt']} attempts: {e}")
+            output = {"error": f"{stage} failed: {e}", "next": "publish"}
+        output["seconds"] = round(time.time() - started, 3)
+        store.save(job_id, stage, output)
+        logger.info(f"Job {job_id}: {stage} done in {output['seconds']}s")
+    else:
+        logger.info(f"Job {job_id}: {stage} already done, resuming after it")
+    # jobs split off by the stage, e.g. one per group of a multi-group upload
+    for child in output.get("fan_out", []):
+        queue.send(queue_for(child["stage"]), child)
+    following = output["next"] if "next" in output else next_stage(stage)
+    if following:
+        queue.send(queue_for(following), dict(job, stage=following, attempt=1))
+    return output
+
+
+def handle_sqs_event(event, handlers, queue, store):
+    '''
+    Lambda entry point for an SQS trigger, each record is one job record.
+    '''
+    for record in event["Records"]:
+        run_stage(json.loads(record["body"]), handlers, queue, store)
+
+
+def first_error(store, job_id):
+    '''
+    The error of the first stage that failed, or None.
+    '''
+    for stage in STAGES:
+        output = store.load(job_id, stage)
+        if output and output.get("error"):
+            return output["error"]
+    return None
+
+
+class LocalOrchestrator:
+    '''
+    Runs jobs through the stages in this process, with workers threads taking messages from
+    a MemoryQueue or FileQueue. Used for tests, benchmarks and running the pipeline from a laptop.
+    '''
+
+    def __init__(self, handlers, queue=None, store=None, workers=4, poll_seconds=0.05):
+        self.handlers = handlers
+        self.queue = queue or MemoryQueue()
+        self.store = store
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+
+    def submit(self, job):
+        self.queue.send(queue_for(job["stage"]), job)
+
+    def run(self):
+        '''
+        Works until every queue is empty and no stage is running.
+        '''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running = set()
+            while True:
+                while len(running) < self.workers:
+                    job = self.queue.receive(PIPELINE_QUEUE) or self.queue.receive(VERIFICATION_QUEUE)
+                    if job is None:
+                        break
+                    running.add(executor.submit(run_stage, job, self.handlers, self.queue, self.store))
+                if not running:
+                    if not self.queue.pending():
+                        return
+                    # only delayed retries left
+                    time.sleep(self.poll_seconds)
+                    continue
+                done, running = wait(running, timeout=self.poll_seconds, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
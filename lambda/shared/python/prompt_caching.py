@@ -0,0 +1,52 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# models that take Bedrock prompt cache checkpoints, by model id without the cross-region prefix.
+# other models get the same prompt as a single text block, a checkpoint would fail the request.
+# verification only sends checkpoints in direct mode and in the cascade tiers, the agent builds its own messages.
+# the default verification config (agent mode, Claude 3.5 Sonnet v1) doesn't use prompt caching
+PROMPT_CACHING_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022",
+    "anthropic.claude-3-7-sonnet-20250219",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+)
+CROSS_REGION_PREFIXES = ("us.", "eu.", "apac.")
+
+
+def supports_prompt_caching(model_id):
+    for region_prefix in CROSS_REGION_PREFIXES:
+        if model_id.startswith(region_prefix):
+            model_id = model_id[len(region_prefix):]
+            break
+    return model_id.startswith(PROMPT_CACHING_MODELS)
+
+
+def cached_prefix_content(prefix, rest, model_id, enabled=True):
+    '''
+    Message content for a prompt whose prefix is the same for many calls (the data, the instructions)
+    and whose rest changes (the insight). The prefix ends in a cache checkpoint, so the calls after the first
+    one read it from the prompt cache instead of processing it again. Without enabled it's one text block.
+    '''
+    if not (enabled and supports_prompt_caching(model_id)):
+        return [{"type": "text", "text": prefix + rest}]
+    return [
+        {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": rest},
+    ]
+
+
+def report_cache_usage(model_id, model_response):
+    '''
+    Logs the prompt cache read and write tokens of a model response and returns them.
+    '''
+    usage = model_response.get("usage") or {}
+    tokens = {
+        "input_tokens": usage.get("input_tokens", 0),
+        "cache_read_input_tokens": usage.get("cache_read_input_tokens", 0),
+        "cache_write_input_tokens": usage.get("cache_creation_input_tokens", 0),
+    }
+    logger.info(f"Prompt cache for {model_id}: {tokens}")
+    return tokens
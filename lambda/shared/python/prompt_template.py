@@ -0,0 +1,74 @@
+import re
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SLOT = re.compile(r"\{([a-z_]+)\}")
+
+
+class PromptTemplate:
+    '''
+    A prompt with {name} slots, split once into its literal pieces and slots.
+    Rendering joins the pieces and the values in one pass: the output is built once at its final size
+    and the inserted values are never searched for placeholders themselves.
+    Only the given slot names are slots, other braces in the prompt stay as they are.
+    '''
+
+    def __init__(self, text, slots, name="prompt"):
+        self.text = text
+        self.name = name
+        self.slots = frozenset(slots)
+        # literal pieces at the even positions, slot names at the odd ones
+        self.parts = []
+        position = 0
+        for match in SLOT.finditer(text):
+            if match.group(1) not in self.slots:
+                continue
+            self.parts.append(text[position:match.start()])
+            self.parts.append(match.group(1))
+            position = match.end()
+        self.parts.append(text[position:])
+        self.literal_size = sum(len(part) for part in self.parts[::2])
+        self._splits = {}
+
+    @classmethod
+    def from_file(cls, path, slots):
+        with open(path, "r") as f:
+            return cls(f.read(), slots, name=path)
+
+    def split(self, slot):
+        '''
+        The template up to the given slot and the template from the slot on, e.g. to send the part
+        that is the same for every call as a cacheable prefix. Kept, so the split is also only done once.
+        '''
+        if slot not in self._splits:
+            position = self.text.index("{" + slot + "}")
+            head, tail = self.text[:position], self.text[position:]
+            self._splits[slot] = (
+                PromptTemplate(head, [name for name in self.slots if "{" + name + "}" in head], name=f"{self.name} (before {slot})"),
+                PromptTemplate(tail, [name for name in self.slots if "{" + name + "}" in tail], name=f"{self.name} (from {slot})"),
+            )
+        return self._splits[slot]
+
+    def _values(self, values):
+        missing = self.slots - values.keys()
+        if missing:
+            raise KeyError(f"{self.name} is missing values for {sorted(missing)}")
+        return {name: str(values[name]) for name in self.slots}
+
+    def size(self, **values):
+        '''
+        Length of the rendered prompt in characters, without rendering it.
+        '''
+        values = self._values(values)
+        return self.literal_size + sum(len(values[name]) for name in self.parts[1::2])
+
+    def render(self, **values):
+        values = self._values(values)
+        pieces = self.parts[:]
+        for i in range(1, len(pieces), 2):
+            pieces[i] = values[pieces[i]]
+        rendered = "".join(pieces)
+        logger.info(f"Rendered {self.name}: {len(rendered)} characters")
+        return rendered
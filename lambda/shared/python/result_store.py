@@ -0,0 +1,259 @@
+import collections
+import datetime
+import json
+import logging
+import threading
+import uuid
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# every group's results live under results/<group id>/, so a group is found with one exact key or prefix.
+# each run writes its own immutable object under runs/, the manifest holds the runs that were compacted into it
+RESULTS_PREFIX = "results/"
+MANIFEST_FILE = "manifest.json"
+RUNS_DIR = "runs/"
+
+# runs younger than this are left for the next compaction, so a run whose write is still in flight can't be skipped
+COMPACTION_SETTLE_SECONDS = 300
+MANIFEST_WRITE_ATTEMPTS = 5
+
+# S3 answers a failed If-Match / If-None-Match with one of these
+CONDITIONAL_WRITE_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+
+def group_prefix(group_id):
+    return f"{RESULTS_PREFIX}{str(group_id).strip()}/"
+
+
+def manifest_key(group_id):
+    return group_prefix(group_id) + MANIFEST_FILE
+
+
+def runs_prefix(group_id):
+    return group_prefix(group_id) + RUNS_DIR
+
+
+def legacy_key(prefix):
+    # results used to be written to <group ids joined by _>.json at the root of the bucket
+    return f"{prefix}.json"
+
+
+def split_groups(prefix):
+    return [group for group in str(prefix).split("_") if group]
+
+
+def new_run_id(now=None):
+    # sortable by time so the runs of a group list in the order they were written. compaction relies on that,
+    # a run id is made right before the run is written and never reused by a later attempt
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime("%Y%m%dT%H%M%S%fZ") + "-" + uuid.uuid4().hex[:8]
+
+
+def list_group_keys(s3, bucket_name, group_id, prefix=None, start_after=None):
+    '''
+    Object keys stored for one group (or under one of its sub prefixes), in key order, following pagination.
+    '''
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix or group_prefix(group_id)}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for page in paginator.paginate(**kwargs):
+        keys += [obj["Key"] for obj in page.get("Contents", [])]
+    return keys
+
+
+def list_groups(s3, bucket_name):
+    groups = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=RESULTS_PREFIX, Delimiter="/"):
+        groups += [p["Prefix"][len(RESULTS_PREFIX):].rstrip("/") for p in page.get("CommonPrefixes", [])]
+    return groups
+
+
+class ResultCache:
+    '''
+    LRU of parsed result objects by key, kept in a warm lambda. Entries hold the object's ETag,
+    run objects never change so they are served as is, anything else is revalidated with If-None-Match.
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, content):
+        with self.lock:
+            self.entries[key] = (etag, content)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def _missing(e):
+    return e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
+
+
+def _not_modified(e):
+    return e.response.get("Error", {}).get("Code") in ("304", "NotModified")
+
+
+def read_json(s3, bucket_name, key, with_etag=False, cache=None):
+    '''
+    Returns the parsed JSON object stored at key, or None when there is no such key.
+    With with_etag the object's ETag is returned as well, for a conditional write back.
+    With a ResultCache a cached copy is used when S3 says it's still current.
+    '''
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None and f"/{RUNS_DIR}" in key:
+        cache.hits += 1
+        return cached[::-1] if with_etag else cached[1]
+    kwargs = {"IfNoneMatch": cached[0]} if cached is not None else {}
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=key, **kwargs)
+    except ClientError as e:
+        if cached is not None and _not_modified(e):
+            cache.hits += 1
+            return cached[::-1] if with_etag else cached[1]
+        if _missing(e):
+            return (None, None) if with_etag else None
+        raise
+    content = json.loads(obj["Body"].read().decode("utf-8"))
+    if cache is not None:
+        cache.misses += 1
+        cache.put(key, obj["ETag"], content)
+    return (content, obj["ETag"]) if with_etag else content
+
+
+def write_json(s3, bucket_name, key, content, **conditions):
+    '''
+    Writes content as JSON. conditions are passed on to put_object (IfMatch / IfNoneMatch).
+    '''
+    return s3.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(content).encode("utf-8"), ContentType="application/json", **conditions)
+
+
+def run_key(group_id, run_id):
+    return runs_prefix(group_id) + f"{run_id}.json"
+
+
+def run_exists(s3, bucket_name, group_id, run_id):
+    try:
+        s3.head_object(Bucket=bucket_name, Key=run_key(group_id, run_id))
+    except ClientError as e:
+        if _missing(e):
+            return False
+        raise
+    return True
+
+
+def write_run(s3, bucket_name, group_id, run_id, result):
+    '''
+    Stores one run's result as its own object. The cost doesn't depend on how many runs the group already has.
+    '''
+    key = run_key(group_id, run_id)
+    # run ids are unique, If-None-Match only guards against overwriting a run by mistake
+    write_json(s3, bucket_name, key, result, IfNoneMatch="*")
+    return key
+
+
+def save_run(s3, bucket_name, prefix, result, run_id=None):
+    '''
+    Stores a run over one or more groups (prefix is the group ids joined by _) in the runs of each group.
+    '''
+    run_id = run_id or new_run_id()
+    return [write_run(s3, bucket_name, group_id, run_id, result) for group_id in split_groups(prefix)]
+
+
+def _read_manifest(s3, bucket_name, group_id, cache=None):
+    manifest, etag = read_json(s3, bucket_name, manifest_key(group_id), with_etag=True, cache=cache)
+    if manifest is None:
+        # not compacted yet, the legacy root file (if any) is where the history starts
+        manifest = {"history": read_json(s3, bucket_name, legacy_key(group_id), cache=cache) or {}, "compacted_through": None}
+    return manifest, etag
+
+
+def _append(history, s3, bucket_name, run_keys, cache=None):
+    for key in run_keys:
+        result = read_json(s3, bucket_name, key, cache=cache)
+        if result is not None:
+            history[f"data_{len(history) + 1}"] = result
+    return history
+
+
+def load_history(s3, bucket_name, group_id, cache=None):
+    '''
+    The group's result history ({"data_1": ..., "data_2": ...}), or None when the group has no results.
+    That is the compacted manifest plus the runs written since the last compaction, numbered in run order.
+    The returned dict is a new one, but the entries may be shared with the cache and must not be changed.
+    '''
+    manifest, _ = _read_manifest(s3, bucket_name, group_id, cache)
+    pending = list_group_keys(s3, bucket_name, group_id, prefix=runs_prefix(group_id), start_after=manifest["compacted_through"])
+    history = _append(dict(manifest["history"]), s3, bucket_name, pending, cache)
+    return history or None
+
+
+def latest_result(s3, bucket_name, group_id, cache=None):
+    '''
+    The group's most recent result, or None when the group has no results.
+    '''
+    manifest, _ = _read_manifest(s3, bucket_name, group_id, cache)
+    pending = list_group_keys(s3, bucket_name, group_id, prefix=runs_prefix(group_id), start_after=manifest["compacted_through"])
+    if pending:
+        return read_json(s3, bucket_name, pending[-1], cache=cache)
+    history = manifest["history"]
+    return history.get(f"data_{len(history)}") if history else None
+
+
+def _settled_runs(s3, bucket_name, group_id, start_after, now):
+    settled = []
+    paginator = s3.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket_name, "Prefix": runs_prefix(group_id)}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get("Contents", []):
+            if (now - obj["LastModified"]).total_seconds() < COMPACTION_SETTLE_SECONDS:
+                # stop at the first recent run, everything after it is left in order for the next compaction
+                return settled
+            settled.append(obj["Key"])
+    return settled
+
+
+def compact_group(s3, bucket_name, group_id, now=None):
+    '''
+    Folds the settled runs of a group into its manifest. The manifest is written with If-Match on the
+    ETag it was read with (If-None-Match when it's new), a concurrent compaction makes the write fail
+    and the merge is redone on the fresh manifest. Returns the number of runs compacted.
+    '''
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    for _ in range(MANIFEST_WRITE_ATTEMPTS):
+        manifest, etag = _read_manifest(s3, bucket_name, group_id)
+        runs = _settled_runs(s3, bucket_name, group_id, manifest["compacted_through"], now)
+        if not runs:
+            return 0
+        manifest["history"] = _append(manifest["history"], s3, bucket_name, runs)
+        manifest["compacted_through"] = runs[-1]
+        manifest["compacted_at"] = now.isoformat()
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            write_json(s3, bucket_name, manifest_key(group_id), manifest, **condition)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_ERRORS:
+                logger.info(f"Manifest of group {group_id} changed while compacting, retrying")
+                continue
+            raise
+        logger.info(f"Compacted {len(runs)} runs of group {group_id}")
+        return len(runs)
+    raise RuntimeError(f"Could not update the manifest of group {group_id} after {MANIFEST_WRITE_ATTEMPTS} attempts")
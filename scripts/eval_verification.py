@@ -0,0 +1,86 @@
+"""
+Compares verification with and without a verification cascade on a labeled set of insights.
+Both runs verify the same insights against the same handed off tables and report accuracy, time per insight
+and which tier decided the insights. Bedrock is called, so AWS credentials are needed.
+
+The labeled set is a JSON lines file with {"insight": ..., "label": "correct" | "incorrect"} per line.
+The tables are the "tables" of a job's preprocess checkpoint ({"bucket": ..., "hourly": ..., "child": ..., "group": ...}).
+The config is a config.json as uploaded, its "verification_cascade" is the cascade under test.
+
+usage: python scripts/eval_verification.py --tables <tables.json> --config <config.json> [--use-cache] <labeled.jsonl>
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+sys.path.insert(0, os.path.join(ROOT, "shared", "python"))
+
+
+def load_verify_insights():
+    # the lambda reads its prompt relative to the working directory when it is imported
+    cwd = os.getcwd()
+    try:
+        sys.path.insert(0, os.path.join(ROOT, "insights_verification"))
+        os.chdir(os.path.join(ROOT, "insights_verification"))
+        import verify_insights
+    finally:
+        os.chdir(cwd)
+    return verify_insights.verify_insights
+
+
+def evaluate(verify_insights, event, labels):
+    started = time.time()
+    result = verify_insights(event, None)
+    elapsed = time.time() - started
+    correct = sum(verdict == label for verdict, label in zip(result["verdicts"], labels))
+    tiers = collections.Counter(detail["tier"] or detail["decided_by"] for detail in result["details"])
+    return {
+        "accuracy": round(correct / len(labels), 3),
+        "seconds_per_insight": round(elapsed / len(labels), 2),
+        "decided_by": dict(tiers),
+        "escalations": sum(len(detail["escalations"]) for detail in result["details"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", required=True)
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--use-cache", action="store_true", help="allow LLM cache hits, the timings are then not comparable")
+    parser.add_argument("labeled")
+    args = parser.parse_args()
+
+    with open(args.tables) as f:
+        tables = json.load(f)
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.labeled) as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    if not config.get("verification_cascade"):
+        sys.exit("the config has no verification_cascade to evaluate")
+
+    verify_insights = load_verify_insights()
+    labels = [example["label"].strip().lower() for example in examples]
+    event = {
+        "insights": [example["insight"] for example in examples],
+        "artifact": tables,
+        "insights_verification_model_id": config.get("insights_verification_model_id", "anthropic.claude-3-5-sonnet-20240620-v1:0"),
+        "verification_rate_limits": config.get("verification_rate_limits"),
+        "verification_concurrency": config.get("verification_concurrency"),
+        "verification_mode": config.get("verification_mode"),
+        "verification_prompt_caching": config.get("verification_prompt_caching", True),
+        "use_llm_cache": args.use_cache,
+    }
+    report = {
+        "baseline": evaluate(verify_insights, dict(event, verification_cascade=None), labels),
+        "cascade": evaluate(verify_insights, dict(event, verification_cascade=config["verification_cascade"]), labels),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
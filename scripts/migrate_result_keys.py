@@ -0,0 +1,73 @@
+"""
+Moves result files from the legacy <group ids>.json keys at the root of the bucket
+to the compacted manifest at results/<group id>/manifest.json.
+
+A legacy file written for several groups (e.g. 101_102.json) is copied into the history of each group.
+Groups that already have a manifest are left alone, so run it before the first compaction.
+
+usage: python scripts/migrate_result_keys.py --bucket <bucket> [--apply] [--delete-legacy]
+"""
+import argparse
+import os
+import re
+import sys
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "shared", "python"))
+
+from result_store import manifest_key, read_json, split_groups, write_json  # noqa: E402
+
+LEGACY_KEY = re.compile(r"^(\d+(?:_\d+)*)\.json$")
+
+
+def legacy_keys(s3, bucket_name):
+    paginator = s3.get_paginator("list_objects_v2")
+    # the legacy files sit at the root, so a delimiter keeps the listing to the root level
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            if LEGACY_KEY.match(obj["Key"]):
+                yield obj["Key"]
+
+
+def merge(history, legacy):
+    entries = [legacy[k] for k in sorted(legacy, key=lambda k: int(k.split("_")[-1]) if k.split("_")[-1].isdigit() else 0) if k.startswith("data_")]
+    for entry in entries:
+        history[f"data_{len(history) + 1}"] = entry
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--apply", action="store_true", help="write the new keys, without it the script only prints what it would do")
+    parser.add_argument("--delete-legacy", action="store_true", help="delete the legacy keys after they were migrated")
+    args = parser.parse_args()
+
+    s3 = boto3.client("s3")
+    migrated = {}
+    for key in legacy_keys(s3, args.bucket):
+        legacy = read_json(s3, args.bucket, key) or {}
+        for group_id in split_groups(LEGACY_KEY.match(key).group(1)):
+            target = manifest_key(group_id)
+            if target not in migrated and read_json(s3, args.bucket, target) is not None:
+                print(f"{key}: {target} already exists, skipping group {group_id}")
+                continue
+            migrated[target] = merge(migrated.get(target, {}), legacy)
+            print(f"{key} -> {target} ({len(legacy)} entries)")
+
+    if not args.apply:
+        print(f"dry run, {len(migrated)} group manifests would be written. rerun with --apply")
+        return
+    for target, history in migrated.items():
+        # runs written before the migration are all still pending, compaction picks them up after this history
+        write_json(s3, args.bucket, target, {"history": history, "compacted_through": None}, IfNoneMatch="*")
+    if args.delete_legacy:
+        for key in list(legacy_keys(s3, args.bucket)):
+            s3.delete_object(Bucket=args.bucket, Key=key)
+            print(f"deleted {key}")
+    print(f"migrated {len(migrated)} group manifests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Runs the insights pipeline for uploaded ZIP files in this process, with local queues and checkpoints
+instead of SQS. The stages still read the uploads from S3 and call Bedrock, so AWS credentials are needed.
+
+With --state-dir the queues and checkpoints are kept on disk and an interrupted run resumes where it stopped
+when it is started again with the same directory (and no keys).
+
+usage: python scripts/run_pipeline_local.py --bucket <bucket> [--workers 4] [--state-dir <dir>] <zip key> [<zip key> ...]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+sys.path.insert(0, os.path.join(ROOT, "shared", "python"))
+
+from pipeline import FileCheckpointStore, FileQueue, LocalOrchestrator, MemoryQueue, new_job  # noqa: E402
+
+
+def load_handlers():
+    # both lambdas read their prompt files relative to the working directory when they are imported
+    handlers = {}
+    cwd = os.getcwd()
+    try:
+        for package in ("insights_generation", "insights_verification"):
+            sys.path.insert(0, os.path.join(ROOT, package))
+        os.chdir(os.path.join(ROOT, "insights_generation"))
+        import stages
+        import blocked_words
+        # read lazily by the blocked word filter, load them while the prompts can be found
+        blocked_words.prompt_words()
+        handlers.update(stages.HANDLERS)
+        os.chdir(os.path.join(ROOT, "insights_verification"))
+        import verify_insights
+        handlers.update(verify_insights.HANDLERS)
+    finally:
+        os.chdir(cwd)
+    return handlers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--state-dir", help="keep queues and checkpoints here, otherwise they are kept in memory and a temp dir")
+    parser.add_argument("keys", nargs="*")
+    args = parser.parse_args()
+
+    os.environ.setdefault("S3_BUCKET_NAME", args.bucket)
+    if args.state_dir:
+        queue = FileQueue(os.path.join(args.state_dir, "queues"))
+        store = FileCheckpointStore(os.path.join(args.state_dir, "checkpoints"))
+    else:
+        queue = MemoryQueue()
+        store = FileCheckpointStore(tempfile.mkdtemp(prefix="insights-pipeline-"))
+
+    orchestrator = LocalOrchestrator(load_handlers(), queue, store, workers=args.workers)
+    for key in args.keys:
+        job = new_job(args.bucket, key)
+        orchestrator.submit(job)
+        print(f"{key}: job {job['job_id']}")
+    started = time.time()
+    orchestrator.run()
+    print(f"done in {time.time() - started:.1f}s, checkpoints in {store.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import datetime
+import hashlib
+import io
+
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeS3:
+    '''
+    The S3 calls the result store makes, in memory. put_object honours If-Match / If-None-Match,
+    objects get the LastModified of the fake clock in now.
+    '''
+
+    def __init__(self):
+        self.objects = {}
+        self.now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def _error(self, code):
+        return ClientError({"Error": {"Code": code}}, "fake")
+
+    def _etag(self, key):
+        return hashlib.md5(self.objects[key][0]).hexdigest()
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None):
+        if IfNoneMatch == "*" and Key in self.objects:
+            raise self._error("PreconditionFailed")
+        if IfMatch and (Key not in self.objects or self._etag(Key) != IfMatch):
+            raise self._error("PreconditionFailed")
+        self.objects[Key] = (Body, self.now)
+        return {}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        if Key not in self.objects:
+            raise self._error("NoSuchKey")
+        if IfNoneMatch and IfNoneMatch == self._etag(Key):
+            raise self._error("304")
+        return {"Body": io.BytesIO(self.objects[Key][0]), "ETag": self._etag(Key)}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self._error("404")
+        return {"ETag": self._etag(Key)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix="", StartAfter=None, Delimiter=None):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix) and (StartAfter is None or k > StartAfter))
+        yield {"Contents": [{"Key": k, "LastModified": self.objects[k][1]} for k in keys]}
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
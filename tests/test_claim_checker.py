@@ -0,0 +1,70 @@
+import pandas as pd
+
+from claim_checker import extract_claims, check_insight, prepare_frames
+
+
+def _frames(awc, ct):
+    # one row per day for child 12 over three weeks, awc and ct give the per-week daily values
+    days = pd.date_range("2024-01-01", periods=21)
+    child = pd.DataFrame({
+        "Child ID": 12,
+        "Day Date": days.strftime("%m/%d/%Y"),
+        "AWC Sum": [awc[i // 7] for i in range(21)],
+        "CT Sum": [ct[i // 7] for i in range(21)],
+    })
+    return prepare_frames(pd.DataFrame(), child, pd.DataFrame())
+
+
+def test_change_claim():
+    claims = extract_claims("The CT Sum dropped about 20% from week 1 to week 2.")
+    assert len(claims) == 1
+    claim = claims[0]
+    assert claim["metric"] == "CT Sum"
+    assert claim["entity"] == {"type": "group"}
+    assert claim["comparison"] == "change"
+    assert claim["value"] == -20.0
+    assert claim["periods"] == [("week", 1), ("week", 2)]
+    assert claim["approximate"]
+    assert not claim["mixed_metrics"]
+
+
+def test_child_value_claim():
+    claims = extract_claims("Child 7 had an AWC Sum of 5000 on 01/02/2024.")
+    assert [(c["entity"], c["metric"], c["comparison"], c["value"]) for c in claims] == [({"type": "child", "id": 7}, "AWC Sum", "value", 5000.0)]
+
+
+def test_extreme_hour_claim():
+    claims = extract_claims("The group had the most conversational turns at 3 pm.")
+    assert [(c["metric"], c["comparison"], c["value"]) for c in claims] == [("CT Sum", "highest", 15)]
+
+
+def test_two_metric_sentence_has_a_claim_per_change():
+    claims = extract_claims("Child 12's AWC Sum rose 10% between week 1 and week 3 while the CT Sum dropped 30%.")
+    assert [(c["metric"], c["value"]) for c in claims] == [("AWC Sum", 10.0), ("CT Sum", -30.0)]
+    assert all(c["mixed_metrics"] and c["periods"] == [("week", 1), ("week", 3)] for c in claims)
+
+
+def test_two_metric_sentence_that_holds_is_correct():
+    frames = _frames(awc=[1000, 1000, 1100], ct=[100, 100, 70])
+    verdict, results = check_insight("Child 12's AWC Sum rose 10% between week 1 and week 3 while the CT Sum dropped 30%.", frames)
+    assert [r["status"] for r in results] == ["supported", "supported"]
+    assert verdict == "correct"
+
+
+def test_refuted_claim_of_a_two_metric_sentence_goes_to_the_model():
+    frames = _frames(awc=[1000, 1000, 1100], ct=[100, 100, 90])
+    verdict, results = check_insight("Child 12's AWC Sum rose 10% between week 1 and week 3 while the CT Sum dropped 30%.", frames)
+    assert [r["status"] for r in results] == ["supported", "refuted"]
+    assert verdict is None
+
+
+def test_refuted_single_metric_claim_is_incorrect():
+    frames = _frames(awc=[1000, 1000, 1100], ct=[100, 100, 90])
+    verdict, _ = check_insight("Child 12's CT Sum dropped 30% between week 1 and week 3.", frames)
+    assert verdict == "incorrect"
+
+
+def test_unchecked_numbers_leave_it_to_the_model():
+    frames = _frames(awc=[1000, 1000, 1100], ct=[100, 100, 70])
+    verdict, _ = check_insight("Child 12's CT Sum dropped 30% between week 1 and week 3, the most of 5 children.", frames)
+    assert verdict is None
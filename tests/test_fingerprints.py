@@ -0,0 +1,104 @@
+import os
+
+import pandas as pd
+import pytest
+
+from fingerprints import fingerprint, compare, delta_insight_count
+
+GENERATION_DIR = os.path.join(os.path.dirname(__file__), "..", "lambda", "insights_generation")
+CONFIG = {"number_of_insights": 5, "Insights_generation_model_id": "model", "paraphrase_concurrency": 4}
+
+
+def _frames(days, ct=100):
+    dates = [f"01/{day:02d}/2024" for day in days]
+    hourly = pd.DataFrame({"Child ID": 1, "Day Date": dates, "CT Sum": ct})
+    child = pd.DataFrame({"Child ID": 1, "Day Date": dates, "CT Sum": ct})
+    group = pd.DataFrame({"Group ID": 7, "Day Date": dates, "CT Avg": 10.5})
+    return hourly, child, group
+
+
+def test_same_data_in_another_order_is_reused():
+    hourly, child, group = _frames([1, 2, 3])
+    previous = fingerprint(hourly, child, group, CONFIG)
+    shuffled = [df.iloc[::-1][df.columns[::-1]] for df in (hourly, child, group)]
+    assert compare(previous, fingerprint(*shuffled, CONFIG)) == ("reuse", [])
+
+
+def test_runtime_settings_dont_force_a_run():
+    previous = fingerprint(*_frames([1, 2]), CONFIG)
+    assert compare(previous, fingerprint(*_frames([1, 2]), dict(CONFIG, paraphrase_concurrency=1))) == ("reuse", [])
+
+
+def test_added_days_are_a_delta():
+    previous = fingerprint(*_frames([1, 2]), CONFIG)
+    assert compare(previous, fingerprint(*_frames([1, 2, 3, 4]), CONFIG)) == ("delta", ["01/03/2024", "01/04/2024"])
+
+
+@pytest.mark.parametrize("current", [
+    fingerprint(*_frames([1, 2], ct=[100, 101]), CONFIG),
+    fingerprint(*_frames([1]), CONFIG),
+    fingerprint(*_frames([1, 2]), dict(CONFIG, number_of_insights=3)),
+])
+def test_changed_or_removed_days_or_config_are_a_full_run(current):
+    previous = fingerprint(*_frames([1, 2]), CONFIG)
+    assert compare(previous, current) == ("full", [])
+
+
+def test_nothing_to_compare_with_is_a_full_run():
+    assert compare(None, fingerprint(*_frames([1]), CONFIG)) == ("full", [])
+
+
+def test_delta_insight_count():
+    assert delta_insight_count(5, ["a"], list("abcdefghij")) == 1
+    assert delta_insight_count(5, list("abcd"), list("abcdefghij")) == 2
+    assert delta_insight_count(5, list("abcdefghij"), list("abcdefghij")) == 5
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    # the module reads its prompt files relative to the working directory when it's imported
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.chdir(GENERATION_DIR)
+    import stages
+    monkeypatch.setattr(stages, "write_tables", lambda s3, bucket, frames: {name: f"artifacts/{name}" for name in frames})
+    return stages
+
+
+def _previous(days, insights):
+    result = {
+        "insights": [insight for insight, _ in insights],
+        "verification_result": [verdict for _, verdict in insights],
+        "verification_details": [{} for _ in insights],
+        "Insight_generation_timestamp": "2024-01-01T00:00:00",
+        "fingerprints": fingerprint(*_frames(days), CONFIG),
+    }
+    return lambda s3, bucket, group_id: result
+
+
+def test_plan_group_reuses_unchanged_data(stages, monkeypatch):
+    monkeypatch.setattr(stages, "latest_result", _previous([1, 2], [("a", "correct")]))
+    output, stage = stages.plan_group("bucket", "7", *_frames([1, 2]), CONFIG)
+    assert stage == "publish"
+    assert output["reuse"]["insights"] == ["a"]
+    assert "tables" not in output
+
+
+def test_plan_group_carries_only_what_fits(stages, monkeypatch):
+    previous = [(f"insight {i}", "incorrect" if i == 1 else "correct") for i in range(6)]
+    monkeypatch.setattr(stages, "latest_result", _previous(list(range(1, 10)), previous))
+    output, stage = stages.plan_group("bucket", "7", *_frames(list(range(1, 11))), CONFIG)
+    assert stage == "generate"
+    incremental = output["incremental"]
+    assert incremental["new_days"] == ["01/10/2024"]
+    assert incremental["no_of_insights"] == 1
+    assert incremental["carried_slots"] == 4
+    # the incorrect one is left out and only as many as fit are verified again
+    assert [entry["insight"] for entry in incremental["carried"]] == ["insight 0", "insight 2", "insight 3", "insight 4"]
+    assert "delta_tables" in output
+
+
+def test_plan_group_runs_changed_data_in_full(stages, monkeypatch):
+    monkeypatch.setattr(stages, "latest_result", _previous([1, 2], [("a", "correct")]))
+    output, stage = stages.plan_group("bucket", "7", *_frames([1, 2], ct=[1, 2]), CONFIG)
+    assert stage == "generate"
+    assert "incremental" not in output and "reuse" not in output
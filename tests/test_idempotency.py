@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from idempotency import MemoryMarkerStore, LeaseLost, group_lease, lease_holder, renew_job_leases
+from pipeline import FileCheckpointStore
+
+
+def test_claim_is_taken_once():
+    markers = MemoryMarkerStore()
+    assert markers.claim("processed/abc", {"job_id": "a"})
+    assert not markers.claim("processed/abc", {"job_id": "b"})
+    assert markers.get("processed/abc") == {"job_id": "a"}
+    markers.release("processed/abc")
+    assert markers.claim("processed/abc", {"job_id": "b"})
+
+
+def test_lease_is_held_until_it_expires():
+    markers = MemoryMarkerStore()
+    assert markers.acquire_lease("leases/1", "a", seconds=60, now=1000)
+    assert not markers.acquire_lease("leases/1", "b", seconds=60, now=1059)
+    # expired, another job takes it over
+    assert markers.acquire_lease("leases/1", "b", seconds=60, now=1061)
+    assert not markers.acquire_lease("leases/1", "a", seconds=60, now=1062)
+
+
+def test_holder_renews_its_lease():
+    markers = MemoryMarkerStore()
+    markers.acquire_lease("leases/1", "a", seconds=60, now=1000)
+    assert markers.acquire_lease("leases/1", "a", seconds=60, now=1050)
+    assert not markers.acquire_lease("leases/1", "b", seconds=60, now=1100)
+
+
+def test_only_the_holder_releases_a_lease():
+    markers = MemoryMarkerStore()
+    markers.acquire_lease("leases/1", "a")
+    markers.release_lease("leases/1", "b")
+    assert markers.get("leases/1")["holder"] == "a"
+    markers.release_lease("leases/1", "a")
+    assert markers.get("leases/1") is None
+
+
+def test_group_jobs_hold_their_parents_leases():
+    assert lease_holder({"job_id": "p-7", "parent_id": "p"}) == "p"
+    assert lease_holder({"job_id": "p"}) == "p"
+
+
+def test_renewing_job_leases(tmp_path):
+    markers = MemoryMarkerStore()
+    store = FileCheckpointStore(str(tmp_path))
+    job = {"job_id": "a"}
+    store.save("a", "leases", {"groups": ["1", "2"]})
+    markers.acquire_lease(group_lease("1"), "a", seconds=60, now=1000)
+    markers.acquire_lease(group_lease("2"), "a", seconds=60, now=1000)
+    renew_job_leases(markers, job, store)
+    assert markers.get(group_lease("1"))["expires"] > 1060
+
+    # lease 2 expired and was taken over
+    assert markers.acquire_lease(group_lease("2"), "b", seconds=10 ** 10, now=time.time() + 10 ** 6)
+    with pytest.raises(LeaseLost):
+        renew_job_leases(markers, job, store)
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import clean_frame, date_format, normalize_dates
+
+
+@pytest.mark.parametrize("value", [
+    "01/05/2024",
+    "1/5/2024",
+    "2024-01-05",
+    "2024-01-05T10:30:00",
+    "2024-01-05 10:30:00+02:00",
+    "Jan 5, 2024",
+    "5 January 2024",
+    "01-05-2024",
+])
+def test_dates_match_dateutil(value):
+    assert normalize_dates(pd.Series([value]))[0] == date_format(value)
+
+
+def test_repeated_and_missing_dates():
+    column = pd.Series(["2024-01-05", np.nan, "1/6/2024", "2024-01-05"], index=[3, 4, 5, 6], name="Day Date")
+    normalized = normalize_dates(column)
+    assert normalized.index.tolist() == [3, 4, 5, 6]
+    assert normalized.name == "Day Date"
+    assert normalized[3] == normalized[6] == "1/5/2024"
+    assert pd.isna(normalized[4])
+    assert normalized[5] == "1/6/2024"
+
+
+def test_clean_frame():
+    df = pd.DataFrame({" Child ID ": ["1", "2", "3"], "Day Date": [" 2024-01-05 ", "", "01/06/2024"], "CT Sum": [1, 2, 3]})
+    cleaned = clean_frame(df)
+    assert list(cleaned.columns) == ["Child ID", "Day Date", "CT Sum"]
+    # the row with an empty date is dropped
+    assert cleaned["Child ID"].tolist() == ["1", "3"]
+    assert cleaned["Day Date"].tolist() == ["1/5/2024", "1/6/2024"]
+
+
+def test_clean_frame_keeps_categoricals():
+    df = pd.DataFrame({"Group ID": pd.Categorical([" 7", "7 ", "8"]), "Day Date": ["1/5/2024"] * 3})
+    cleaned = clean_frame(df)
+    assert isinstance(cleaned["Group ID"].dtype, pd.CategoricalDtype)
+    assert cleaned["Group ID"].tolist() == ["7", "7", "8"]
@@ -0,0 +1,69 @@
+import datetime
+import json
+
+from result_store import COMPACTION_SETTLE_SECONDS, compact_group, latest_result, load_history, new_run_id, read_json, manifest_key, write_run
+
+BUCKET = "bucket"
+
+
+def _write(s3, group_id, n, at):
+    # the run id is made right before the write, like publish does
+    s3.now = at
+    return write_run(s3, BUCKET, group_id, new_run_id(at), {"n": n})
+
+
+def test_run_ids_sort_by_time():
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    ids = [new_run_id(start + datetime.timedelta(microseconds=i)) for i in (0, 1, 10, 1000000)]
+    assert sorted(ids) == ids
+
+
+def test_compaction_keeps_run_order_and_leaves_recent_runs(s3):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    for n in range(3):
+        _write(s3, "7", n + 1, start + datetime.timedelta(seconds=n))
+    # a run written just now isn't settled yet
+    late = start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS + 10)
+    _write(s3, "7", 4, late)
+
+    assert compact_group(s3, BUCKET, "7", now=late) == 3
+    manifest = read_json(s3, BUCKET, manifest_key("7"))
+    assert [manifest["history"][f"data_{i}"]["n"] for i in (1, 2, 3)] == [1, 2, 3]
+    # the pending run follows the compacted ones
+    assert [entry["n"] for entry in load_history(s3, BUCKET, "7").values()] == [1, 2, 3, 4]
+    assert latest_result(s3, BUCKET, "7") == {"n": 4}
+
+    assert compact_group(s3, BUCKET, "7", now=late) == 0
+    assert compact_group(s3, BUCKET, "7", now=late + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS)) == 1
+    assert [entry["n"] for entry in load_history(s3, BUCKET, "7").values()] == [1, 2, 3, 4]
+
+
+def test_compaction_stops_at_the_first_recent_run(s3):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    _write(s3, "7", 1, start)
+    recent = _write(s3, "7", 2, start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS))
+    _write(s3, "7", 3, start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS + 1))
+    # run 3 looks settled, but it sorts after run 2 which isn't yet
+    body, _ = s3.objects[recent]
+    s3.objects[recent] = (body, start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS * 2))
+    assert compact_group(s3, BUCKET, "7", now=start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS * 2)) == 1
+    assert [entry["n"] for entry in load_history(s3, BUCKET, "7").values()] == [1, 2, 3]
+
+
+def test_compaction_redoes_the_merge_when_the_manifest_changed(s3):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    run = _write(s3, "7", 1, start)
+    put = s3.put_object
+    raced = []
+
+    def racing_put(**kwargs):
+        # another compaction writes the manifest first
+        if kwargs["Key"] == manifest_key("7") and not raced:
+            raced.append(True)
+            put(Bucket=BUCKET, Key=manifest_key("7"), Body=json.dumps({"history": {"data_1": {"n": 1}}, "compacted_through": run}).encode("utf-8"))
+        return put(**kwargs)
+
+    s3.put_object = racing_put
+    assert compact_group(s3, BUCKET, "7", now=start + datetime.timedelta(seconds=COMPACTION_SETTLE_SECONDS + 1)) == 0
+    assert raced
+    assert read_json(s3, BUCKET, manifest_key("7"))["history"] == {"data_1": {"n": 1}}
@@ -0,0 +1,58 @@
+import io
+
+import pandas as pd
+import pytest
+
+from schemas import SchemaError, read_csv_with_schema
+
+GROUP_CSV = (
+    "Group ID,Day Date,CT Avg,Star CT,Unlisted\n"
+    "7,01/01/2024,5.0,1,x\n"
+    "7,01/02/2024,33.333333,0,y\n"
+)
+
+
+def _read(text, file_name="file_3.csv", **kwargs):
+    return read_csv_with_schema(io.BytesIO(text.encode("utf-8")), file_name, **kwargs)
+
+
+def test_columns_and_dtypes():
+    df = _read(GROUP_CSV)
+    assert list(df.columns) == ["Group ID", "Day Date", "CT Avg", "Star CT"]
+    assert isinstance(df["Group ID"].dtype, pd.CategoricalDtype)
+    assert df["CT Avg"].dtype == "float64"
+    assert df["Star CT"].dtype == "int8"
+
+
+def test_values_are_written_back_as_uploaded():
+    assert _read(GROUP_CSV).to_csv(index=False) == (
+        "Group ID,Day Date,CT Avg,Star CT\n"
+        "7,01/01/2024,5.0,1\n"
+        "7,01/02/2024,33.333333,0\n"
+    )
+
+
+def test_whole_floats_stay_floats():
+    df = _read("Group ID,Day Date,CT Avg\n7,01/01/2024,5.0\n7,01/02/2024,6\n")
+    assert df["CT Avg"].dtype == "float64"
+    assert df["CT Avg"].tolist() == [5.0, 6.0]
+
+
+def test_chunks_give_the_same_frame():
+    text = "Group ID,Day Date,CT Avg,Star CT\n" + "".join(f"{i % 3},01/{i % 28 + 1:02d}/2024,{i / 3},{i % 2}\n" for i in range(50))
+    pd.testing.assert_frame_equal(_read(text, chunksize=7), _read(text))
+
+
+def test_missing_required_column():
+    with pytest.raises(SchemaError, match="CT Avg"):
+        _read("Group ID,Day Date\n7,01/01/2024\n")
+
+
+def test_non_numeric_value():
+    with pytest.raises(SchemaError, match="data row 2"):
+        _read("Group ID,Day Date,CT Avg\n7,01/01/2024,5\n7,01/02/2024,n/a?\n")
+
+
+def test_fraction_in_an_int_column():
+    with pytest.raises(SchemaError, match="Star CT"):
+        _read("Group ID,Day Date,CT Avg,Star CT\n7,01/01/2024,5,1.5\n")